@@ -0,0 +1,101 @@
+"""
+Input tokens and latency over a simulated chat: the old flattened request (the whole history
+as one "ROLE: content" user message) versus structured turns with cache breakpoints.
+
+Usage:
+    ANTHROPIC_API_KEY=... python bench_chat_growth.py [turns]
+
+Every request carries the production system prompt and tools and asks for a few tokens only,
+so latency is dominated by prompt processing. Assistant replies are canned so both runs send
+the same history. Uncached tokens are what each turn pays for in full; cache reads are billed
+at a tenth of that.
+"""
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+from clients import get_anthropic_client
+from ai_utils import TOOLS, CLAUDE_MODEL, build_system_blocks, build_conversation_messages, mark_history_cacheable
+
+TOPICS = ["the quarterly planning review", "a dentist appointment", "lunch with the design team",
+          "the board prep session", "a flight to Denver", "the weekly one-on-one"]
+
+def user_message(turn):
+    topic = TOPICS[turn % len(TOPICS)]
+    return (
+        f"Turn {turn}: I need to sort out {topic}. It should happen sometime next week, ideally in the "
+        f"morning, and it can't overlap with anything already on my calendar. Please check what is "
+        f"free and suggest two options, and keep in mind the travel time between meetings downtown. "
+        f"Also remind me what we decided about the earlier items in this conversation."
+    )
+
+def assistant_message(turn):
+    topic = TOPICS[turn % len(TOPICS)]
+    return (
+        f"For {topic}, Tuesday at 9:30 AM and Thursday at 10:00 AM are both open and leave at least "
+        f"thirty minutes around your other meetings. Earlier we settled the previous items as discussed; "
+        f"let me know which slot you prefer and I'll put it on the calendar."
+    )
+
+def flattened_request(chat):
+    conversation = "".join(f"\n\n{msg['role'].upper()}: {msg['content']}" for msg in chat)
+    messages = [{"role": "user", "content": conversation}]
+    mark_history_cacheable(messages)
+    return build_system_blocks("Sam"), messages
+
+def structured_request(chat):
+    _, messages = build_conversation_messages(chat)
+    mark_history_cacheable(messages, len(messages))
+    return build_system_blocks("Sam"), messages
+
+def run_chat(client, turns, build_request):
+    rows = []
+    chat = []
+    for turn in range(turns):
+        chat.append({"role": "user", "content": user_message(turn)})
+        system, messages = build_request(copy.deepcopy(chat))
+        start = time.perf_counter()
+        response = client.messages.create(
+            model=CLAUDE_MODEL.value,
+            max_tokens=16,
+            system=system,
+            messages=messages,
+            tools=TOOLS
+        )
+        latency = (time.perf_counter() - start) * 1000
+        usage = response.usage
+        rows.append((
+            usage.input_tokens,
+            getattr(usage, "cache_read_input_tokens", 0) or 0,
+            getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            latency
+        ))
+        chat.append({"role": "assistant", "content": assistant_message(turn)})
+    return rows
+
+def report(label, rows):
+    print(f"\n{label}")
+    print(f"{'turn':>4}  {'uncached':>9}  {'cache read':>10}  {'cache write':>11}  {'latency':>9}")
+    for turn, (uncached, read, write, latency) in enumerate(rows, start=1):
+        print(f"{turn:>4}  {uncached:>9}  {read:>10}  {write:>11}  {latency:>7.0f} ms")
+    uncached = sum(row[0] for row in rows)
+    read = sum(row[1] for row in rows)
+    write = sum(row[2] for row in rows)
+    # Cache writes cost 1.25x and reads 0.1x the base input price
+    effective = uncached + 1.25 * write + 0.1 * read
+    print(f"total uncached={uncached} cache_read={read} cache_write={write} "
+          f"effective_input={effective:.0f} mean_latency={sum(row[3] for row in rows) / len(rows):.0f} ms")
+
+if __name__ == '__main__':
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        print("Error: ANTHROPIC_API_KEY is required.")
+        exit(1)
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+
+    client = get_anthropic_client(api_key)
+    report("Flattened history (one growing user message)", run_chat(client, turns, flattened_request))
+    report("Structured turns with cache breakpoints", run_chat(client, turns, structured_request))
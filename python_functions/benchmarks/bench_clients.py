@@ -0,0 +1,47 @@
+"""
+Warm-request latency of a fresh Anthropic client per request versus the pooled client from clients.py.
+
+Usage:
+    ANTHROPIC_API_KEY=... python bench_clients.py [requests]
+
+Each request is a messages.count_tokens call, which is free and returns quickly, so the
+difference between the two columns is connection and TLS setup.
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import anthropic # type: ignore
+from clients import get_anthropic_client
+
+MODEL = "claude-3-7-sonnet-20250219"
+
+def timed_request(client):
+    start = time.perf_counter()
+    client.messages.count_tokens(model=MODEL, messages=[{"role": "user", "content": "ping"}])
+    return (time.perf_counter() - start) * 1000
+
+def report(label, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{label:<16} p50={statistics.median(samples):7.1f} ms  p95={p95:7.1f} ms  mean={statistics.mean(samples):7.1f} ms")
+
+if __name__ == '__main__':
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if not api_key:
+        print("Error: ANTHROPIC_API_KEY is required.")
+        exit(1)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    fresh = [timed_request(anthropic.Anthropic(api_key=api_key)) for _ in range(count)]
+
+    pooled_client = get_anthropic_client(api_key)
+    timed_request(pooled_client)  # Warm up the pool
+    pooled = [timed_request(pooled_client) for _ in range(count)]
+
+    print(f"Warm-request latency over {count} requests")
+    report("fresh client", fresh)
+    report("pooled client", pooled)
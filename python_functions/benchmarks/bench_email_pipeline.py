@@ -0,0 +1,597 @@
+"""
+Throughput and latency of the inbound email path, end to end: process_sendgrid_inbound_email
+(parse, get_secretary_info, log_inbound_task) and the queued worker (routing, process_with_ai
+tool loop, send_email_response), driven at several concurrency levels against local stand-ins.
+
+Usage:
+    python bench_email_pipeline.py [--concurrency 1,4,16] [--emails 100] [--corpus DIR]
+                                   [--responses FILE | --record FILE] [--firestore memory|emulator]
+                                   [--anthropic-ms 800] [--calendar-ms 120] [--sendgrid-ms 150] [--firestore-ms 5]
+
+Stand-ins:
+  Firestore  an in-memory fake, or the emulator at FIRESTORE_EMULATOR_HOST (--firestore emulator)
+  Anthropic  recorded responses (--responses), falling back to a scripted loop: one turn calling
+             get_events and find_free_slots, then structured_output. --record runs against the
+             real API (ANTHROPIC_API_KEY) and saves the responses for later replays.
+  Calendar   an in-process fake service with a fixed set of events
+  SendGrid   a local HTTP server; the pooled client from clients.py posts to it
+
+Every stand-in sleeps for its configured latency, so runs are repeatable. Each level is a closed
+loop: N senders each post a webhook and wait until the reply to their email was sent before
+posting the next one, with the local email queue sized to N. Webhook latency is the time to
+acknowledge SendGrid; end-to-end latency runs from the webhook to the reply being sent.
+
+A corpus is a directory of captured webhook requests (*.http): the Content-Type header line, a
+blank line, then the raw multipart body. Each replay gets a fresh Message-ID so the inbound
+dedupe doesn't drop it; captures without a Message-ID are deduplicated after the first delivery.
+"""
+import argparse
+import contextlib
+import copy
+import glob
+import hashlib
+import http.server
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+# Parameters are read from the environment; set them before the functions modules are imported
+os.environ.setdefault("EMAIL_PIPELINE_MODE", "local")
+os.environ.setdefault("CLAUDE_API_KEY", os.environ.get("ANTHROPIC_API_KEY", "bench"))
+os.environ.setdefault("SENDGRID_API_KEY", "bench")
+os.environ.setdefault("SENDING_DOMAIN", "starlis.com")
+
+BOUNDARY = "benchboundary"
+SECRETARIES = 8  # Generated emails are spread over this many secretaries (one user each)
+CALENDAR_EVENTS = 40  # Events in the fake calendar, over the next few weeks
+
+SUBJECTS = ["Quick sync next week", "Project kickoff", "Coffee?", "Quarterly review", "Interview scheduling"]
+BODIES = [
+    "Hi, could we find 30 minutes next week to go over the launch plan? Mornings work best for me.",
+    "Hello! I'd like to schedule a kickoff meeting with the team sometime next week. What times are free?",
+    "Are you available for coffee one afternoon next week? Happy to come to your office.",
+    "We need an hour next week for the quarterly review. Please suggest a couple of options.",
+    "Thanks for applying! Could you share some availability next week for a 45 minute interview?"
+]
+
+# --- Firestore ---------------------------------------------------------------------------
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+class FakeDocument:
+    def __init__(self, store, path, doc_id):
+        self._store = store
+        self.path = f"{path}/{doc_id}"
+        self.id = doc_id
+
+    def collection(self, name):
+        return FakeCollection(self._store, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        return self._store.read(self.path, self.id)
+
+    def set(self, data, merge=False):
+        self._store.write(self.path, data, merge=merge)
+
+    def update(self, data):
+        self._store.write(self.path, data, update=True)
+
+    def create(self, data):
+        self._store.write(self.path, data, create=True)
+
+class FakeCollection:
+    def __init__(self, store, path):
+        self._store = store
+        self._path = path
+
+    def document(self, doc_id=None):
+        return FakeDocument(self._store, self._path, doc_id or uuid.uuid4().hex[:20])
+
+class FakeWriteBatch:
+    """Batched and transactional writes; applied together on commit (transactions on return)."""
+
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref.path, data, {'merge': merge}))
+
+    def update(self, ref, data):
+        self._writes.append((ref.path, data, {'update': True}))
+
+    def commit(self):
+        with self._store.lock:
+            for path, data, options in self._writes:
+                self._store.write(path, data, **options)
+        self._writes = []
+
+class FakeFirestore:
+    """
+    Enough of the Firestore client for the email path: documents, subcollections, batches,
+    transactions (serialized by one lock) and the SERVER_TIMESTAMP/ArrayUnion/Increment transforms.
+    """
+
+    def __init__(self, latency_ms):
+        self.docs = {}
+        self.lock = threading.RLock()
+        self.latency = latency_ms / 1000
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeWriteBatch(self)
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+    def read(self, path, doc_id):
+        time.sleep(self.latency)
+        with self.lock:
+            return FakeSnapshot(doc_id, copy.deepcopy(self.docs.get(path)))
+
+    def write(self, path, data, merge=False, update=False, create=False):
+        from firebase_admin import firestore
+        from google.api_core.exceptions import AlreadyExists, NotFound
+        time.sleep(self.latency)
+        with self.lock:
+            if create and path in self.docs:
+                raise AlreadyExists(path)
+            if update and path not in self.docs:
+                raise NotFound(path)
+            document = self.docs.get(path, {}) if (merge or update) else {}
+            for key, value in data.items():
+                target = document
+                parts = key.split('.') if update else [key]
+                for part in parts[:-1]:
+                    target = target.setdefault(part, {})
+                self._apply(target, parts[-1], value, merge)
+            self.docs[path] = document
+
+    def _apply(self, target, key, value, merge):
+        from firebase_admin import firestore
+        current = target.get(key)
+        if merge and isinstance(value, dict):
+            if not isinstance(current, dict):
+                current = target[key] = {}
+            for nested_key, nested_value in value.items():
+                self._apply(current, nested_key, nested_value, merge)
+            return
+        if value is firestore.SERVER_TIMESTAMP:
+            value = datetime.now()
+        elif isinstance(value, firestore.ArrayUnion):
+            value = (current or []) + [item for item in value.values if item not in (current or [])]
+        elif isinstance(value, firestore.Increment):
+            value = (current or 0) + value.value
+        target[key] = copy.deepcopy(value)
+
+def fake_transactional(function):
+    """Stand-in for firestore.transactional: runs the function once under the store lock and commits."""
+    def run(transaction, *args, **kwargs):
+        with transaction._store.lock:
+            result = function(transaction, *args, **kwargs)
+            transaction.commit()
+        return result
+    return run
+
+def emulator_client():
+    from google.auth.credentials import AnonymousCredentials
+    from google.cloud import firestore
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        print("Error: FIRESTORE_EMULATOR_HOST is required for --firestore emulator.")
+        exit(1)
+    return firestore.Client(project=os.environ.get("GCLOUD_PROJECT", "bench"), credentials=AnonymousCredentials())
+
+# --- Anthropic ---------------------------------------------------------------------------
+
+def request_key(request):
+    """Identifies a request by its email (the first message) and its position in the tool loop."""
+    first = request["messages"][0]["content"]
+    if isinstance(first, list):
+        first = "".join(block.get("text", "") for block in first if block.get("type") == "text")
+    kind = "tools" if request.get("tools") else "text"
+    digest = hashlib.sha256(first.encode("utf-8")).hexdigest()[:16]
+    return f"{kind}:{digest}:{len(request['messages'])}"
+
+def scripted_response(request):
+    """A response for the default script, in Messages API form."""
+    usage = {"input_tokens": 1500, "output_tokens": 120, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+    if not request.get("tools"):
+        # Triage and thread summaries
+        system = request.get("system") if isinstance(request.get("system"), str) else ""
+        text = "full" if "Answer with one word" in system else "The sender asked for a meeting next week."
+        content = [{"type": "text", "text": text}]
+        stop_reason = "end_turn"
+    elif len(request["messages"]) == 1 and request.get("tool_choice", {}).get("type") != "tool":
+        start = date.today() + timedelta(days=7 - date.today().weekday())
+        days = {"start_day": start.strftime("%m/%d/%Y"), "end_day": (start + timedelta(days=4)).strftime("%m/%d/%Y")}
+        content = [
+            {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}", "name": "get_events", "input": days},
+            {"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}", "name": "find_free_slots",
+             "input": dict(days, duration_minutes=30)}
+        ]
+        stop_reason = "tool_use"
+    else:
+        content = [{
+            "type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:12]}", "name": "structured_output",
+            "input": {
+                "reasoning": "Checked the calendar and found open slots.",
+                "email_response": "<p>Hello,</p><p>Tuesday at 10:00 AM or Thursday at 2:00 PM both work.</p>"
+                                  "<p>Starla, Assistant to Sam</p>"
+            }
+        }]
+        stop_reason = "tool_use"
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:12]}", "type": "message", "role": "assistant", "model": request["model"],
+        "content": content, "stop_reason": stop_reason, "stop_sequence": None, "usage": usage
+    }
+
+class FakeMessages:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, **request):
+        from anthropic.types import Message
+        time.sleep(self._client.latency)
+        recorded = self._client.recordings.get(request_key(request))
+        with self._client.lock:
+            self._client.requests += 1
+            if recorded is not None:
+                self._client.replayed += 1
+        return Message.model_validate(recorded if recorded is not None else scripted_response(request))
+
+class FakeAnthropic:
+    """Replays recorded responses by request key; unknown requests get the scripted loop."""
+
+    def __init__(self, latency_ms, recordings):
+        self.latency = latency_ms / 1000
+        self.recordings = recordings
+        self.messages = FakeMessages(self)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.replayed = 0
+
+        # The first validation of each content block type builds its model; do that before the
+        # senders start, since concurrent first validations can leave blocks as plain dicts
+        from anthropic.types import Message
+        for request in ({"tools": []}, {"tools": [{}]}, {"tools": [{}], "tool_choice": {"type": "tool"}}):
+            Message.model_validate(scripted_response(dict(request, model="warmup", messages=[{"content": ""}])))
+
+class RecordingMessages:
+    def __init__(self, client, recordings):
+        self._client = client
+        self._recordings = recordings
+
+    def create(self, **request):
+        response = self._client.messages.create(**request)
+        self._recordings[request_key(request)] = response.model_dump(mode="json")
+        return response
+
+class RecordingAnthropic:
+    """The real client; every response is kept for --record."""
+
+    def __init__(self, client, recordings):
+        self.messages = RecordingMessages(client, recordings)
+
+# --- Calendar ----------------------------------------------------------------------------
+
+class FakeRequest:
+    def __init__(self, latency, result):
+        self._latency = latency
+        self._result = result
+
+    def execute(self):
+        time.sleep(self._latency)
+        return copy.deepcopy(self._result)
+
+class FakeEvents:
+    def __init__(self, calendar):
+        self._calendar = calendar
+
+    def list(self, syncToken=None, **params):
+        items = [] if syncToken else self._calendar.items
+        return FakeRequest(self._calendar.latency, {"items": items, "nextSyncToken": "bench-sync-token"})
+
+    def insert(self, calendarId, body, **params):
+        return FakeRequest(self._calendar.latency, dict(body, id=uuid.uuid4().hex, htmlLink="https://calendar.example"))
+
+    def patch(self, calendarId, eventId, body, **params):
+        return FakeRequest(self._calendar.latency, dict(body, id=eventId))
+
+    def delete(self, calendarId, eventId, **params):
+        return FakeRequest(self._calendar.latency, {})
+
+class FakeFreeBusy:
+    def __init__(self, calendar):
+        self._calendar = calendar
+
+    def query(self, body):
+        calendars = {item["id"]: {"busy": []} for item in body.get("items", [])}
+        return FakeRequest(self._calendar.latency, {"calendars": calendars})
+
+class FakeCalendar:
+    """The Calendar service every user gets: the same CALENDAR_EVENTS working-hours events."""
+
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        start = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+        self.items = []
+        for number in range(CALENDAR_EVENTS):
+            event_start = start + timedelta(days=number // 2, hours=(number % 2) * 4)
+            self.items.append({
+                "id": f"event{number}",
+                "summary": f"Meeting {number}",
+                "start": {"dateTime": event_start.isoformat() + "-05:00"},
+                "end": {"dateTime": (event_start + timedelta(hours=1)).isoformat() + "-05:00"},
+                "description": "Agenda: " + "status updates and planning " * 10
+            })
+
+    def events(self):
+        return FakeEvents(self)
+
+    def freebusy(self):
+        return FakeFreeBusy(self)
+
+# --- SendGrid ----------------------------------------------------------------------------
+
+def start_sendgrid_server(latency_ms):
+    """A local stand-in for the SendGrid v3 API that accepts every mail after latency_ms."""
+    sent = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(latency_ms / 1000)
+            sent.append(len(body))
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, sent
+
+# --- Payloads ----------------------------------------------------------------------------
+
+def form_body(fields):
+    parts = [
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    ]
+    return ("".join(parts) + f"--{BOUNDARY}--\r\n").encode("utf-8")
+
+def generated_payloads():
+    """One webhook per subject/body pair and secretary, in SendGrid's parsed-fields format."""
+    payloads = []
+    for number in range(len(BODIES) * SECRETARIES):
+        secretary_id = f"bench{number % SECRETARIES:03d}"
+        sender = f"sender{number}@example.com"
+        fields = {
+            "to": f"sam-{secretary_id}@{os.environ['SENDING_DOMAIN']}",
+            "from": sender,
+            "subject": SUBJECTS[number % len(SUBJECTS)],
+            "text": BODIES[number % len(BODIES)],
+            "headers": f"From: {sender}\r\nMessage-ID: <seed{number}@example.com>\r\n",
+            "envelope": json.dumps({"from": sender, "to": [f"sam-{secretary_id}@{os.environ['SENDING_DOMAIN']}"]})
+        }
+        payloads.append((f"multipart/form-data; boundary={BOUNDARY}", form_body(fields)))
+    return payloads
+
+def load_corpus(directory):
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.http"))):
+        with open(path, "rb") as capture:
+            raw = capture.read()
+        head, _, body = raw.partition(b"\r\n\r\n") if b"\r\n\r\n" in raw else raw.partition(b"\n\n")
+        match = re.search(rb"^content-type:\s*(.+?)\s*$", head, re.IGNORECASE | re.MULTILINE)
+        if not match:
+            print(f"Skipping {path}: no Content-Type line")
+            continue
+        payloads.append((match.group(1).decode("latin-1"), body))
+    return payloads
+
+def with_new_message_id(body, number):
+    return re.sub(rb"(Message-ID:\s*)<[^>\r\n]*>", lambda m: m.group(1) + f"<replay{number}-{uuid.uuid4().hex}@bench>".encode(),
+                  body, count=1, flags=re.IGNORECASE)
+
+def make_request(content_type, body):
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+    return Request(EnvironBuilder(method="POST", path="/", data=body, content_type=content_type).get_environ())
+
+def post_webhook(app, content_type, body):
+    """Call the webhook function the way the Functions Framework does, inside a Flask request context."""
+    import main
+    from flask import request
+    with app.test_request_context("/", method="POST", data=body, content_type=content_type):
+        return main.process_sendgrid_inbound_email(request._get_current_object())
+
+def seed_secretaries(db, payloads):
+    """Create the secretary and user documents every payload's recipient needs."""
+    from email_utils import parse_sendgrid_inbound_email, extract_secretary_id_from_email
+    seeded = set()
+    for content_type, body in payloads:
+        email_data = parse_sendgrid_inbound_email(make_request(content_type, body)) or {}
+        secretary_id = extract_secretary_id_from_email(email_data.get("to", ""), os.environ["SENDING_DOMAIN"])
+        if not secretary_id or secretary_id in seeded:
+            continue
+        seeded.add(secretary_id)
+        user_id = f"user-{secretary_id}"
+        db.collection("users").document(user_id).set({"first_name": "Sam", "firstName": "Sam", "lastName": "Bench"})
+        db.collection("ai_secretaries").document(secretary_id).set({
+            "user_id": user_id, "secretary_id": secretary_id, "name": "Starla",
+            "user_full_name": "Sam Bench", "user_email": "sam@example.com",
+            "personality": "helpful and professional", "custom_instructions": ""
+        })
+    return seeded
+
+# --- Load --------------------------------------------------------------------------------
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+def run_level(concurrency, payloads, total, sent):
+    import email_pipeline
+    import main
+    from flask import Flask
+
+    pending = threading.local()
+    original_enqueue = email_pipeline.enqueue_email_task
+
+    def tracking_enqueue(*args):
+        pending.future = original_enqueue(*args)
+        return pending.future
+
+    main.enqueue_email_task = tracking_enqueue
+    email_pipeline._local_queue = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="email-task")
+    app = Flask("bench")
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+    webhook_ms, end_to_end_ms, statuses = [], [], {}
+    sent_before = len(sent)
+
+    def sender():
+        while True:
+            with counter_lock:
+                number = next(counter, None)
+            if number is None:
+                return
+            content_type, body = payloads[number % len(payloads)]
+            pending.future = None
+            start = time.perf_counter()
+            response = post_webhook(app, content_type, with_new_message_id(body, number))
+            acknowledged = time.perf_counter()
+            if pending.future is not None:
+                pending.future.result()
+            finished = time.perf_counter()
+            with counter_lock:
+                webhook_ms.append((acknowledged - start) * 1000)
+                if pending.future is not None:
+                    end_to_end_ms.append((finished - start) * 1000)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        threads = [threading.Thread(target=sender) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    email_pipeline._local_queue.shutdown()
+    main.enqueue_email_task = original_enqueue
+
+    print(f"{concurrency:>11}  {total / elapsed:>10.2f}  "
+          f"{percentile(webhook_ms, 0.5):>8.0f} {percentile(webhook_ms, 0.95):>8.0f} {percentile(webhook_ms, 0.99):>8.0f}  "
+          f"{percentile(end_to_end_ms, 0.5):>8.0f} {percentile(end_to_end_ms, 0.95):>8.0f} {percentile(end_to_end_ms, 0.99):>8.0f}  "
+          f"{len(sent) - sent_before:>5}  {statuses}")
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--emails", type=int, default=100, help="Emails per level")
+    parser.add_argument("--corpus", help="Directory of captured webhook requests (*.http)")
+    parser.add_argument("--responses", help="Replay Anthropic responses recorded with --record")
+    parser.add_argument("--record", help="Call the real Anthropic API and save its responses here")
+    parser.add_argument("--firestore", choices=["memory", "emulator"], default="memory")
+    parser.add_argument("--anthropic-ms", type=float, default=800)
+    parser.add_argument("--calendar-ms", type=float, default=120)
+    parser.add_argument("--sendgrid-ms", type=float, default=150)
+    parser.add_argument("--firestore-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    import clients
+    import tools
+    from firebase_admin import firestore
+
+    server, sent = start_sendgrid_server(args.sendgrid_ms)
+    clients.SENDGRID_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    if args.firestore == "emulator":
+        clients._db = emulator_client()
+    else:
+        clients._db = FakeFirestore(args.firestore_ms)
+        firestore.transactional = fake_transactional
+
+    calendar = FakeCalendar(args.calendar_ms)
+    tools.get_calendar_service = lambda user_id: calendar
+
+    recordings = {}
+    if args.record:
+        api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not api_key:
+            print("Error: ANTHROPIC_API_KEY is required for --record.")
+            exit(1)
+        anthropic_client = RecordingAnthropic(clients.get_anthropic_client(api_key), recordings)
+    else:
+        if args.responses:
+            with open(args.responses) as recorded:
+                recordings = json.load(recorded)
+        anthropic_client = FakeAnthropic(args.anthropic_ms, recordings)
+    clients._anthropic_clients[os.environ["CLAUDE_API_KEY"]] = anthropic_client
+
+    payloads = load_corpus(args.corpus) if args.corpus else generated_payloads()
+    if not payloads:
+        print("Error: no payloads to send.")
+        exit(1)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        secretaries = seed_secretaries(clients._db, payloads)
+
+    print(f"{len(payloads)} payloads for {len(secretaries)} secretaries, {args.emails} emails per level")
+    print(f"latency (ms): anthropic={args.anthropic_ms:g} calendar={args.calendar_ms:g} "
+          f"sendgrid={args.sendgrid_ms:g} firestore={args.firestore_ms:g}")
+    print(f"\n{'concurrency':>11}  {'emails/s':>10}  {'ack p50':>8} {'p95':>8} {'p99':>8}  "
+          f"{'e2e p50':>8} {'p95':>8} {'p99':>8}  {'sent':>5}  webhook statuses")
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        run_level(concurrency, payloads, args.emails, sent)
+
+    if isinstance(clients._db, FakeFirestore):
+        tasks = [doc for path, doc in clients._db.docs.items() if path.count("/") == 1 and path.startswith("task_history/")]
+        statuses = {}
+        for task in tasks:
+            statuses[task.get("status")] = statuses.get(task.get("status"), 0) + 1
+        tool_calls = [call for task in tasks for call in task.get("tool_calls", [])]
+        tool_errors = sum(1 for call in tool_calls if call.get("error"))
+        print(f"\nTask statuses: {statuses}, {len(tool_calls)} tool calls ({tool_errors} failed)")
+        daily = [doc for path, doc in clients._db.docs.items() if path.startswith("usage_daily/")]
+        print(f"Anthropic usage: {sum(doc.get('requests', 0) for doc in daily)} requests, "
+              f"{sum(doc.get('input_tokens', 0) for doc in daily)} input and "
+              f"{sum(doc.get('output_tokens', 0) for doc in daily)} output tokens, "
+              f"${sum(doc.get('cost_usd', 0) for doc in daily):.4f} (at list prices)")
+
+    if args.record:
+        with open(args.record, "w") as output:
+            json.dump(recordings, output, indent=1)
+        print(f"\nSaved {len(recordings)} responses to {args.record}")
+    elif args.responses:
+        print(f"\n{anthropic_client.replayed} of {anthropic_client.requests} Anthropic requests replayed from {args.responses}")
+    server.shutdown()
+
+if __name__ == '__main__':
+    main_benchmark()
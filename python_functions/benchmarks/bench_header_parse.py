@@ -0,0 +1,75 @@
+"""
+Header extraction cost on large raw emails: five extract_header-style full-message scans
+(the previous approach) versus one parse_header_block pass.
+
+Usage:
+    python bench_header_parse.py [size_mb ...]
+"""
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+from email_utils import parse_header_block
+
+HEADERS = ['From', 'To', 'Subject', 'Message-ID', 'References']
+
+def build_raw_email(size_mb):
+    """A multipart email with a base64 attachment of roughly size_mb megabytes."""
+    attachment = base64.encodebytes(os.urandom(int(size_mb * 1024 * 1024 * 3 / 4))).decode('ascii')
+    return "\r\n".join([
+        "From: Alice Example <alice@example.com>",
+        "To: ai-abc12345@starlis.com",
+        "Subject: =?utf-8?q?Quarterly_planning_=E2=80=93_agenda?=",
+        "Message-ID: <1234@mail.example.com>",
+        "References: <1000@mail.example.com>",
+        "\t<1100@mail.example.com>",
+        "MIME-Version: 1.0",
+        'Content-Type: multipart/mixed; boundary="XYZ"',
+        "",
+        "--XYZ",
+        "Content-Type: text/plain",
+        "",
+        "Can we meet Tuesday?",
+        "--XYZ",
+        "Content-Type: application/pdf",
+        "Content-Transfer-Encoding: base64",
+        "",
+        attachment,
+        "--XYZ--",
+        ""
+    ])
+
+def legacy_extract_header(raw_email, header_name):
+    """The previous extract_header: splits the whole message for every header."""
+    lines = raw_email.splitlines()
+    header_value = ""
+    for i, line in enumerate(lines):
+        if line.startswith(f"{header_name}:"):
+            header_value = line[len(header_name)+1:].strip()
+            for j in range(i+1, len(lines)):
+                if lines[j].startswith((' ', '\t')):
+                    header_value += ' ' + lines[j].strip()
+                else:
+                    break
+            break
+    return header_value
+
+def best_of(function, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+if __name__ == '__main__':
+    sizes = [float(size) for size in sys.argv[1:]] or [1, 5, 10, 25]
+    print(f"{'size':>8}  {'5x scans':>12}  {'one pass':>12}")
+    for size_mb in sizes:
+        raw_email = build_raw_email(size_mb)
+        legacy_ms = best_of(lambda: [legacy_extract_header(raw_email, name) for name in HEADERS])
+        single_ms = best_of(lambda: parse_header_block(raw_email))
+        print(f"{size_mb:>6} MB  {legacy_ms:>9.2f} ms  {single_ms:>9.3f} ms")
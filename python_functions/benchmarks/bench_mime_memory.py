@@ -0,0 +1,89 @@
+"""
+Peak memory of parsing a SendGrid raw-email webhook body: werkzeug's in-memory form parse
+plus string splitting (the previous approach) versus read_inbound_form_stream.
+
+Usage:
+    python bench_mime_memory.py [size_mb ...]
+
+Each measurement runs in a fresh process and reports the peak Python heap allocation during
+the parse (tracemalloc), which is not masked by memory the imports already reserved.
+"""
+import base64
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+BOUNDARY = "benchboundary"
+
+def write_form_body(path, size_mb):
+    """Write a multipart/form-data body whose 'email' field holds a raw email with a size_mb attachment."""
+    attachment = base64.encodebytes(os.urandom(int(size_mb * 1024 * 1024 * 3 / 4)))
+    with open(path, "wb") as body:
+        body.write(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="email"\r\n\r\n'.encode())
+        body.write(
+            b"From: Alice <alice@example.com>\r\nTo: ai-abc12345@starlis.com\r\nSubject: Agenda\r\n"
+            b"Message-ID: <1234@mail.example.com>\r\nMIME-Version: 1.0\r\n"
+            b'Content-Type: multipart/mixed; boundary="XYZ"\r\n\r\n'
+            b"--XYZ\r\nContent-Type: text/plain\r\n\r\nCan we meet Tuesday?\r\n"
+            b"--XYZ\r\nContent-Type: application/pdf\r\nContent-Disposition: attachment; filename=\"a.pdf\"\r\n"
+            b"Content-Transfer-Encoding: base64\r\n\r\n"
+        )
+        body.write(attachment)
+        body.write(b"--XYZ--\r\n")
+        body.write(f"\r\n--{BOUNDARY}--\r\n".encode())
+
+def run_child(mode, path):
+    """Parse the body at path with the given mode and print the peak allocation in MB."""
+    from werkzeug.formparser import parse_form_data
+    from email_utils import read_inbound_form_stream
+
+    content_type = f"multipart/form-data; boundary={BOUNDARY}"
+    tracemalloc.start()
+    with open(path, "rb") as stream:
+        if mode == "legacy":
+            environ = {
+                "REQUEST_METHOD": "POST",
+                "CONTENT_TYPE": content_type,
+                "CONTENT_LENGTH": str(os.path.getsize(path)),
+                "wsgi.input": stream
+            }
+            _, form, _ = parse_form_data(environ, max_form_memory_size=None)
+            email_raw = form.to_dict().get("email", "")
+            body = email_raw.split("\r\n\r\n", 1)[1]
+        else:
+            class StreamRequest:
+                pass
+            request = StreamRequest()
+            request.content_type = content_type
+            request.stream = stream
+            _, raw_email, attachments, _ = read_inbound_form_stream(request)
+            body = raw_email["text"]
+    _, peak = tracemalloc.get_traced_memory()
+    print(f"{peak / (1024 * 1024):.1f}")
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        run_child(sys.argv[2], sys.argv[3])
+        exit(0)
+
+    sizes = [float(size) for size in sys.argv[1:]] or [1, 10, 25]
+    print(f"{'size':>8}  {'in-memory form':>15}  {'streaming':>10}   (peak allocation)")
+    for size_mb in sizes:
+        with tempfile.NamedTemporaryFile(suffix=".form", delete=False) as body_file:
+            path = body_file.name
+        try:
+            write_form_body(path, size_mb)
+            results = []
+            for mode in ("legacy", "streaming"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", mode, path],
+                    capture_output=True, text=True, check=True
+                ).stdout.strip().splitlines()[-1]
+                results.append(float(output))
+            print(f"{size_mb:>6} MB  {results[0]:>12.1f} MB  {results[1]:>7.1f} MB")
+        finally:
+            os.unlink(path)
@@ -0,0 +1,68 @@
+"""
+Cold-start import cost of each functions module, measured with python -X importtime.
+
+Usage:
+    python import_time.py [module ...]
+
+Exits with status 1 if any module's cumulative import time is over its budget.
+Run it a few times: the first run also pays for compiling .pyc files.
+"""
+import os
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions")
+
+# Cumulative import time budgets in milliseconds
+IMPORT_BUDGETS_MS = {
+    "main": 1500,
+    "generate_title": 800,
+    "ai_utils": 300,
+    "email_utils": 300,
+    "clients": 50
+}
+
+# Modules that should not be imported until a request needs them
+DEFERRED_MODULES = ["anthropic", "googleapiclient", "sendgrid", "google.cloud.firestore"]
+
+def measure(module):
+    """
+    Import a module in a fresh interpreter.
+
+    Returns:
+      tuple: (cumulative import time in ms, {imported module: cumulative ms})
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=FUNCTIONS_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    imported = {}
+    for line in result.stderr.splitlines():
+        # Format: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imported[name.strip()] = int(cumulative) / 1000
+    return imported.get(module, 0.0), imported
+
+if __name__ == '__main__':
+    modules = sys.argv[1:] or list(IMPORT_BUDGETS_MS)
+    over_budget = False
+
+    for module in modules:
+        total_ms, imported = measure(module)
+        budget = IMPORT_BUDGETS_MS.get(module)
+        status = "ok" if budget is None or total_ms <= budget else "OVER BUDGET"
+        over_budget = over_budget or status != "ok"
+        print(f"{module:<16} {total_ms:8.1f} ms  (budget {budget} ms)  {status}")
+
+        eager = [name for name in DEFERRED_MODULES if name in imported]
+        if eager:
+            print(f"  imported at module scope: {', '.join(eager)}")
+
+    exit(1 if over_budget else 0)
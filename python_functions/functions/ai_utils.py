@@ -1,33 +1,312 @@
 import json
-from firebase_admin import credentials, firestore
-import firebase_admin
-from firebase_functions.params import StringParam
-import anthropic # type: ignore
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from firebase_functions.params import StringParam, BoolParam
 import logging
 from datetime import date
-from email_utils import format_email_response
-
-# Initialize Firebase Admin SDK
-try:
-    cred = credentials.Certificate("starlis_admin_creds.json")
-    firebase_admin.initialize_app(cred)
-except ValueError:
-    # App already initialized
-    pass
-
-# Initialize Firestore
-db = firestore.client()
+from email_utils import format_email_response, estimate_tokens
+from clients import get_anthropic_client
+from profile_cache import get_user_profile
+from task_history import TaskHistoryWriter
+from response_cache import lookup_response, store_response
+from tracing import span, model_span, record_model_usage, bind_context
 
 CLAUDE_API_KEY = StringParam('CLAUDE_API_KEY')
 CLAUDE_MODEL = StringParam('CLAUDE_MODEL', 'claude-3-7-sonnet-20250219')
 
+# Model for emails the router sends to a single request without calendar tools (see email_router)
+SMALL_MODEL = StringParam('SMALL_MODEL', 'claude-3-5-haiku-20241022')
+
 # Initialize Globals
 MAX_TOOL_CALLS = 10  # Maximum number of tool calls allowed in a single request
+MAX_PARALLEL_TOOL_CALLS = 4  # Maximum number of tool calls running at once for a single request
+TOOL_CALL_TIMEOUT_SECONDS = 30  # Maximum time to wait for a single tool call, from when it gets a slot
+TOOL_EXECUTOR_MAX_WORKERS = 16  # Threads shared by all requests on this instance
+HUNG_TOOL_CALLS_MAX = 8  # Timed-out calls still holding executor threads before new calls are refused
+HUNG_TOOL_CALLS_MAX_PER_USER = 2  # Same, for one user's calls
+
+# Tool loop budget per request: once another free turn could run past one of these (or
+# max_tool_calls), the next request forces structured_output (see ToolLoopBudget)
+TOOL_LOOP_MAX_SECONDS = 60  # Wall clock of the whole loop
+TOOL_LOOP_MAX_TOKENS = 120000  # Input (cached included) and output tokens over all requests of the loop
+
+# Tools that change calendar data; calls on the same event_id run one after another
+MUTATING_TOOLS = {"add_event", "update_event", "delete_event"}
+
+# Shared so worker threads (and their per-thread Calendar services) are reused across requests
+_tool_executor = ThreadPoolExecutor(max_workers=TOOL_EXECUTOR_MAX_WORKERS, thread_name_prefix="tool-call")
+
+# Timed-out tool calls whose threads are still running, by user_id
+_hung_tool_calls = {}
+_hung_tool_calls_lock = threading.Lock()
+
+# Tool results are resent on every later turn of the loop, so they are compacted:
+# only the fields below are kept per tool (others are sent whole), long event descriptions
+# are cut, JSON has no spaces, and events already returned unchanged become {"id", "unchanged"}
+COMPACT_TOOL_RESULTS = BoolParam('COMPACT_TOOL_RESULTS', default=True)
+TOOL_RESULT_DESCRIPTION_MAX_CHARS = 300
+TOOL_RESULT_FIELDS = {
+    "get_events": ["id", "summary", "start", "end", "location", "description"],
+    "add_event": ["id", "summary", "start", "end", "location", "link"],
+    "update_event": ["id", "summary", "start", "end", "location"]
+}
 
-def process_with_ai(secretary_info, from_address, subject, body, task_id):
+# Labels shown in the chat while a tool is running
+TOOL_PROGRESS_LABELS = {
+    "add_event": "Adding event to calendar",
+    "get_events": "Checking calendar",
+    "delete_event": "Removing event from calendar",
+    "update_event": "Updating calendar event",
+    "find_free_slots": "Finding open times"
+}
+
+# Tool definitions sent with every request. The last tool carries the cache breakpoint,
+# so the whole tool list is cached as one prefix.
+TOOLS = [
+    {
+        "name": "add_event",
+        "description": "Add an event to the user's calendar. Use this when the user wants to schedule a meeting, call, appointment, or any event with a specific time.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "title": {
+                    "type": "string",
+                    "description": "The title or name of the event"
+                },
+                "description": {
+                    "type": "string",
+                    "description": "Details about the event (optional)"
+                },
+                "start_day": {
+                    "type": "string",
+                    "description": "Start day in MM/DD/YYYY format"
+                },
+                "end_day": {
+                    "type": "string",
+                    "description": "End day in MM/DD/YYYY format"
+                },
+                "start_time": {
+                    "type": "string",
+                    "description": "Start time in HH:MM AM/PM format"
+                },
+                "end_time": {
+                    "type": "string",
+                    "description": "End time in HH:MM AM/PM format"
+                },
+                "location": {
+                    "type": "string",
+                    "description": "Location of the event (optional)"
+                },
+                "attendees": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    },
+                    "description": "List of email addresses for attendees (optional)"
+                }
+            },
+            "required": ["title", "start_day", "end_day", "start_time", "end_time"]
+        }
+    },
+    {
+        "name": "get_events",
+        "description": "Get events from the user's calendar for a specific date range. Events already returned earlier in this conversation, and unchanged since, are listed as {\"id\": ..., \"unchanged\": true}.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "start_day": {
+                    "type": "string",
+                    "description": "Start day in MM/DD/YYYY format"
+                },
+                "end_day": {
+                    "type": "string",
+                    "description": "End day in MM/DD/YYYY format"
+                }
+            },
+            "required": ["start_day", "end_day"]
+        }
+    },
+    {
+        "name": "delete_event",
+        "description": "Delete an event from the user's calendar.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "event_id": {
+                    "type": "string",
+                    "description": "The unique ID of the event to delete"
+                }
+            },
+            "required": ["event_id"]
+        }
+    },
+    {
+        "name": "update_event",
+        "description": "Update an existing event in the user's calendar.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "event_id": {
+                    "type": "string",
+                    "description": "The unique ID of the event to update"
+                },
+                "title": {
+                    "type": "string",
+                    "description": "Updated title of the event (optional)"
+                },
+                "description": {
+                    "type": "string",
+                    "description": "Updated description (optional)"
+                },
+                "start_day": {
+                    "type": "string",
+                    "description": "Updated start day in MM/DD/YYYY format (optional)"
+                },
+                "end_day": {
+                    "type": "string",
+                    "description": "Updated end day in MM/DD/YYYY format (optional)"
+                },
+                "start_time": {
+                    "type": "string",
+                    "description": "Updated start time in HH:MM AM/PM format (optional)"
+                },
+                "end_time": {
+                    "type": "string",
+                    "description": "Updated end time in HH:MM AM/PM format (optional)"
+                },
+                "location": {
+                    "type": "string",
+                    "description": "Updated location (optional)"
+                },
+                "attendees": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    },
+                    "description": "Updated list of attendee email addresses (optional)"
+                }
+            },
+            "required": ["event_id"]
+        }
+    },
+    {
+        "name": "find_free_slots",
+        "description": "Find open time windows for a meeting of a given length, on the user's calendar and on the attendees' calendars where their free/busy is visible. Returns only the free windows (day, start_time, end_time), not the events. Use this to suggest or pick meeting times.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "start_day": {
+                    "type": "string",
+                    "description": "First day to search in MM/DD/YYYY format"
+                },
+                "end_day": {
+                    "type": "string",
+                    "description": "Last day to search in MM/DD/YYYY format"
+                },
+                "duration_minutes": {
+                    "type": "integer",
+                    "description": "Meeting length in minutes"
+                },
+                "working_hours_start": {
+                    "type": "string",
+                    "description": "Earliest start time each day in HH:MM AM/PM format (optional, default 09:00 AM)"
+                },
+                "working_hours_end": {
+                    "type": "string",
+                    "description": "Latest end time each day in HH:MM AM/PM format (optional, default 05:00 PM)"
+                },
+                "attendees": {
+                    "type": "array",
+                    "items": {
+                        "type": "string"
+                    },
+                    "description": "Email addresses of other participants whose availability should be respected (optional)"
+                },
+                "include_weekends": {
+                    "type": "boolean",
+                    "description": "Also search Saturdays and Sundays (optional, default false)"
+                }
+            },
+            "required": ["start_day", "end_day", "duration_minutes"]
+        }
+    },
+    {
+        "name": "structured_output",
+        "description": "Format the final response with separate reasoning and email response sections.",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "reasoning": {
+                    "type": "string",
+                    "description": "Your reasoning and thought process for how you approached this email request. This will not be sent to the user but will be logged for review."
+                },
+                "email_response": {
+                    "type": "string",
+                    "description": "The actual email response that will be sent to the user. This should be a complete email response without any meta-commentary about the email writing process."
+                }
+            },
+            "required": ["reasoning", "email_response"]
+        },
+        "cache_control": {"type": "ephemeral"}
+    }
+]
+
+# Static part of the system prompt. It must not contain per-user or per-day details,
+# otherwise the cached prefix changes on every request.
+SYSTEM_PROMPT = """
+You are a professional virtual assistant named Starla working on behalf of the user named at the end of these instructions (your principal). As your principal's dedicated secretary, your role is to:
+
+1. MANAGE CALENDAR: Create, update, and delete events on your principal's calendar. When scheduling events with other people, always add their email addresses as attendees so they receive calendar invitations.
+
+2. EMAIL COMMUNICATION: Draft responses to emails in a professional, friendly tone, clearly identifying yourself as your principal's assistant. Always sign emails as "Starla, Assistant to <principal's first name>" to make it clear you are not your principal.
+
+3. COMMUNICATION STYLE:
+- Use phrases like "On behalf of <principal>..." or "<principal> asked me to..."
+- Avoid any language that might suggest you are your principal
+- Be courteous, clear, and concise in all communications
+- Maintain a helpful, responsive tone
+- DO NOT include the subject in your response. It will be automatically handled by the email service.
+
+4. SCHEDULING PROTOCOL:
+- When scheduling meetings, always check your principal's calendar first: use the find_free_slots tool to find or suggest open times, and the get_events tool when you need to see the events themselves (for example to update or delete one)
+- For meetings with multiple participants, collect all attendee emails to send proper calendar invites
+- Always include relevant attendees when creating calendar events
+- If the user doesn't specify a location, use the default location "608 E 13th Ave, Denver, CO 80203"
+- If the user doesn't specify a time, suggest some times that work with your principal's schedule. ALWAYS use the find_free_slots tool (or get_events) before suggesting any times or using the add_event tool because otherwise you might accept or suggest a time that conflicts with another commitment.
+
+5. EMAIL ANALYSIS:
+- When presented with an email, determine if calendar actions are needed
+- Identify key information: requested meeting times, participants, topics
+- Send appropriate responses that address all points raised
+
+6. FORMAT OF RESPONSES:
+- Use plain text
+
+Remember that you represent your principal professionally but are not impersonating them. Your goal is to manage their schedule efficiently and communicate clearly as their designated assistant.
+
+IMPORTANT: When you are ready to generate your final response, please use the structured_output tool to provide:
+1. Your reasoning about the request (this will be logged but not sent to the user)
+2. The html email response (this will be sent directly to the user)
+
+Keep in mind that the email_response field should contain ONLY what will be sent to the user, with no meta-commentary about writing an email.
+"""
+
+# Appended to emails answered without calendar tools
+NO_CALENDAR_NOTE = """
+        The calendar tools are not available for this email. Reply without checking or changing the calendar, and do not suggest or confirm specific times.
+        """
+
+def process_with_ai(secretary_info, from_address, subject, body, task_id, task_writer=None, thread_context='', route='full', usage=None):
     """
     Process the email with AI and generate a response.
     Uses Claude to handle the request intelligently.
+    
+    If a TaskHistoryWriter is passed, the AI output and tool calls are added to it and the
+    caller flushes it; otherwise they are written to the task right away.
+    thread_context is the email thread's summary and recent messages (see thread_memory).
+    route 'reply' answers with SMALL_MODEL and no calendar tools (see email_router); anything
+    else runs the full tool loop. The Claude requests are recorded on usage (a UsageLedger), if given.
     """
     try:
         # Extract relevant info from secretary_info
@@ -38,8 +317,24 @@ def process_with_ai(secretary_info, from_address, subject, body, task_id):
         user_full_name = secretary_info.get('user_full_name', '')
         user_email = secretary_info.get('user_email', '')
         
-        # Initialize Claude client
-        client = anthropic.Anthropic(api_key=CLAUDE_API_KEY.value)
+        writer = task_writer or TaskHistoryWriter(task_id)
+        
+        # Near-identical emails to this secretary are answered from the response cache (opt-in)
+        cached, cache_probe = lookup_response(secretary_info, from_address, subject, body, thread_context)
+        if cached:
+            writer.update({'response_cache': {key: value for key, value in cached.items() if key not in ('email_response', 'reasoning')}})
+            writer.record_ai_output(cached['email_response'], cached['reasoning'])
+            if task_writer is None:
+                writer.flush()
+            return cached['email_response'], [f"Response cache {cached['kind']} hit (similarity {cached['similarity']})"]
+        
+        # Reuse the instance's Claude client
+        client = get_anthropic_client(CLAUDE_API_KEY.value)
+        ai_start = time.perf_counter()
+        tool_calls_before = len(writer.tool_calls)
+        
+        # Earlier messages in the thread, as a bounded summary plus recent turns
+        thread_section = f"CONVERSATION SO FAR:\n{thread_context}\n" if thread_context else ""
         
         # Format the email content including conversation history
         email_content = f"""
@@ -50,19 +345,30 @@ def process_with_ai(secretary_info, from_address, subject, body, task_id):
         You've received an email from: {from_address}
         Subject: {subject}
         
+        {thread_section}
         MOST RECENT EMAIL:
         {body}
         
         Please respond appropriately as the AI secretary, taking into account the full conversation context.
         """
         
+        ai_response = None
+        if route == 'reply':
+            try:
+                ai_response, logs = answer_without_tools(client, email_content, user_id, usage)
+            except Exception as e:
+                logging.error(f"Error answering with {SMALL_MODEL.value}, using the full tool loop: {str(e)}")
+        
         # Process with Claude
-        ai_response, logs = process_with_claude(
-            client=client,
-            email_content=email_content,
-            user_id=user_id,  # Pass the user_id here
-            max_tool_calls=MAX_TOOL_CALLS
-        )
+        if ai_response is None:
+            ai_response, logs = process_with_claude(
+                client=client,
+                email_content=email_content,
+                user_id=user_id,  # Pass the user_id here
+                max_tool_calls=MAX_TOOL_CALLS,
+                task_writer=writer,
+                usage=usage
+            )
         
         # Extract the email response from the structured output
         if isinstance(ai_response, dict):
@@ -73,12 +379,15 @@ def process_with_ai(secretary_info, from_address, subject, body, task_id):
             reasoning = "No structured reasoning provided."
             email_response = ai_response
         
+        # Cache completed answers; runs that changed the calendar are never replayed
+        if isinstance(ai_response, dict) and not reasoning.startswith(("Error in processing", "Reached maximum tool calls")):
+            mutated = any(call['name'] in MUTATING_TOOLS for call in writer.tool_calls[tool_calls_before:])
+            store_response(cache_probe, email_response, reasoning, (time.perf_counter() - ai_start) * 1000, mutated)
+        
         # Log the AI's response in the task history
-        db.collection('task_history').document(task_id).update({
-            'ai_response': email_response,
-            'ai_reasoning': reasoning,
-            'processed_at': firestore.SERVER_TIMESTAMP
-        })
+        writer.record_ai_output(email_response, reasoning)
+        if task_writer is None:
+            writer.flush()
         
         return email_response, logs
     
@@ -87,226 +396,394 @@ def process_with_ai(secretary_info, from_address, subject, body, task_id):
         # Return a generic error response and minimal logs
         return "I apologize, but I encountered an error processing your request. Please try again later.", [f"Error processing with AI: {str(e)}"]
 
-def process_with_claude(client, email_content, user_id, max_tool_calls=5):
-    """Process email content with Claude and return the response."""
-    logs = []  # Track execution
+def answer_without_tools(client, email_content, user_id, usage=None):
+    """
+    Answer an email with SMALL_MODEL in one request. Only the structured_output tool is
+    offered, and it is forced, so the reply comes back in the same shape as the tool loop's.
     
-    # Define the tools we'll provide to Claude
-    tools = [
-        {
-            "name": "add_event",
-            "description": "Add an event to the user's calendar. Use this when the user wants to schedule a meeting, call, appointment, or any event with a specific time.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "title": {
-                        "type": "string",
-                        "description": "The title or name of the event"
-                    },
-                    "description": {
-                        "type": "string",
-                        "description": "Details about the event (optional)"
-                    },
-                    "start_day": {
-                        "type": "string",
-                        "description": "Start day in MM/DD/YYYY format"
-                    },
-                    "end_day": {
-                        "type": "string",
-                        "description": "End day in MM/DD/YYYY format"
-                    },
-                    "start_time": {
-                        "type": "string",
-                        "description": "Start time in HH:MM AM/PM format"
-                    },
-                    "end_time": {
-                        "type": "string",
-                        "description": "End time in HH:MM AM/PM format"
-                    },
-                    "location": {
-                        "type": "string",
-                        "description": "Location of the event (optional)"
-                    },
-                    "attendees": {
-                        "type": "array",
-                        "items": {
-                            "type": "string"
-                        },
-                        "description": "List of email addresses for attendees (optional)"
-                    }
-                },
-                "required": ["title", "start_day", "end_day", "start_time", "end_time"]
-            }
-        },
-        {
-            "name": "get_events",
-            "description": "Get events from the user's calendar for a specific date range.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "start_day": {
-                        "type": "string",
-                        "description": "Start day in MM/DD/YYYY format"
-                    },
-                    "end_day": {
-                        "type": "string",
-                        "description": "End day in MM/DD/YYYY format"
-                    }
-                },
-                "required": ["start_day", "end_day"]
-            }
-        },
-        {
-            "name": "delete_event",
-            "description": "Delete an event from the user's calendar.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "event_id": {
-                        "type": "string",
-                        "description": "The unique ID of the event to delete"
-                    }
-                },
-                "required": ["event_id"]
-            }
-        },
+    The request is recorded on usage (a UsageLedger), if given.
+    
+    Returns:
+      tuple: ({"reasoning", "email_response"}, logs)
+    """
+    user_data = get_user_profile(user_id)
+    first_name = user_data.get('first_name', 'User') if user_data else 'User'
+    
+    with model_span(SMALL_MODEL.value, 'reply') as model_call:
+        response = client.messages.create(
+            model=SMALL_MODEL.value,
+            max_tokens=1000,
+            system=build_system_blocks(first_name),
+            messages=[{"role": "user", "content": email_content + NO_CALENDAR_NOTE}],
+            tools=[tool for tool in TOOLS if tool["name"] == "structured_output"],
+            tool_choice={"type": "tool", "name": "structured_output"}
+        )
+        record_model_usage(model_call, response.usage)
+    if usage is not None:
+        usage.record(SMALL_MODEL.value, response.usage, 'reply')
+    
+    for block in response.content:
+        if block.type == "tool_use" and block.name == "structured_output" and block.input.get("email_response"):
+            logs = [f"Answered with {SMALL_MODEL.value} without calendar tools"]
+            return {
+                "reasoning": block.input.get("reasoning", ""),
+                "email_response": block.input["email_response"]
+            }, logs
+    raise ValueError("No structured output in the response")
+
+def build_system_blocks(first_name):
+    """
+    Build the system parameter: the cached static prompt followed by the per-user context.
+    """
+    today = date.today().strftime('%B %d, %Y')
+    return [
         {
-            "name": "update_event",
-            "description": "Update an existing event in the user's calendar.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "event_id": {
-                        "type": "string",
-                        "description": "The unique ID of the event to update"
-                    },
-                    "title": {
-                        "type": "string",
-                        "description": "Updated title of the event (optional)"
-                    },
-                    "description": {
-                        "type": "string",
-                        "description": "Updated description (optional)"
-                    },
-                    "start_day": {
-                        "type": "string",
-                        "description": "Updated start day in MM/DD/YYYY format (optional)"
-                    },
-                    "end_day": {
-                        "type": "string",
-                        "description": "Updated end day in MM/DD/YYYY format (optional)"
-                    },
-                    "start_time": {
-                        "type": "string",
-                        "description": "Updated start time in HH:MM AM/PM format (optional)"
-                    },
-                    "end_time": {
-                        "type": "string",
-                        "description": "Updated end time in HH:MM AM/PM format (optional)"
-                    },
-                    "location": {
-                        "type": "string",
-                        "description": "Updated location (optional)"
-                    },
-                    "attendees": {
-                        "type": "array",
-                        "items": {
-                            "type": "string"
-                        },
-                        "description": "Updated list of attendee email addresses (optional)"
-                    }
-                },
-                "required": ["event_id"]
-            }
+            "type": "text",
+            "text": SYSTEM_PROMPT,
+            "cache_control": {"type": "ephemeral"}
         },
         {
-            "name": "structured_output",
-            "description": "Format the final response with separate reasoning and email response sections.",
-            "input_schema": {
-                "type": "object",
-                "properties": {
-                    "reasoning": {
-                        "type": "string",
-                        "description": "Your reasoning and thought process for how you approached this email request. This will not be sent to the user but will be logged for review."
-                    },
-                    "email_response": {
-                        "type": "string",
-                        "description": "The actual email response that will be sent to the user. This should be a complete email response without any meta-commentary about the email writing process."
-                    }
-                },
-                "required": ["reasoning", "email_response"]
-            }
+            "type": "text",
+            "text": f"Your principal is {first_name}. Sign emails as \"Starla, Assistant to {first_name}\". Today is {today}."
         }
     ]
+
+def mark_history_cacheable(messages, prefix_length=0):
+    """
+    Move the conversation cache breakpoint to the last block of the newest message,
+    so each tool-loop iteration reads everything sent before it from the cache.
     
-    # Rest of process_with_claude function remains the same
-    try:
-        # Add system context with current date
-        today_context = f"Today is {date.today().strftime('%B %d, %Y')}."
-        logs.append(f"Added system context with today's date: {date.today().strftime('%B %d, %Y')}")
-        # Get the user's first name from firestore
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            first_name = user_data.get('first_name', 'User')
+    prefix_length is the number of messages that came with the request (a chat's turns, or
+    the email). Once the tool loop has added turns, a second breakpoint stays on the last of
+    them, so that stable prefix is read from the cache however long the loop runs, and the next
+    chat request (the same turns plus one exchange) starts from it.
+    System, tools and these two make the API's limit of four breakpoints.
+    """
+    for message in messages:
+        if isinstance(message["content"], list):
+            for block in message["content"]:
+                block.pop("cache_control", None)
+    
+    breakpoints = [messages[-1]]
+    if 0 < prefix_length < len(messages):
+        breakpoints.append(messages[prefix_length - 1])
+    for message in breakpoints:
+        if isinstance(message["content"], str):
+            message["content"] = [{"type": "text", "text": message["content"]}]
+        message["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
+def build_conversation_messages(chat_messages):
+    """
+    Convert chat messages ([{"role": "user"|"assistant"|"system", "content": ...}]) into
+    Messages API turns. System messages are returned separately for the system parameter,
+    consecutive messages from the same role are merged, and the conversation always starts
+    with a user turn.
+    
+    Returns:
+      tuple: (system text, list of {"role", "content"} messages)
+    """
+    system_parts = []
+    messages = []
+    for message in chat_messages:
+        role = message.get("role", "user")
+        content = message.get("content", "")
+        if role == "system":
+            system_parts.append(str(content))
+            continue
+        if role != "assistant":
+            role = "user"
+        if isinstance(content, str):
+            if not content.strip():
+                continue
+            content = [{"type": "text", "text": content}]
+        if messages and messages[-1]["role"] == role:
+            messages[-1]["content"].extend(content)
         else:
-            first_name = 'User'
+            messages.append({"role": role, "content": list(content)})
+    
+    if messages and messages[0]["role"] == "assistant":
+        messages.insert(0, {"role": "user", "content": [{"type": "text", "text": "(Conversation started by the assistant.)"}]})
+    return "\n\n".join(system_parts), messages
 
-        system_prompt = system_prompt = f'''
-            You are a professional virtual assistant named Starla working on behalf of {first_name}. As {first_name}'s dedicated secretary, your role is to:
+def new_cache_usage():
+    """
+    Empty token totals for record_cache_usage.
+    """
+    return {
+        "requests": 0,
+        "cache_read_input_tokens": 0,
+        "cache_creation_input_tokens": 0,
+        "input_tokens": 0,
+        "output_tokens": 0
+    }
 
-            1. MANAGE CALENDAR: Create, update, and delete events on {first_name}'s calendar. When scheduling events with other people, always add their email addresses as attendees so they receive calendar invitations.
+def record_cache_usage(usage, cache_usage):
+    """
+    Add one response's prompt cache and output token counts to the running totals.
+    """
+    cache_usage["requests"] += 1
+    cache_usage["output_tokens"] += getattr(usage, "output_tokens", 0) or 0
+    cache_usage["cache_read_input_tokens"] += getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_usage["cache_creation_input_tokens"] += getattr(usage, "cache_creation_input_tokens", 0) or 0
+    cache_usage["input_tokens"] += getattr(usage, "input_tokens", 0) or 0
 
-            2. EMAIL COMMUNICATION: Draft responses to emails in a professional, friendly tone, clearly identifying yourself as {first_name}'s assistant. Always sign emails as "Starla, Assistant to {first_name}" to make it clear you are not {first_name} himself.
+class ToolLoopBudget:
+    """
+    Wall clock, tokens and requests of one tool loop, and why it ended.
 
-            3. COMMUNICATION STYLE:
-            - Use phrases like "On behalf of {first_name}..." or "{first_name} asked me to..."
-            - Avoid any language that might suggest you are {first_name}
-            - Be courteous, clear, and concise in all communications
-            - Maintain a helpful, responsive tone
-            - DO NOT include the subject in your response. It will be automatically handled by the email service. 
+    The next turn is assumed to take about as long and send about as many tokens as the
+    last one, so the answer is forced as soon as another free turn could run past a limit;
+    the loop then ends with a reply instead of the max_tool_calls apology.
+    """
 
-            4. SCHEDULING PROTOCOL:
-            - When scheduling meetings, always check {first_name}'s calendar first using the get_events tool
-            - For meetings with multiple participants, collect all attendee emails to send proper calendar invites
-            - Always include relevant attendees when creating calendar events
-            - If the user doesn't specify a location, use the default location "608 E 13th Ave, Denver, CO 80203"
-                - If the user doesn't specify a time, suggest some times that work with {first_name}'s schedule. ALWAYS use the get_events tool before suggesting any times or using the add_event tool because otherwise you might accept or suggest a time that conflicts with another commitment. 
+    def __init__(self, max_tool_calls):
+        self.max_tool_calls = max_tool_calls
+        self.max_seconds = TOOL_LOOP_MAX_SECONDS
+        self.max_tokens = TOOL_LOOP_MAX_TOKENS
+        self.started = time.perf_counter()
+        self.turn_started = None
+        self.last_turn_seconds = 0.0
+        self.requests = 0
+        self.tokens = 0
+        self.last_request_tokens = 0
+        self.memo_hits = 0  # Repeated tool calls answered from the memo
+        self.forced_by = None  # 'tool_calls', 'time' or 'tokens', once the answer is forced
+        self.termination = None  # Why the loop ended
 
-            5. EMAIL ANALYSIS:
-            - When presented with an email, determine if calendar actions are needed
-            - Identify key information: requested meeting times, participants, topics
-            - Send appropriate responses that address all points raised
+    def start_turn(self):
+        now = time.perf_counter()
+        if self.turn_started is not None:
+            self.last_turn_seconds = now - self.turn_started
+        self.turn_started = now
 
-            6. FORMAT OF RESPONSES:
-                - Use plain text
+    def record_request(self, usage):
+        tokens = sum(getattr(usage, field, 0) or 0 for field in (
+            "input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens", "output_tokens"
+        ))
+        self.requests += 1
+        self.tokens += tokens
+        self.last_request_tokens = tokens
 
-            Remember that you represent {first_name} professionally but are not impersonating him. Your goal is to manage his schedule efficiently and communicate clearly as his designated assistant.
-            '''
-        
-        # Add structured output instructions to system prompt
-        structured_output_instructions = """
-        IMPORTANT: When you are ready to generate your final response, please use the structured_output tool to provide:
-        1. Your reasoning about the request (this will be logged but not sent to the user)
-        2. The html email response (this will be sent directly to the user)
-        
-        Keep in mind that the email_response field should contain ONLY what will be sent to the user, with no meta-commentary about writing an email.
+    def limit_reached(self, tool_call_count):
+        """
+        The limit another free turn could run past, or None.
+        """
+        if tool_call_count + 1 >= self.max_tool_calls:
+            return "tool_calls"
+        if self.elapsed() + self.last_turn_seconds > self.max_seconds:
+            return "time"
+        if self.tokens + self.last_request_tokens > self.max_tokens:
+            return "tokens"
+        return None
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        The tool_loop record stored on the task.
         """
+        return {
+            "termination": self.termination,
+            "forced_by": self.forced_by,
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "elapsed_ms": round(self.elapsed() * 1000),
+            "memo_hits": self.memo_hits
+        }
+
+def tool_memo_key(tool_name, tool_input):
+    """
+    Key of a read-only tool call in the per-request memo, or None for calls that are never
+    answered from it (calendar changes).
+    """
+    if tool_name in MUTATING_TOOLS:
+        return None
+    return tool_name, json.dumps(tool_input, sort_keys=True, default=str)
+
+def update_tool_memo(tool_memo, calls, outcomes):
+    """
+    Remember a turn's successful read-only results. A successful calendar change, or one
+    whose outcome is unknown (timed out), clears the memo instead, since earlier reads (and
+    reads in the same turn) may be stale.
+    """
+    if any(isinstance(result, dict) and result.get("outcome") == "unknown" for result, _ in outcomes):
+        tool_memo.clear()
+        return
+    succeeded = [
+        (tool_name, tool_input, result)
+        for (tool_name, tool_input), (result, _) in zip(calls, outcomes)
+        if not (isinstance(result, dict) and "error" in result)
+    ]
+    if any(tool_name in MUTATING_TOOLS for tool_name, _, _ in succeeded):
+        tool_memo.clear()
+        return
+    for tool_name, tool_input, result in succeeded:
+        tool_memo[tool_memo_key(tool_name, tool_input)] = result
+
+def compact_tool_result(tool_name, result, seen_events, tool_result_usage):
+    """
+    Serialize a tool result for its tool_result block, compacted unless COMPACT_TOOL_RESULTS is off.
+    
+    Parameters:
+      tool_name (str): The tool that produced the result
+      result: The tool's return value
+      seen_events (dict): Event id -> compacted event already sent in this loop (updated here)
+      tool_result_usage (dict): Running byte counts (updated here)
+      
+    Returns:
+      str: the tool_result content
+    """
+    raw = json.dumps(result)
+    if COMPACT_TOOL_RESULTS.value:
+        content = json.dumps(_project_tool_result(tool_name, result, seen_events), separators=(",", ":"), ensure_ascii=False)
+    else:
+        content = raw
+    tool_result_usage["results"] += 1
+    tool_result_usage["raw_bytes"] += len(raw.encode("utf-8"))
+    tool_result_usage["bytes"] += len(content.encode("utf-8"))
+    tool_result_usage["tokens"] += estimate_tokens(content)
+    return content
+
+def _project_tool_result(tool_name, result, seen_events):
+    """
+    Keep the TOOL_RESULT_FIELDS of each event and replace get_events entries already sent unchanged.
+    """
+    fields = TOOL_RESULT_FIELDS.get(tool_name)
+    if fields is None or (isinstance(result, dict) and "error" in result):
+        return result
+    if isinstance(result, dict):
+        return _project_event(result, fields)
+    if not isinstance(result, list):
+        return result
+    
+    compacted = []
+    for event in result:
+        if not isinstance(event, dict):
+            compacted.append(event)
+            continue
+        projected = _project_event(event, fields)
+        event_id = event.get("id")
+        if tool_name == "get_events" and event_id:
+            if seen_events.get(event_id) == projected:
+                compacted.append({"id": event_id, "unchanged": True})
+                continue
+            seen_events[event_id] = projected
+        compacted.append(projected)
+    return compacted
+
+def _project_event(event, fields):
+    projected = {}
+    for field in fields:
+        value = event.get(field)
+        if value is None or value == "":
+            continue
+        if field == "description" and isinstance(value, str) and len(value) > TOOL_RESULT_DESCRIPTION_MAX_CHARS:
+            value = value[:TOOL_RESULT_DESCRIPTION_MAX_CHARS].rstrip() + "..."
+        projected[field] = value
+    return projected
+
+def process_with_claude(client, email_content, user_id, max_tool_calls=5, task_writer=None, usage=None):
+    """
+    Process email content with Claude and return the response.
+    email_content is either the prompt text or a list of chat messages (see build_conversation_messages).
+    """
+    for event in iter_claude_events(client, email_content, user_id, max_tool_calls=max_tool_calls, task_writer=task_writer, usage=usage):
+        if event["type"] == "result":
+            return event["result"], event["logs"]
+
+def iter_claude_events(client, email_content, user_id, max_tool_calls=5, stream=False, task_writer=None, usage=None):
+    """
+    Run the Claude tool loop as a generator of progress events.
+    
+    With stream=True the Anthropic streaming API is used and events are yielded as they arrive:
+      {"type": "text", "text": ...}          text deltas from Claude
+      {"type": "email_delta", "text": ...}   deltas of the structured_output email_response
+      {"type": "tool", "name": ..., "status": "running"|"done", "label": ...}
+    The last event is always {"type": "result", "result": ..., "logs": [...]}, where result is
+    what process_with_claude returns. Tool calls are recorded on task_writer, and each
+    Claude request on usage (a UsageLedger), if given.
+    
+    The loop runs on a ToolLoopBudget: repeated identical read-only tool calls are answered
+    from a per-request memo, the answer is forced once the budget is nearly spent, and the
+    reason the loop ended is logged and stored on the task as tool_loop.
+    """
+    logs = []  # Track execution
+    cache_usage = new_cache_usage()
+    tool_result_usage = {
+        "results": 0,
+        "raw_bytes": 0,  # Before compaction
+        "bytes": 0,  # As sent
+        "tokens": 0,  # Estimated, as sent
+        "resent_bytes": 0  # Tool result bytes already in the context of later requests
+    }
+    
+    budget = ToolLoopBudget(max_tool_calls)
+    
+    result = yield from _run_tool_loop(client, email_content, user_id, max_tool_calls, stream, logs, cache_usage, tool_result_usage, task_writer, usage, budget)
+    
+    logs.append(
+        f"Tool loop ended: {budget.termination} after {budget.requests} requests, {budget.tokens} tokens, "
+        f"{budget.elapsed():.1f}s ({budget.memo_hits} repeated tool calls answered from memo"
+        f"{f', answer forced by {budget.forced_by} budget' if budget.forced_by else ''})"
+    )
+    
+    logs.append(
+        f"Prompt cache usage over {cache_usage['requests']} requests: "
+        f"cache_read={cache_usage['cache_read_input_tokens']}, "
+        f"cache_creation={cache_usage['cache_creation_input_tokens']}, "
+        f"uncached_input={cache_usage['input_tokens']}, "
+        f"output={cache_usage['output_tokens']}"
+    )
+    logs.append(
+        f"Tool results: {tool_result_usage['results']} results, "
+        f"{tool_result_usage['raw_bytes']} -> {tool_result_usage['bytes']} bytes (~{tool_result_usage['tokens']} tokens), "
+        f"{tool_result_usage['resent_bytes']} bytes resent in later requests"
+    )
+    if task_writer is not None and tool_result_usage["results"]:
+        task_writer.update({"tool_result_usage": tool_result_usage})
+    if task_writer is not None:
+        task_writer.update({"tool_loop": budget.summary()})
+    yield {"type": "result", "result": result, "logs": logs}
+
+def _run_tool_loop(client, email_content, user_id, max_tool_calls, stream, logs, cache_usage, tool_result_usage, task_writer, usage, budget):
+    """
+    Body of iter_claude_events: yields progress events and returns the final result.
+    """
+    try:
+        # Get the user's first name from firestore
+        user_data = get_user_profile(user_id)
+        if user_data:
+            first_name = user_data.get('first_name', 'User')
+        else:
+            first_name = 'User'
         
-        # Create system message
-        system_message = system_prompt + today_context + structured_output_instructions
+        # Static prompt first (cached), per-user details in a small trailing block
+        system_message = build_system_blocks(first_name)
+        logs.append(f"Added system context with today's date: {date.today().strftime('%B %d, %Y')}")
         
-        # Start with just the initial user message
-        messages = [
-            {
-                "role": "user",
-                "content": email_content
-            }
-        ]
+        if isinstance(email_content, list):
+            # A chat: earlier turns are sent as real turns so they stay a cacheable prefix
+            conversation_system, messages = build_conversation_messages(email_content)
+            if conversation_system:
+                system_message.append({"type": "text", "text": conversation_system})
+            if not messages:
+                raise ValueError("No user or assistant messages to send")
+            logs.append(f"Conversation with {len(messages)} turns")
+        else:
+            # Start with just the initial user message
+            messages = [
+                {
+                    "role": "user",
+                    "content": email_content
+                }
+            ]
+        prefix_length = len(messages)  # Turns that came with the request
         
         # Track tool calls to prevent infinite loops
         tool_call_count = 0
+        seen_events = {}  # Events already sent in tool results, for compact_tool_result
+        tool_memo = {}  # Read-only tool call results of this request, by tool_memo_key
         
         # Variables to store structured output
         reasoning = ""
@@ -314,17 +791,30 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
         
         while tool_call_count < max_tool_calls:
             logs.append(f"Starting message iteration {tool_call_count + 1}")
+            mark_history_cacheable(messages, prefix_length)
+            tool_result_usage["resent_bytes"] += tool_result_usage["bytes"]
+            
+            # Once another free turn could run past the budget, ask for the answer now
+            budget.start_turn()
+            if budget.forced_by is None:
+                budget.forced_by = budget.limit_reached(tool_call_count)
+                if budget.forced_by:
+                    logs.append(f"Tool loop {budget.forced_by} budget nearly spent, forcing structured output")
             
             # Call Claude API with tools
             try:
-                response = client.messages.create(
-                    model=CLAUDE_MODEL.value,
-                    max_tokens=1000,
-                    system=system_message,
-                    messages=messages,
-                    tools=tools,
-                    tool_choice={"type": "auto"}
-                )
+                response = yield from _request_claude_turn(client, stream, {
+                    "model": CLAUDE_MODEL.value,
+                    "max_tokens": 1000,
+                    "system": system_message,
+                    "messages": messages,
+                    "tools": TOOLS,
+                    "tool_choice": {"type": "tool", "name": "structured_output"} if budget.forced_by else {"type": "auto"}
+                })
+                record_cache_usage(response.usage, cache_usage)
+                budget.record_request(response.usage)
+                if usage is not None:
+                    usage.record(CLAUDE_MODEL.value, response.usage, 'tool_loop')
                 
                 # Check if Claude wants to use a tool
                 if response.stop_reason == "tool_use":
@@ -334,6 +824,7 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
                     # Process each tool call
                     tool_results = []
                     assistant_content = []
+                    pending_calls = []  # (result position, tool_id, tool_name, tool_input)
                     
                     # First collect all content from the response
                     for content_block in response.content:
@@ -370,19 +861,46 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
                                 tool_results.append({
                                     "type": "tool_result",
                                     "tool_use_id": tool_id,
-                                    "content": json.dumps({"status": "success"})
+                                    "content": compact_tool_result(tool_name, {"status": "success"}, seen_events, tool_result_usage)
                                 })
                             else:
-                                # Execute regular tools
-                                result, tool_logs = handle_tool_call(user_id, tool_name, tool_input)
-                                logs.extend(tool_logs)
-                                
-                                # Add to tool results
-                                tool_results.append({
-                                    "type": "tool_result",
-                                    "tool_use_id": tool_id,
-                                    "content": json.dumps(result)
-                                })
+                                # Queue regular tools so all calls of this turn run together
+                                tool_results.append(None)
+                                pending_calls.append((len(tool_results) - 1, tool_id, tool_name, tool_input))
+                    
+                    # Execute the regular tools concurrently and fill in their results in order;
+                    # read-only calls this request already made are answered from the memo
+                    if pending_calls:
+                        for _, _, tool_name, _ in pending_calls:
+                            yield tool_progress_event(tool_name, "running")
+                        turn_start = time.perf_counter()
+                        outcomes = [None] * len(pending_calls)
+                        run_indexes = []
+                        for index, (_, _, tool_name, tool_input) in enumerate(pending_calls):
+                            memo_key = tool_memo_key(tool_name, tool_input)
+                            if memo_key in tool_memo:
+                                outcomes[index] = (tool_memo[memo_key], [f"Repeated {tool_name} call answered from memo"])
+                                budget.memo_hits += 1
+                            else:
+                                run_indexes.append(index)
+                        if run_indexes:
+                            run_calls = [(pending_calls[index][2], pending_calls[index][3]) for index in run_indexes]
+                            run_outcomes = execute_tool_calls(user_id, run_calls)
+                            for index, outcome in zip(run_indexes, run_outcomes):
+                                outcomes[index] = outcome
+                            update_tool_memo(tool_memo, run_calls, run_outcomes)
+                        turn_ms = (time.perf_counter() - turn_start) * 1000
+                        for _, _, tool_name, _ in pending_calls:
+                            yield tool_progress_event(tool_name, "done")
+                        for (position, tool_id, tool_name, tool_input), (result, tool_logs) in zip(pending_calls, outcomes):
+                            logs.extend(tool_logs)
+                            if task_writer is not None:
+                                task_writer.record_tool_call(tool_name, tool_input, result, turn_ms)
+                            tool_results[position] = {
+                                "type": "tool_result",
+                                "tool_use_id": tool_id,
+                                "content": compact_tool_result(tool_name, result, seen_events, tool_result_usage)
+                            }
                     
                     # Add the assistant's message to the conversation
                     messages.append({
@@ -400,6 +918,7 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
                     # If we've extracted the structured output, we can break out of the loop
                     if email_response:
                         logs.append("Structured output received, finishing process")
+                        budget.termination = "structured_output"
                         break
                     
                     # Otherwise continue the conversation
@@ -415,13 +934,15 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
                     formatted_response = format_email_response(raw_response)
                     
                     logs.append(f"Final response generated and formatted")
-                    return formatted_response, logs
+                    budget.termination = "text_response"
+                    return formatted_response
                 
             except Exception as e:
                 error_msg = f"API error: {str(e)}"
                 logs.append(error_msg)
                 logging.error(error_msg)
-                return f"I encountered an error processing this email: {str(e)}", logs
+                budget.termination = "api_error"
+                return f"I encountered an error processing this email: {str(e)}"
         
         # If we have the email response, return it along with logs
         if email_response:
@@ -435,25 +956,257 @@ def process_with_claude(client, email_content, user_id, max_tool_calls=5):
                 "email_response": email_response
             }
             
-            return result, logs
+            return result
         
         # If we exceeded max tool calls without getting structured output
+        budget.termination = "max_tool_calls"
         return {
             "reasoning": "Reached maximum tool calls without receiving structured output.",
             "email_response": "I'm sorry, but I was unable to complete this task due to technical limitations. Please try again later."
-        }, logs
+        }
     
     except Exception as e:
         error_msg = f"Error in Claude processing: {e}"
         logging.error(error_msg)
         logs.append(error_msg)
+        budget.termination = "error"
         return {
             "reasoning": f"Error in processing: {str(e)}",
             "email_response": "I apologize, but I encountered an error processing your request. Please try again later."
-        }, logs
+        }
+
+def _request_claude_turn(client, stream, request):
+    """
+    Send one Messages API request and return the final Message.
+    When streaming, text and structured_output email deltas are yielded while the response arrives.
+    """
+    with model_span(request["model"], "tool_loop") as model_call:
+        if not stream:
+            response = client.messages.create(**request)
+            record_model_usage(model_call, response.usage)
+            return response
+        
+        current_tool = None
+        streamed_email = ""
+        with client.messages.stream(**request) as message_stream:
+            for event in message_stream:
+                if event.type == "text":
+                    yield {"type": "text", "text": event.text}
+                elif event.type == "content_block_start":
+                    current_tool = event.content_block.name if event.content_block.type == "tool_use" else None
+                elif event.type == "input_json" and current_tool == "structured_output":
+                    # The snapshot is the partially parsed tool input; forward the new part of the email
+                    snapshot = event.snapshot if isinstance(event.snapshot, dict) else {}
+                    email_text = snapshot.get("email_response") or ""
+                    if len(email_text) > len(streamed_email) and email_text.startswith(streamed_email):
+                        yield {"type": "email_delta", "text": email_text[len(streamed_email):]}
+                        streamed_email = email_text
+            response = message_stream.get_final_message()
+            record_model_usage(model_call, response.usage)
+            return response
+
+def tool_progress_event(tool_name, status):
+    """
+    Build a progress event for a tool call, with a label the chat UI can show.
+    """
+    return {
+        "type": "tool",
+        "name": tool_name,
+        "status": status,
+        "label": TOOL_PROGRESS_LABELS.get(tool_name, "Working")
+    }
+
+def execute_tool_calls(user_id, calls, max_parallel=MAX_PARALLEL_TOOL_CALLS, timeout=TOOL_CALL_TIMEOUT_SECONDS):
+    """
+    Run all tool calls of one Claude turn concurrently. When the turn has more than one
+    calendar mutation, they are sent together as Google batch requests (see handle_mutation_batch).
+    
+    Parameters:
+      user_id (str): The Firebase user ID the tools act for
+      calls (list): (tool_name, tool_input) pairs in the order Claude requested them
+      max_parallel (int): Maximum number of calls of this request running at once
+      timeout (int): Seconds each call may take before it is reported as timed out
+      
+    A call that times out keeps its executor thread until it returns. While too many of
+    them are still running (HUNG_TOOL_CALLS_MAX, or HUNG_TOOL_CALLS_MAX_PER_USER for this
+    user), new calls are reported as not run instead of waiting for a thread.
+      
+    Returns:
+      list: (result, logs) pairs in the same order as calls
+    """
+    with _hung_tool_calls_lock:
+        hung_total = sum(_hung_tool_calls.values())
+        hung_for_user = _hung_tool_calls.get(user_id, 0)
+    if hung_total >= HUNG_TOOL_CALLS_MAX or hung_for_user >= HUNG_TOOL_CALLS_MAX_PER_USER:
+        error_msg = f"Tool calls not run: {hung_for_user} of this user's and {hung_total} in all earlier calls are still hanging"
+        logging.error(error_msg)
+        return [
+            ({"error": f"{tool_name} was not run (earlier calls are still not responding); it is safe to retry later"}, [error_msg])
+            for tool_name, _ in calls
+        ]
+    
+    # Group the calls: with several mutations they all share one batched group; otherwise
+    # mutations of the same event share a group and run in order. Everything else (reads,
+    # a single new event) gets a group of its own. Groups are (batched, indexes, waves).
+    mutation_indexes = [
+        index for index, (tool_name, tool_input) in enumerate(calls)
+        if tool_name in MUTATING_TOOLS and isinstance(tool_input, dict)
+    ]
+    batch_mutations = len(mutation_indexes) > 1
+    groups = []
+    event_groups = {}
+    for index, (tool_name, tool_input) in enumerate(calls):
+        event_id = tool_input.get("event_id") if isinstance(tool_input, dict) else None
+        if batch_mutations and index in mutation_indexes:
+            continue
+        if tool_name in MUTATING_TOOLS and event_id:
+            if event_id not in event_groups:
+                event_groups[event_id] = []
+                groups.append((False, event_groups[event_id], 0))
+            event_groups[event_id].append(index)
+        else:
+            groups.append((False, [index], 0))
+    if batch_mutations:
+        # Same-event mutations go out in successive batches
+        event_counts = {}
+        for index in mutation_indexes:
+            event_id = calls[index][1].get("event_id")
+            if event_id:
+                event_counts[event_id] = event_counts.get(event_id, 0) + 1
+        groups.append((True, mutation_indexes, max(event_counts.values(), default=1)))
+    
+    outcomes = [None] * len(calls)
+    
+    request_slots = threading.Semaphore(max_parallel)
+    # A group's timeout starts when it holds a slot; a group given up while still waiting never runs
+    started = [threading.Event() for _ in groups]
+    started_at = [None] * len(groups)
+    abandoned = [False] * len(groups)
+    finished = [False] * len(groups)
+    hung = [False] * len(groups)  # Timed out while still running; counted in _hung_tool_calls
+    state_lock = threading.Lock()
+    
+    def run_group(group_index, batched, indexes):
+        with request_slots:
+            with state_lock:
+                if abandoned[group_index]:
+                    return None
+                started_at[group_index] = time.monotonic()
+                started[group_index].set()
+            try:
+                if batched:
+                    return handle_mutation_batch(user_id, [calls[index] for index in indexes])
+                group_outcomes = []
+                for index in indexes:
+                    tool_name, tool_input = calls[index]
+                    group_outcomes.append(handle_tool_call(user_id, tool_name, tool_input))
+                return group_outcomes
+            finally:
+                with state_lock:
+                    finished[group_index] = True
+                    if hung[group_index]:
+                        _count_hung_tool_call(user_id, -1)
     
+    futures = []
+    for group_index, (batched, indexes, waves) in enumerate(groups):
+        group_timeout = timeout * (waves if batched else len(indexes))
+        futures.append((group_index, indexes, group_timeout, _tool_executor.submit(bind_context(run_group), group_index, batched, indexes)))
+    # Waiting for a slot is bounded by every group running to its own timeout
+    queue_deadline = time.monotonic() + sum(group_timeout for _, _, group_timeout, _ in futures)
+    
+    for group_index, indexes, group_timeout, future in futures:
+        try:
+            if not started[group_index].wait(timeout=max(0, queue_deadline - time.monotonic())):
+                with state_lock:
+                    abandoned[group_index] = started_at[group_index] is None
+            if abandoned[group_index]:
+                for index in indexes:
+                    tool_name = calls[index][0]
+                    error_msg = f"Tool call {tool_name} was not run: no free slot before the deadline"
+                    logging.error(error_msg)
+                    outcomes[index] = ({"error": f"{tool_name} was not run (too many calls at once); it is safe to retry"}, [error_msg])
+                continue
+            deadline = started_at[group_index] + group_timeout
+            group_outcomes = future.result(timeout=max(0, deadline - time.monotonic()))
+            for index, outcome in zip(indexes, group_outcomes):
+                outcomes[index] = outcome
+        except FutureTimeoutError:
+            with state_lock:
+                if not finished[group_index]:
+                    hung[group_index] = True
+                    _count_hung_tool_call(user_id, 1)
+            for index in indexes:
+                outcomes[index] = timed_out_tool_call(calls[index][0], timeout)
+        except Exception as e:
+            for index in indexes:
+                error_msg = f"Error in tool call handling: {e}"
+                logging.error(error_msg)
+                outcomes[index] = ({"error": f"Error in tool call handling: {str(e)}"}, [error_msg])
+    
+    return outcomes
+
+def _count_hung_tool_call(user_id, change):
+    with _hung_tool_calls_lock:
+        count = _hung_tool_calls.get(user_id, 0) + change
+        if count > 0:
+            _hung_tool_calls[user_id] = count
+        else:
+            _hung_tool_calls.pop(user_id, None)
+
+def timed_out_tool_call(tool_name, timeout):
+    """
+    Outcome of a tool call that ran past its timeout. The call keeps running in its thread,
+    so a calendar change may still be applied: Claude is told the outcome is unknown rather
+    than that it failed, so it checks instead of retrying into a duplicate.
+    
+    Returns:
+      tuple: (result, logs)
+    """
+    error_msg = f"Tool call {tool_name} timed out after {timeout} seconds"
+    logging.error(error_msg)
+    if tool_name in MUTATING_TOOLS:
+        from tools import unknown_mutation_result
+        return unknown_mutation_result(tool_name, f"is still in progress after {timeout} seconds"), [error_msg]
+    return {"error": f"{tool_name} timed out"}, [error_msg]
+
+def handle_mutation_batch(user_id, calls):
+    """
+    Run a turn's calendar mutations (add_event, update_event, delete_event) through Google
+    batch requests instead of one HTTP request each. A failing batch request is reported
+    per call by execute_event_mutations; errors caught here happen before anything is sent.
+    
+    Returns:
+      list: (result, logs) pairs in the same order as calls
+    """
+    from tools import execute_event_mutations
+    try:
+        with span("tool_call.batch", {"tool.calls": len(calls)}):
+            results = execute_event_mutations(user_id, calls)
+    except Exception as e:
+        error_msg = f"Error in batched calendar mutations: {str(e)}"
+        logging.error(error_msg)
+        return [({"error": f"Failed to {tool_name.replace('_', ' ')}: {str(e)}"}, [error_msg]) for tool_name, _ in calls]
+    
+    outcomes = []
+    for (tool_name, tool_input), result in zip(calls, results):
+        logs = [f"Handling tool call: {tool_name} with arguments: {tool_input} (batched)"]
+        if isinstance(result, dict) and "error" in result:
+            logs.append(f"Error in {tool_name}: {result['error']}")
+        else:
+            logs.append(f"{tool_name} succeeded: {json.dumps(result)}")
+        outcomes.append((result, logs))
+    return outcomes
+
 def handle_tool_call(user_id, function_name, arguments):
-    """Handle individual tool calls and return the appropriate response."""
+    """Handle individual tool calls and return the appropriate response, inside a tool_call span."""
+    with span("tool_call", {"tool.name": function_name}) as tool_span:
+        result, logs = _dispatch_tool_call(user_id, function_name, arguments)
+        if isinstance(result, dict) and "error" in result:
+            tool_span.set_attribute("tool.error", str(result["error"]))
+        return result, logs
+
+def _dispatch_tool_call(user_id, function_name, arguments):
+    """Run the tool function for a tool call."""
     logs = []  # Track execution
     try:
         log_msg = f"Handling tool call: {function_name} with arguments: {arguments}"
@@ -461,7 +1214,7 @@ def handle_tool_call(user_id, function_name, arguments):
         logs.append(log_msg)
         # Import tools only when needed to avoid circular imports
         import sys
-        from tools import add_event, get_events, delete_event, update_event
+        from tools import add_event, get_events, delete_event, update_event, find_free_slots
         if function_name == "add_event":
             try:
                 result = add_event(
@@ -532,6 +1285,25 @@ def handle_tool_call(user_id, function_name, arguments):
                 logging.error(error_msg)
                 logs.append(error_msg)
                 return {"error": f"Failed to update event: {str(e)}"}, logs
+        elif function_name == "find_free_slots":
+            try:
+                result = find_free_slots(
+                    user_id=user_id,
+                    start_day=arguments["start_day"],
+                    end_day=arguments["end_day"],
+                    duration_minutes=arguments["duration_minutes"],
+                    working_hours_start=arguments.get("working_hours_start") or "09:00 AM",
+                    working_hours_end=arguments.get("working_hours_end") or "05:00 PM",
+                    attendees=arguments.get("attendees", None),
+                    include_weekends=arguments.get("include_weekends", False)
+                )
+                logs.append(f"Found free slots successfully: {json.dumps(result)}")
+                return result, logs
+            except Exception as e:
+                error_msg = f"Error in find_free_slots: {str(e)}"
+                logging.error(error_msg)
+                logs.append(error_msg)
+                return {"error": f"Failed to find free slots: {str(e)}"}, logs
         else:
             error_msg = f"Unknown function call: {function_name}"
             logging.warning(error_msg)
@@ -0,0 +1,447 @@
+import bisect
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import pytz
+from clients import get_db
+from tracing import firestore_span
+
+CALENDAR_TIMEZONE = 'America/New_York'
+
+# Calendar index settings
+CALENDAR_INDEX_TTL_SECONDS = 60  # Served from memory for this long, then refreshed with an incremental sync
+CALENDAR_INDEX_PAST_DAYS = 30  # Days before the full sync covered by the index
+CALENDAR_INDEX_FUTURE_DAYS = 365  # Days after the full sync covered by the index
+CALENDAR_INDEX_RESYNC_MARGIN_DAYS = 30  # Full sync again once the covered window ends this close to today
+CALENDAR_INDEX_MAX_USERS = 100  # Indexes kept in memory per instance
+CALENDAR_INDEX_PERSIST_MAX_EVENTS = 2000  # Larger indexes are persisted cut to a shorter window
+CALENDAR_INDEX_PERSIST_MAX_BYTES = 900 * 1024  # Same for serialized events over this size (Firestore documents are capped at 1 MiB)
+CALENDAR_INDEX_PERSIST_PAST_DAYS = 1  # Days before now kept when a large index is cut
+CALENDAR_SYNC_PAGE_SIZE = 2500  # Maximum events per Calendar list page
+CALENDAR_INDEX_FORMAT = 2  # Persisted indexes of another format are ignored (2: events keep 'transparency')
+
+# Indexes keyed by user_id, oldest first
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+INDEX_STATS = {
+    'hits': 0,
+    'fallbacks': 0,
+    'full_syncs': 0,
+    'incremental_syncs': 0,
+    'events_synced': 0
+}
+
+class CalendarIndex:
+    """
+    A user's primary calendar events over a time window, sorted by start time.
+    Overlap queries bisect on start time; events starting more than the longest event
+    duration before the query can't overlap it, so only that slice is scanned.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.events = {}  # event_id -> (sort key, simplified event)
+        self.starts = []  # Sorted (start_ts, end_ts, event_id)
+        self.max_duration = 0
+        self.sync_token = None
+        self.window_start = 0
+        self.window_end = 0
+        self.synced_at = None  # time.monotonic() of the last sync
+        self.syncing = False  # A sync is fetching from Google (outside the lock)
+        self.changes_during_sync = []  # ('put', event) / ('remove', event_id) recorded while syncing
+        self.version = 0  # Bumped on every change
+        self.generation = uuid.uuid4().hex  # Tells versions of a reloaded index apart
+        self.lock = threading.Lock()
+
+    def put(self, event):
+        """
+        Add or replace a Calendar API event (cancelled events are removed).
+        """
+        event_id = event.get('id')
+        if not event_id:
+            return
+        if event.get('status') == 'cancelled':
+            self.remove(event_id)
+            return
+        self.insert(simplify_event(event))
+
+    def insert(self, simplified):
+        """
+        Add or replace an event already in get_events form.
+        """
+        event_id = simplified['id']
+        start_ts, end_ts = event_interval(simplified)
+        if start_ts is None:
+            return
+
+        self.remove(event_id)
+        key = (start_ts, end_ts, event_id)
+        bisect.insort(self.starts, key)
+        self.events[event_id] = (key, simplified)
+        self.max_duration = max(self.max_duration, end_ts - start_ts)
+        self.version += 1
+
+    def remove(self, event_id):
+        entry = self.events.pop(event_id, None)
+        if entry is None:
+            return
+        position = bisect.bisect_left(self.starts, entry[0])
+        if position < len(self.starts) and self.starts[position] == entry[0]:
+            del self.starts[position]
+        self.version += 1
+
+    def covers(self, start_ts, end_ts):
+        return self.sync_token is not None and self.window_start <= start_ts and end_ts <= self.window_end
+
+    def query(self, start_ts, end_ts):
+        """
+        Returns the simplified events overlapping [start_ts, end_ts], ordered by start time.
+        """
+        first = bisect.bisect_left(self.starts, (start_ts - self.max_duration,))
+        last = bisect.bisect_left(self.starts, (end_ts,))
+        return [
+            dict(self.events[event_id][1])
+            for event_start, event_end, event_id in self.starts[first:last]
+            if event_end > start_ts
+        ]
+
+    def to_dict(self, max_events=None, max_bytes=None):
+        """
+        The persisted form. With more than max_events events, or events over max_bytes once
+        serialized (descriptions can be long), only the events from
+        CALENDAR_INDEX_PERSIST_PAST_DAYS ago on are kept, as many as fit in start order, and
+        the window is narrowed to what they cover.
+        """
+        window_start, window_end = self.window_start, self.window_end
+        sizes = {event_id: _serialized_size(entry[1]) for event_id, entry in self.events.items()}
+        fits = (
+            (max_events is None or len(self.events) <= max_events)
+            and (max_bytes is None or sum(sizes.values()) <= max_bytes)
+        )
+        if fits:
+            events = [entry[1] for entry in self.events.values()]
+        else:
+            window_start = max(window_start, time.time() - CALENDAR_INDEX_PERSIST_PAST_DAYS * 86400)
+            kept = [key for key in self.starts if key[1] > window_start]
+            total = 0
+            for position, key in enumerate(kept):
+                total += sizes[key[2]]
+                if (max_events is not None and position >= max_events) or (max_bytes is not None and total > max_bytes):
+                    # Every event overlapping [window_start, window_end) starts before the first one cut
+                    window_end = min(window_end, key[0])
+                    kept = kept[:position]
+                    break
+            events = [self.events[event_id][1] for _, _, event_id in kept]
+        return {
+            'format': CALENDAR_INDEX_FORMAT,
+            'sync_token': self.sync_token,
+            'window_start': window_start,
+            'window_end': window_end,
+            'events': events
+        }
+
+    @classmethod
+    def from_dict(cls, user_id, data):
+        index = cls(user_id)
+        for event in data.get('events', []):
+            index.insert(event)
+        index.sync_token = data.get('sync_token')
+        index.window_start = data.get('window_start', 0)
+        index.window_end = data.get('window_end', 0)
+        return index
+
+def simplify_event(event):
+    """
+    The event fields returned by get_events. 'transparency' is only set for events shown as
+    free, which find_free_slots doesn't count as busy.
+    """
+    start = event.get('start', {})
+    end = event.get('end', {})
+    simplified = {
+        'id': event.get('id'),
+        'summary': event.get('summary', 'No Title'),
+        'start': start.get('dateTime', start.get('date')),
+        'end': end.get('dateTime', end.get('date')),
+        'location': event.get('location', ''),
+        'description': event.get('description', '')
+    }
+    if event.get('transparency') == 'transparent':
+        simplified['transparency'] = 'transparent'
+    return simplified
+
+def _serialized_size(simplified):
+    return len(json.dumps(simplified, ensure_ascii=False).encode('utf-8'))
+
+def parse_event_time(value):
+    """
+    Timestamp for an event start/end: an RFC 3339 dateTime, or an all-day date
+    (midnight in CALENDAR_TIMEZONE).
+    """
+    if not value:
+        return None
+    if len(value) == 10:
+        day = datetime.strptime(value, '%Y-%m-%d')
+        return pytz.timezone(CALENDAR_TIMEZONE).localize(day).timestamp()
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+def event_interval(simplified):
+    start_ts = parse_event_time(simplified.get('start'))
+    end_ts = parse_event_time(simplified.get('end'))
+    if start_ts is None:
+        return None, None
+    return start_ts, max(end_ts if end_ts is not None else start_ts, start_ts)
+
+def get_indexed_events(user_id, start_dt, end_dt):
+    """
+    Events overlapping [start_dt, end_dt] from the user's calendar index, syncing it first
+    if it is older than CALENDAR_INDEX_TTL_SECONDS.
+
+    Returns:
+      list or None: simplified events ordered by start, or None if the range isn't covered
+                    by the index (the caller should ask Google directly)
+    """
+    start_ts, end_ts = start_dt.timestamp(), end_dt.timestamp()
+    index = sync_calendar_index(user_id)
+    with index.lock:
+        if not index.covers(start_ts, end_ts):
+            INDEX_STATS['fallbacks'] += 1
+            return None
+        INDEX_STATS['hits'] += 1
+        return index.query(start_ts, end_ts)
+
+def sync_calendar_index(user_id, force=False):
+    """
+    Bring the user's index up to date: an incremental sync with the stored syncToken, or a
+    full sync of the window when there is no token, it expired (410 Gone), or the window is
+    running out.
+
+    Google is called without holding index.lock, and only one thread syncs an index at a
+    time; the others get the index as it is meanwhile (a cold one covers nothing, so they
+    query Google directly). Changes recorded during the sync are applied again on top of
+    its result.
+
+    Returns:
+      CalendarIndex: the user's index
+    """
+    index = _get_index(user_id)
+    with index.lock:
+        fresh = index.synced_at is not None and time.monotonic() - index.synced_at < CALENDAR_INDEX_TTL_SECONDS
+        if (fresh and not force) or index.syncing:
+            return index
+        index.syncing = True
+        index.changes_during_sync = []
+        sync_token = index.sync_token
+        window_running_out = index.window_end - time.time() < CALENDAR_INDEX_RESYNC_MARGIN_DAYS * 86400
+
+    try:
+        changes = None
+        if sync_token and not window_running_out:
+            try:
+                changes = _list_all_pages(user_id, syncToken=sync_token)
+            except Exception as e:
+                if getattr(getattr(e, 'resp', None), 'status', None) != 410:
+                    raise
+                print(f"Calendar sync token expired for {user_id}, running a full sync")
+        synced = _full_sync(user_id) if changes is None else None
+
+        with index.lock:
+            if synced is not None:
+                _swap_in(index, synced)
+                changed = True
+            else:
+                changed = _apply_incremental(index, *changes)
+            for action, value in index.changes_during_sync:
+                if action == 'put':
+                    index.put(value)
+                else:
+                    index.remove(value)
+            index.synced_at = time.monotonic()
+            data = index.to_dict(CALENDAR_INDEX_PERSIST_MAX_EVENTS, CALENDAR_INDEX_PERSIST_MAX_BYTES) if changed else None
+    finally:
+        with index.lock:
+            index.syncing = False
+            index.changes_during_sync = []
+
+    if data is not None:
+        _persist_index(user_id, data)
+    return index
+
+def calendar_version(user_id, max_age=CALENDAR_INDEX_TTL_SECONDS):
+    """
+    An identifier of the user's calendar state as of the in-memory index's last sync; it
+    changes whenever an event does. Never syncs or reads Firestore.
+    
+    Parameters:
+      max_age (float): seconds since the last sync after which the version isn't trusted
+
+    Returns:
+      str or None: the version, or None if the index isn't in memory or wasn't synced within max_age
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+    if index is None:
+        return None
+    with index.lock:
+        if index.synced_at is None or time.monotonic() - index.synced_at >= max_age:
+            return None
+        return f"{index.generation}:{index.version}"
+
+def record_event_change(user_id, event):
+    """
+    Apply an event the assistant just created or updated to the in-memory index, so it is
+    visible before the next sync (which will return the same change again, harmlessly).
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+    if index is None or not event:
+        return
+    with index.lock:
+        index.put(event)
+        if index.syncing:
+            index.changes_during_sync.append(('put', event))
+
+def record_event_deleted(user_id, event_id):
+    """
+    Remove an event the assistant just deleted from the in-memory index.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+    if index is None:
+        return
+    with index.lock:
+        index.remove(event_id)
+        if index.syncing:
+            index.changes_during_sync.append(('remove', event_id))
+
+def evict_calendar_index(user_id):
+    """
+    Drop a user's in-memory index, e.g. after they reconnect their calendar.
+    """
+    with _indexes_lock:
+        _indexes.pop(user_id, None)
+
+def _get_index(user_id):
+    """
+    The user's in-memory index, loaded from Firestore (or created empty) on first use.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is not None:
+            _indexes.move_to_end(user_id)
+            return index
+
+    index = _load_index(user_id) or CalendarIndex(user_id)
+    with _indexes_lock:
+        # Another thread may have created it meanwhile
+        index = _indexes.setdefault(user_id, index)
+        _indexes.move_to_end(user_id)
+        while len(_indexes) > CALENDAR_INDEX_MAX_USERS:
+            _indexes.popitem(last=False)
+    return index
+
+def _list_all_pages(user_id, **params):
+    """
+    Run events().list over every page.
+
+    Returns:
+      tuple: (items, nextSyncToken)
+    """
+    from tools import get_calendar_service
+    service = get_calendar_service(user_id)
+    items = []
+    page_token = None
+    while True:
+        result = service.events().list(
+            calendarId='primary',
+            singleEvents=True,
+            maxResults=CALENDAR_SYNC_PAGE_SIZE,
+            pageToken=page_token,
+            **params
+        ).execute()
+        items.extend(result.get('items', []))
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return items, result.get('nextSyncToken')
+
+def _full_sync(user_id):
+    """
+    Fetch the whole window into a new index, without touching the user's current one.
+    """
+    tz = pytz.timezone(CALENDAR_TIMEZONE)
+    now = datetime.now(tz)
+    window_start = now - timedelta(days=CALENDAR_INDEX_PAST_DAYS)
+    window_end = now + timedelta(days=CALENDAR_INDEX_FUTURE_DAYS)
+    items, sync_token = _list_all_pages(
+        user_id,
+        timeMin=window_start.isoformat(),
+        timeMax=window_end.isoformat()
+    )
+
+    synced = CalendarIndex(user_id)
+    for event in items:
+        synced.put(event)
+    synced.sync_token = sync_token
+    synced.window_start = window_start.timestamp()
+    synced.window_end = window_end.timestamp()
+    INDEX_STATS['full_syncs'] += 1
+    INDEX_STATS['events_synced'] += len(items)
+    print(f"Full calendar sync for {user_id}: {len(items)} events")
+    return synced
+
+def _swap_in(index, synced):
+    """
+    Replace the index's contents with a full sync's (called with index.lock held).
+    """
+    index.events = synced.events
+    index.starts = synced.starts
+    index.max_duration = synced.max_duration
+    index.sync_token = synced.sync_token
+    index.window_start = synced.window_start
+    index.window_end = synced.window_end
+    index.version += 1
+
+def _apply_incremental(index, items, sync_token):
+    """
+    Apply the changes fetched with the index's syncToken (called with index.lock held).
+
+    Returns:
+      bool: whether anything changed
+    """
+    for event in items:
+        index.put(event)
+    changed = bool(items) or sync_token != index.sync_token
+    index.sync_token = sync_token or index.sync_token
+    INDEX_STATS['incremental_syncs'] += 1
+    INDEX_STATS['events_synced'] += len(items)
+    return changed
+
+def _load_index(user_id):
+    """
+    Read a persisted index so a new instance starts with an incremental sync.
+    """
+    try:
+        with firestore_span('get', 'calendar_index'):
+            snapshot = get_db().collection('calendar_index').document(user_id).get()
+        if snapshot.exists:
+            data = snapshot.to_dict()
+            if data.get('format') == CALENDAR_INDEX_FORMAT:
+                return CalendarIndex.from_dict(user_id, data)
+            print(f"Calendar index for {user_id} has an old format, running a full sync")
+    except Exception as e:
+        print(f"Error loading calendar index for {user_id}: {e}")
+    return None
+
+def _persist_index(user_id, data):
+    try:
+        from firebase_admin import firestore
+        data['updated_at'] = firestore.SERVER_TIMESTAMP
+        with firestore_span('set', 'calendar_index'):
+            get_db().collection('calendar_index').document(user_id).set(data)
+    except Exception as e:
+        # New instances fall back to a full sync until a save succeeds
+        logging.error(f"Error saving calendar index for {user_id} ({len(data['events'])} events): {e}")
@@ -0,0 +1,102 @@
+import threading
+
+# Everything heavy (firebase_admin, anthropic, httpx) is imported on first use, so a cold
+# start only pays for the clients the invoked function actually needs.
+
+FIREBASE_CREDENTIALS_FILE = "starlis_admin_creds.json"
+
+# Connection pool settings shared by all API clients on this instance
+CLIENT_MAX_CONNECTIONS = 20  # Maximum open connections per client
+CLIENT_MAX_KEEPALIVE_CONNECTIONS = 10  # Idle connections kept open for reuse
+CLIENT_KEEPALIVE_EXPIRY_SECONDS = 60  # How long an idle connection is kept
+CLIENT_CONNECT_TIMEOUT_SECONDS = 10
+CLIENT_READ_TIMEOUT_SECONDS = 120  # Tool-loop turns can take a while to generate
+
+SENDGRID_BASE_URL = "https://api.sendgrid.com"
+
+# One client per API key, built on first use and reused across invocations
+_anthropic_clients = {}
+_sendgrid_clients = {}
+_clients_lock = threading.Lock()
+_db = None
+
+def initialize_firebase():
+    """Initialize Firebase Admin SDK if not already initialized."""
+    import firebase_admin
+    from firebase_admin import credentials
+    try:
+        # Check if app is already initialized
+        firebase_admin.get_app()
+    except ValueError:
+        with _clients_lock:
+            try:
+                firebase_admin.get_app()
+            except ValueError:
+                cred = credentials.Certificate(FIREBASE_CREDENTIALS_FILE)
+                firebase_admin.initialize_app(cred)
+
+def get_db():
+    """
+    Returns the shared Firestore client, initializing Firebase on first use.
+    """
+    global _db
+    if _db is None:
+        initialize_firebase()
+        from firebase_admin import firestore
+        with _clients_lock:
+            if _db is None:
+                _db = firestore.client()
+    return _db
+
+def _pool_limits():
+    import httpx
+    return httpx.Limits(
+        max_connections=CLIENT_MAX_CONNECTIONS,
+        max_keepalive_connections=CLIENT_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY_SECONDS
+    )
+
+def _timeout():
+    import httpx
+    return httpx.Timeout(CLIENT_READ_TIMEOUT_SECONDS, connect=CLIENT_CONNECT_TIMEOUT_SECONDS)
+
+def get_anthropic_client(api_key):
+    """
+    Returns the process-wide Anthropic client for an API key.
+    The client keeps its HTTP connections (and TLS sessions) open between requests.
+    """
+    client = _anthropic_clients.get(api_key)
+    if client is not None:
+        return client
+    import anthropic # type: ignore
+    with _clients_lock:
+        if api_key not in _anthropic_clients:
+            _anthropic_clients[api_key] = anthropic.Anthropic(
+                api_key=api_key,
+                timeout=_timeout(),
+                http_client=anthropic.DefaultHttpxClient(limits=_pool_limits(), timeout=_timeout())
+            )
+        return _anthropic_clients[api_key]
+
+def get_sendgrid_client(api_key):
+    """
+    Returns the process-wide HTTP client for the SendGrid v3 API for an API key.
+    The sendgrid package opens a new urllib connection per request, so mail is posted
+    through a keep-alive httpx client instead; send it Mail.get() payloads.
+    """
+    client = _sendgrid_clients.get(api_key)
+    if client is not None:
+        return client
+    import httpx
+    with _clients_lock:
+        if api_key not in _sendgrid_clients:
+            _sendgrid_clients[api_key] = httpx.Client(
+                base_url=SENDGRID_BASE_URL,
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                limits=_pool_limits(),
+                timeout=_timeout()
+            )
+        return _sendgrid_clients[api_key]
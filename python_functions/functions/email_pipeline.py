@@ -0,0 +1,242 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from firebase_functions.params import StringParam
+from email_utils import get_secretary_info, send_email_response, prepare_email_body
+from ai_utils import process_with_ai, CLAUDE_API_KEY
+from email_router import route_email, record_route, ROUTE_DROP
+from clients import get_anthropic_client
+from task_history import TaskHistoryWriter
+from usage_accounting import UsageLedger
+from thread_memory import resolve_email_thread, load_thread, format_thread_context, append_turns
+from tracing import traced, current_span, firestore_span
+
+# 'trigger': tasks are picked up by the Firestore-triggered worker in main.py
+# 'local': tasks run on an in-process queue (emulator and tests)
+EMAIL_PIPELINE_MODE = StringParam('EMAIL_PIPELINE_MODE', 'trigger')
+
+# Initialize Globals
+LOCAL_QUEUE_MAX_WORKERS = 4  # Emails processed at once by the in-process queue
+EMAIL_WORKER_MAX_INSTANCES = 10  # Upper bound on concurrently running worker instances
+EMAIL_WORKER_TIMEOUT_SECONDS = 300  # Worker function timeout; a run is stopped after this long
+TASK_CLAIM_LEASE_SECONDS = EMAIL_WORKER_TIMEOUT_SECONDS + 30  # A 'processing' claim older than this belongs to a run that died
+TASK_MAX_CLAIMS = 3  # Runs allowed per task before it is marked failed instead of claimed again
+STALE_TASK_SWEEP_MAX = 4  # Stale tasks run again per sweep (concurrently, within one worker timeout)
+
+_local_queue = None
+
+def enqueue_email_task(task_id, db, sending_domain):
+    """
+    Hand a logged email task to the background worker.
+    In 'trigger' mode nothing needs to happen here: creating the task document starts the worker.
+
+    Returns:
+      Future or None: the local queue future in 'local' mode
+    """
+    if EMAIL_PIPELINE_MODE.value != 'local':
+        return None
+
+    global _local_queue
+    if _local_queue is None:
+        _local_queue = ThreadPoolExecutor(max_workers=LOCAL_QUEUE_MAX_WORKERS, thread_name_prefix="email-task")
+    return _local_queue.submit(process_email_task, task_id, db, sending_domain)
+
+def claim_email_task(task_id, db):
+    """
+    Atomically move a task from 'queued' to 'processing'.
+    Triggers are delivered at least once, so only the first claim gets the task data. A
+    'processing' task whose claim is older than TASK_CLAIM_LEASE_SECONDS was left by a run
+    that crashed or timed out, and is claimed again (up to TASK_MAX_CLAIMS runs, after which
+    it is marked failed).
+
+    Returns:
+      dict or None: the task data, or None if the task was already claimed
+    """
+    from firebase_admin import firestore
+    task_ref = db.collection('task_history').document(task_id)
+    transaction = db.transaction()
+
+    @firestore.transactional
+    def claim(transaction):
+        snapshot = task_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        task_data = snapshot.to_dict()
+        status = task_data.get('status')
+        if status == 'processing':
+            if not claim_expired(task_data):
+                return None
+            if task_data.get('claim_count', 1) >= TASK_MAX_CLAIMS:
+                transaction.update(task_ref, {
+                    'status': 'failed',
+                    'error': f"Worker stopped before finishing {TASK_MAX_CLAIMS} times",
+                    'completed_at': firestore.SERVER_TIMESTAMP
+                })
+                return None
+            print(f"Task {task_id}: claim from {task_data.get('processing_started_at')} expired, claiming again")
+        elif status != 'queued':
+            return None
+        transaction.update(task_ref, {
+            'status': 'processing',
+            'processing_started_at': firestore.SERVER_TIMESTAMP,
+            'claim_count': firestore.Increment(1)
+        })
+        return task_data
+
+    with firestore_span('transaction', 'task_history'):
+        return claim(transaction)
+
+def claim_expired(task_data):
+    """
+    Whether a 'processing' task's claim is older than TASK_CLAIM_LEASE_SECONDS.
+    """
+    claimed_at = task_data.get('processing_started_at')
+    return not claimed_at or time.time() - claimed_at.timestamp() >= TASK_CLAIM_LEASE_SECONDS
+
+def run_stale_email_tasks(db, sending_domain):
+    """
+    Run again the tasks left 'processing' by a worker that crashed or timed out.
+    The trigger fires once per task, so nothing else picks these up. At most
+    STALE_TASK_SWEEP_MAX tasks are run per call, concurrently.
+
+    Returns:
+      list: IDs of the tasks that were run
+    """
+    with firestore_span('query', 'task_history'):
+        snapshots = db.collection('task_history').where('status', '==', 'processing').stream()
+        task_ids = [snapshot.id for snapshot in snapshots if claim_expired(snapshot.to_dict())][:STALE_TASK_SWEEP_MAX]
+    if task_ids:
+        with ThreadPoolExecutor(max_workers=len(task_ids), thread_name_prefix="stale-email-task") as pool:
+            list(pool.map(lambda task_id: process_email_task(task_id, db, sending_domain), task_ids))
+    return task_ids
+
+@traced('email.task', flush=True)
+def process_email_task(task_id, db, sending_domain):
+    """
+    Run the AI and send stages for a queued email task.
+    Records per-stage timings (milliseconds) on the task_history document. Status, AI output,
+    tool calls, timings, token usage and debug logs are written together in one batch at the
+    end, along with the user's daily usage counters.
+    """
+    from firebase_admin import firestore
+    started = time.perf_counter()
+    usage = UsageLedger()
+    writer = TaskHistoryWriter(task_id, db, usage)
+    current_span().set_attribute('task.id', task_id)
+
+    try:
+        task_data = claim_email_task(task_id, db)
+        if not task_data:
+            print(f"Task {task_id} already claimed, skipping")
+            return
+
+        if task_data.get('enqueued_at'):
+            writer.record_timing('queue_ms', (time.time() - task_data['enqueued_at']) * 1000)
+
+        # Look up the secretary info in Firestore
+        secretary_info = get_secretary_info(task_data.get('secretary_id'), db)
+        if not secretary_info:
+            raise ValueError(f"No secretary found with ID: {task_data.get('secretary_id')}")
+        usage.user_id = secretary_info.get('user_id')
+        usage.secretary_id = task_data.get('secretary_id')
+
+        # Strip quoted history, signatures and HTML before the body goes into every AI turn
+        body, body_stats = prepare_email_body(task_data.get('body', ''))
+        writer.update({'body_tokens': body_stats})
+        print(f"Task {task_id}: email body {body_stats['original_tokens']} -> {body_stats['tokens']} tokens "
+              f"({body_stats['tokens_saved']} saved)")
+        
+        # Earlier messages in this email thread
+        thread_key = resolve_email_thread(task_data.get('message_id'), task_data.get('references'), task_data.get('in_reply_to'), db)
+        thread = load_thread(thread_key, db)
+        
+        # Drop automated mail and send simple emails to the small model before the tool loop
+        stage_start = time.perf_counter()
+        route, reason = route_email(task_data, body, thread, get_anthropic_client(CLAUDE_API_KEY.value), usage)
+        triage_ms = (time.perf_counter() - stage_start) * 1000
+        writer.record_timing('route_ms', triage_ms)
+        current_span().set_attributes({'email.route': route, 'email.route_reason': reason})
+        
+        if route == ROUTE_DROP:
+            writer.update({'route': record_route(route, reason, triage_ms, 0, usage)})
+            writer.record_timing('worker_total_ms', (time.perf_counter() - started) * 1000)
+            writer.set_status('dropped')
+            writer.update({'completed_at': firestore.SERVER_TIMESTAMP})
+            writer.flush()
+            return
+        
+        # Process the email with AI and get response
+        stage_start = time.perf_counter()
+        response_content, debug_logs = process_with_ai(
+            secretary_info=secretary_info,
+            from_address=task_data.get('from', ''),
+            subject=task_data.get('subject', '(No Subject)'),
+            body=body,
+            task_id=task_id,
+            task_writer=writer,
+            thread_context=format_thread_context(thread),
+            route=route,
+            usage=usage
+        )
+        ai_ms = (time.perf_counter() - stage_start) * 1000
+        writer.record_timing('ai_ms', ai_ms)
+        writer.add_debug_logs(debug_logs)
+        writer.update({'route': record_route(route, reason, triage_ms, ai_ms, usage)})
+
+        # Send the response email with thread headers
+        stage_start = time.perf_counter()
+        sent_message_id = send_email_response(
+            to_email=task_data.get('from', ''),
+            from_email=task_data.get('to', ''),
+            subject=f"Re: {task_data.get('subject', '(No Subject)')}",
+            content=response_content,
+            message_id=task_data.get('message_id'),
+            references=task_data.get('references'),
+            domain=sending_domain
+        )
+        writer.record_timing('send_ms', (time.perf_counter() - stage_start) * 1000)
+        
+        # Add this exchange to the thread memory, with both emails' Message-IDs as thread aliases
+        if sent_message_id:
+            writer.update({'sent_message_id': sent_message_id})
+            remember_email_exchange(thread_key, task_data.get('from', ''), body, response_content, secretary_info, db, usage,
+                                    message_ids=[task_data.get('message_id'), sent_message_id])
+        writer.record_timing('worker_total_ms', (time.perf_counter() - started) * 1000)
+
+        writer.set_status('completed' if sent_message_id else 'send_failed')
+        writer.update({'completed_at': firestore.SERVER_TIMESTAMP})
+        writer.flush()
+
+    except Exception as e:
+        logging.error(f"Error processing email task {task_id}: {str(e)}")
+        writer.set_status('failed')
+        writer.update({
+            'error': str(e),
+            'completed_at': firestore.SERVER_TIMESTAMP
+        })
+        try:
+            writer.flush()
+        except Exception as flush_error:
+            # The task stays 'processing' until run_stale_email_tasks picks it up again
+            logging.error(f"Error recording failure of email task {task_id}: {str(flush_error)}")
+
+def remember_email_exchange(thread_key, from_address, body, response_content, secretary_info, db, usage=None, message_ids=None):
+    """
+    Store an inbound email and the secretary's reply in the thread memory.
+    Failures are logged; they never fail the task.
+    """
+    try:
+        append_turns(
+            thread_key,
+            [
+                {'role': 'user', 'content': f"From {from_address}: {body}"},
+                {'role': 'assistant', 'content': response_content}
+            ],
+            client=get_anthropic_client(CLAUDE_API_KEY.value),
+            user_id=secretary_info.get('user_id'),
+            db=db,
+            usage=usage,
+            message_ids=[message_id for message_id in message_ids or [] if message_id]
+        )
+    except Exception as e:
+        logging.error(f"Error updating thread memory {thread_key}: {str(e)}")
@@ -0,0 +1,189 @@
+import logging
+import re
+from firebase_functions.params import BoolParam, StringParam
+from tracing import model_span, record_model_usage
+from usage_accounting import UsageLedger
+
+# Route inbound emails before the tool loop; when off every email takes the full route
+EMAIL_ROUTING = BoolParam('EMAIL_ROUTING', default=True)
+
+# Model for the triage call on emails the heuristics can't place
+TRIAGE_MODEL = StringParam('TRIAGE_MODEL', 'claude-3-5-haiku-20241022')
+
+# Routes
+ROUTE_DROP = 'drop'  # No reply (auto-replies, bulk and list mail)
+ROUTE_REPLY = 'reply'  # One small-model request without calendar tools
+ROUTE_FULL = 'full'  # The full tool loop with CLAUDE_MODEL
+ROUTES = (ROUTE_DROP, ROUTE_REPLY, ROUTE_FULL)
+
+# Routing settings
+TRIAGE_MAX_TOKENS = 5
+TRIAGE_BODY_MAX_CHARS = 2000  # Email text shown to the triage model
+TRIAGE_CONTEXT_MAX_CHARS = 1000  # Secretary's last message in the thread shown to the triage model
+ACKNOWLEDGEMENT_MAX_CHARS = 160  # Longer emails are never treated as a plain acknowledgement
+
+# Header values of automated and bulk mail
+BULK_PRECEDENCE = {'bulk', 'junk', 'list', 'auto_reply'}
+AUTOMATED_SENDER_PATTERN = re.compile(
+    r'(^|<)(no-?reply|do-?not-?reply|mailer-daemon|postmaster|bounces?|notifications?)([+.@-])',
+    re.IGNORECASE
+)
+
+# Emails that mention the calendar go straight to the full route
+SCHEDULING_PATTERN = re.compile(
+    r'\b(re)?schedul|\bcalendar\b|\bmeet(ing)?s?\b|\bavailab|\bfree\b|\bbusy\b|\bappointment|\binvit|'
+    r'\bbook|\bcancel|\bmove\b|\bpostpone|\bcall\b|\btoday\b|\btomorrow\b|\btonight\b|\bnext (week|month)\b|'
+    r'\b(mon|tues|wednes|thurs|fri|satur|sun)day\b|\b\d{1,2}(:\d{2})?\s*(am|pm)\b',
+    re.IGNORECASE
+)
+ACKNOWLEDGEMENT_PATTERN = re.compile(
+    r'^\W*(thanks?|thank you|thx|ok(ay)?|got it|great|perfect|noted|received|will do|appreciate it)\b',
+    re.IGNORECASE
+)
+
+TRIAGE_PROMPT = """You sort emails sent to an AI secretary that manages its principal's calendar. Answer with one word:
+DROP - automated, bulk, marketing or notification mail that needs no reply
+REPLY - needs a reply, but nothing on the calendar has to be checked or changed
+FULL - anything about meetings, times, availability or events, anything that accepts, confirms or declines something the secretary proposed, and anything you are unsure about"""
+
+# Per-route totals on this instance, for tuning the heuristics
+ROUTE_STATS = {
+    route: {'emails': 0, 'latency_ms': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0}
+    for route in ROUTES
+}
+ROUTE_STATS['triage'] = {'emails': 0, 'latency_ms': 0, 'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0}
+
+def route_email(task_data, body, thread, client, usage=None):
+    """
+    Decide how an inbound email is handled: headers first, then local heuristics, then a
+    triage call to TRIAGE_MODEL for whatever is left.
+
+    Parameters:
+      task_data (dict): The email task (from, subject, routing_headers)
+      body (str): The prepared email body
+      thread (dict): The thread memory (see thread_memory.load_thread)
+      client: Anthropic client for the triage call
+      usage (UsageLedger): (Optional) Ledger the triage call is recorded on
+
+    Returns:
+      tuple: (route, reason)
+    """
+    if not EMAIL_ROUTING.value:
+        return ROUTE_FULL, 'routing disabled'
+
+    route, reason = route_by_headers(task_data.get('routing_headers') or {}, task_data.get('from', ''), thread)
+    if route:
+        return route, reason
+
+    if SCHEDULING_PATTERN.search(f"{task_data.get('subject', '')}\n{body}"):
+        return ROUTE_FULL, 'mentions scheduling'
+
+    # "Sounds good" can accept a proposal from earlier in the thread, so only a fresh email is a plain thank-you
+    text = body.strip()
+    if not thread.get('turns') and len(text) <= ACKNOWLEDGEMENT_MAX_CHARS and '?' not in text and ACKNOWLEDGEMENT_PATTERN.match(text):
+        return ROUTE_REPLY, 'acknowledgement'
+
+    return triage_email(task_data, text, thread, client, usage)
+
+def route_by_headers(headers, from_address, thread):
+    """
+    Drop auto-replies (RFC 3834) always, and bulk, list and automated senders unless the
+    thread already has messages.
+
+    Returns:
+      tuple: (route, reason), or (None, None) when the headers don't decide
+    """
+    auto_submitted = headers.get('auto-submitted', '').strip().lower()
+    if auto_submitted and auto_submitted != 'no':
+        return ROUTE_DROP, f"auto-submitted: {auto_submitted}"
+    if headers.get('x-autoreply') or headers.get('x-autorespond'):
+        return ROUTE_DROP, 'auto-reply header'
+    if headers.get('return-path', '').strip() == '<>':
+        return ROUTE_DROP, 'bounce'
+
+    if thread.get('turns'):
+        return None, None
+    if headers.get('precedence', '').strip().lower() in BULK_PRECEDENCE:
+        return ROUTE_DROP, f"precedence: {headers['precedence'].strip().lower()}"
+    if headers.get('list-id') or headers.get('list-unsubscribe'):
+        return ROUTE_DROP, 'mailing list'
+    if headers.get('x-campaign'):
+        return ROUTE_DROP, 'campaign'
+    if AUTOMATED_SENDER_PATTERN.search(from_address or ''):
+        return ROUTE_DROP, 'automated sender'
+    return None, None
+
+def triage_email(task_data, text, thread, client, usage=None):
+    """
+    Ask TRIAGE_MODEL for a route. Errors and unclear answers take the full route.
+
+    Returns:
+      tuple: (route, reason)
+    """
+    last_reply = next((turn['content'] for turn in reversed(thread.get('turns', [])) if turn.get('role') == 'assistant'), '')
+    context = f"The secretary's last message in this thread:\n{last_reply[:TRIAGE_CONTEXT_MAX_CHARS]}\n\n" if last_reply else ''
+
+    try:
+        with model_span(TRIAGE_MODEL.value, 'triage') as model_call:
+            response = client.messages.create(
+                model=TRIAGE_MODEL.value,
+                max_tokens=TRIAGE_MAX_TOKENS,
+                system=TRIAGE_PROMPT,
+                messages=[{
+                    "role": "user",
+                    "content": f"{context}From: {task_data.get('from', '')}\nSubject: {task_data.get('subject', '')}\n\n{text[:TRIAGE_BODY_MAX_CHARS]}"
+                }]
+            )
+            record_model_usage(model_call, response.usage)
+        if usage is not None:
+            usage.record(TRIAGE_MODEL.value, response.usage, 'triage')
+        answer = "".join(block.text for block in response.content if block.type == "text").strip().lower()
+    except Exception as e:
+        logging.error(f"Error triaging email: {str(e)}")
+        return ROUTE_FULL, 'triage failed'
+
+    route = next((route for route in ROUTES if answer.startswith(route)), None)
+    if route is None:
+        return ROUTE_FULL, f"unclear triage answer: {answer[:20]}"
+    return route, 'triage'
+
+def record_route(route, reason, triage_ms, ai_ms, usage=None):
+    """
+    Add an email to the per-route counters. Triage is counted on its own and also as part of
+    the route it chose, so each route's totals are what its emails cost end to end.
+
+    Parameters:
+      usage (UsageLedger): (Optional) The task's ledger, with the triage and AI calls
+
+    Returns:
+      dict: the route record stored on the task
+    """
+    usage = usage or UsageLedger()
+    totals = usage.totals()
+    triage_usage = usage.totals('triage')
+    record = {
+        'name': route,
+        'reason': reason,
+        'triage_ms': round(triage_ms),
+        'ai_ms': round(ai_ms),
+        'input_tokens': totals['input_tokens'],
+        'output_tokens': totals['output_tokens'],
+        'cost_usd': totals['cost_usd']
+    }
+
+    stats = ROUTE_STATS[route]
+    stats['emails'] += 1
+    stats['latency_ms'] += record['triage_ms'] + record['ai_ms']
+    stats['input_tokens'] += record['input_tokens']
+    stats['output_tokens'] += record['output_tokens']
+    stats['cost_usd'] += record['cost_usd']
+    if triage_usage['requests']:
+        triage_stats = ROUTE_STATS['triage']
+        triage_stats['emails'] += 1
+        triage_stats['latency_ms'] += record['triage_ms']
+        triage_stats['input_tokens'] += triage_usage['input_tokens']
+        triage_stats['output_tokens'] += triage_usage['output_tokens']
+        triage_stats['cost_usd'] += triage_usage['cost_usd']
+
+    print(f"Routed email to '{route}' ({reason}), route stats: {ROUTE_STATS}")
+    return record
@@ -1,51 +1,111 @@
 from flask import Request, Response
 import json
-import sendgrid # type: ignore
-from sendgrid.helpers.mail import Mail, Email, To, Content # type: ignore
-from firebase_functions.params import StringParam
+import os
+import re
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from firebase_functions.params import StringParam, IntParam
+from clients import get_sendgrid_client, initialize_firebase
+from profile_cache import get_secretary_profile
+from tracing import span, firestore_span
+from thread_memory import parse_message_ids
 
 # Initialize SendGrid API key and domain
 SENDGRID_API_KEY = StringParam('SENDGRID_API_KEY')
 
+# Cloud Storage bucket for inbound attachments; when empty only their metadata (name, type, size) is kept
+ATTACHMENT_BUCKET = StringParam('ATTACHMENT_BUCKET', '')
+
+# Inbound size caps
+MAX_INBOUND_EMAIL_BYTES = 25 * 1024 * 1024  # Request bytes read; anything after this is dropped
+MAX_FORM_FIELD_BYTES = 1024 * 1024  # Cap for each plain form field (text, html, headers, ...)
+MAX_ATTACHMENT_BYTES = 10 * 1024 * 1024  # Larger attachments are recorded but not stored
+STREAM_CHUNK_BYTES = 64 * 1024  # Bytes read from the request stream at a time
+ATTACHMENT_UPLOAD_CHUNK_BYTES = 1024 * 1024  # Resumable upload chunk held in memory (a multiple of 256 KiB)
+
+# Inbound body preprocessing: estimated tokens of the email body passed to the AI
+EMAIL_BODY_TOKEN_BUDGET = IntParam('EMAIL_BODY_TOKEN_BUDGET', default=2000)
+CHARS_PER_TOKEN = 4  # Rough average for English text
+TRUNCATION_MARKER = "\n[... truncated]"
+
+# Attribution lines that start a quoted reply chain, signatures and legal footers
+REPLY_ATTRIBUTION_PATTERN = re.compile(r'^On\b.{0,300}\bwrote:\s*$', re.IGNORECASE)
+ORIGINAL_MESSAGE_PATTERN = re.compile(r'^-{2,}\s*(Original Message|Reply message)\s*-{2,}', re.IGNORECASE)
+SEPARATOR_PATTERN = re.compile(r'^\s*(_{5,}|-{5,})\s*$')  # Line above Outlook's From:/Sent: reply header
+FORWARDED_MESSAGE_PATTERN = re.compile(r'\s*(-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)', re.IGNORECASE)
+SIGNATURE_PATTERN = re.compile(r'^(-- ?|__+|Sent from my \w+.*|Get Outlook for \w+.*)\s*$')
+FOOTER_PATTERN = re.compile(
+    r'^\s*(CONFIDENTIALITY (NOTICE|STATEMENT)|LEGAL DISCLAIMER|'
+    r'This (e-?mail|message|communication)( and any (files|attachments).{0,40})? (is|are|may contain) (confidential|intended|privileged)|'
+    r'The information (contained )?in this (e-?mail|message) (is|may be) (confidential|privileged|intended))',
+    re.IGNORECASE
+)
+FOOTER_MAX_CHARS = 1500  # A footer match is only cut this close to the end of the message
+
+# HTML to text conversion
+HTML_BODY_PATTERN = re.compile(r'<(html|body|div|p|br|table|span)\b', re.IGNORECASE)
+HTML_SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'blockquote'}
+HTML_QUOTE_CLASSES = {'gmail_quote', 'yahoo_quoted', 'moz-cite-prefix'}  # Quoted reply containers
+HTML_BLOCK_TAGS = {'p', 'div', 'tr', 'table', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'section'}
+
+# Headers kept on the task for email routing (auto-replies, bulk and list mail)
+ROUTING_HEADERS = [
+    'auto-submitted', 'precedence', 'list-id', 'list-unsubscribe', 'x-autoreply',
+    'x-autorespond', 'x-auto-response-suppress', 'x-campaign', 'return-path'
+]
+
+# Inbound message dedupe settings
+RECENT_MESSAGE_IDS_MAX = 1000  # Message keys remembered in memory per instance
+_recent_message_keys = OrderedDict()
+_recent_message_keys_lock = threading.Lock()
+DEDUPE_STATS = {
+    'checked': 0,
+    'suppressed_memory': 0,
+    'suppressed_firestore': 0
+}
+
 def parse_sendgrid_inbound_email(request: Request) -> dict:
     """
     Parse the email data from SendGrid's Inbound Parse webhook.
     This improved version handles typical SendGrid webhook formats better.
     """
     try:
-        # Extract Message-ID and References headers for threading
+        # Extract Message-ID, References and In-Reply-To headers for threading
         message_id = None
         references = None
+        in_reply_to = None
         
         # For multipart/form-data (most common SendGrid format)
         if request.content_type and 'multipart/form-data' in request.content_type:
-            form = request.form.to_dict()
+            # Stream the form instead of request.form, so the raw email and attachments never sit in memory whole
+            form, raw_email, attachments, truncated = read_inbound_form_stream(request)
+            if raw_email is not None:
+                # Keep the raw email's attachments even when the form fields have the body
+                attachments.extend(raw_email['attachments'])
             
-            # Extract from the 'email' field if that's where the content is
-            if 'email' in form and (not form.get('text') and not form.get('html')):
-                email_raw = form.get('email', '')
-                # Simple extraction of essential parts from the raw email
-                from_address = extract_header(email_raw, 'From')
-                to_address = extract_header(email_raw, 'To')
-                subject = extract_header(email_raw, 'Subject')
-                message_id = extract_header(email_raw, 'Message-ID')
-                references = extract_header(email_raw, 'References')
-                
-                # Try to extract body by looking for double newline after headers
-                body = ""
-                parts = email_raw.split('\r\n\r\n', 1)
-                if len(parts) > 1:
-                    body = parts[1]
+            # Extract from the raw 'email' field if that's where the content is
+            if raw_email is not None and (not form.get('text') and not form.get('html')):
+                headers = raw_email['headers']
+                truncated = truncated or raw_email['truncated']
+                message_id = headers.get('message-id')
+                references = headers.get('references')
+                in_reply_to = headers.get('in-reply-to')
                 
                 email_data = {
-                    'to': to_address,
-                    'from': from_address,
-                    'subject': subject,
-                    'text': body,
-                    'html': ''  # We don't extract HTML separately in this simple parser
+                    'to': headers.get('to', ''),
+                    'from': headers.get('from', ''),
+                    'subject': headers.get('subject', ''),
+                    'text': raw_email['text'],
+                    'html': raw_email['html']
                 }
             else:
-                # Standard form fields from SendGrid
+                # Standard form fields from SendGrid; threading headers come from the raw 'headers' field
+                headers = parse_header_block(form.get('headers', ''))
+                message_id = headers.get('message-id')
+                references = headers.get('references')
+                in_reply_to = headers.get('in-reply-to')
                 email_data = {
                     'to': form.get('to', ''),
                     'from': form.get('from', ''),
@@ -79,6 +139,10 @@ def parse_sendgrid_inbound_email(request: Request) -> dict:
             # Add the message ID and references to the email_data
             email_data['message_id'] = message_id
             email_data['references'] = references
+            email_data['in_reply_to'] = in_reply_to
+            email_data['routing_headers'] = {name: headers[name] for name in ROUTING_HEADERS if headers.get(name)}
+            email_data['attachments'] = attachments
+            email_data['truncated'] = truncated
             
             return email_data
         print("Could not determine how to parse the request")
@@ -90,30 +154,598 @@ def parse_sendgrid_inbound_email(request: Request) -> dict:
         traceback.print_exc()
         return None
 
-def extract_header(raw_email, header_name):
-    """
-    Improved helper to extract headers from raw email text.
-    Handles both single-line and multi-line headers.
-    """
-    lines = raw_email.splitlines()
-    header_value = ""
-    found_header = False
-    
-    for i, line in enumerate(lines):
-        if line.startswith(f"{header_name}:"):
-            header_value = line[len(header_name)+1:].strip()
-            found_header = True
-            # Check for continuation lines (indented with space or tab)
-            for j in range(i+1, len(lines)):
-                if lines[j].startswith((' ', '\t')):
-                    header_value += ' ' + lines[j].strip()
+class _StreamingMimeParser:
+    """
+    Incremental MIME parser for the raw 'email' field. Header blocks are parsed with the
+    stdlib email header parser, but body lines are routed as they arrive: text parts are
+    kept (up to MAX_FORM_FIELD_BYTES) and everything else is decoded straight into an
+    attachment spool. The stdlib feed parser holds every part whole until it ends.
+    """
+    
+    def __init__(self):
+        self._pending = []  # Chunks of the line still being received
+        self._boundaries = []  # Delimiters (b'--' + boundary) of the open multiparts, outermost first
+        self._state = 'headers'  # 'headers', 'body', or 'skip' (preamble/epilogue)
+        self._header_lines = []
+        self._header_size = 0
+        self._part = None
+        self.headers = {}
+        self.text = None
+        self.html = None
+        self.attachments = []
+        self.truncated = False  # Headers or a text part were cut at MAX_FORM_FIELD_BYTES
+    
+    def feed(self, data):
+        # Only the new data is searched for line breaks, so long lines arriving over many
+        # chunks aren't rescanned each time
+        newline = data.find(b'\n')
+        if newline == -1:
+            self._pending.append(data)
+            return
+        self._pending.append(data[:newline + 1])
+        self._handle_line(b''.join(self._pending))
+        lines = data[newline + 1:].split(b'\n')
+        self._pending = [lines.pop()]
+        for line in lines:
+            self._handle_line(line + b'\n')
+    
+    def close(self, truncated=False):
+        """
+        Finish parsing. If the input was cut off, an unfinished attachment is marked truncated.
+        
+        Returns:
+          dict: headers (keyed by lower-case name), text, html, attachments and truncated
+        """
+        rest = b''.join(self._pending)
+        self._pending = []
+        if rest:
+            self._handle_line(rest)
+        if self._state == 'headers' and self._header_lines:
+            self._start_body()
+        if truncated and self._part is not None and self._part['kind'] == 'spool':
+            self._part['spool']['truncated'] = True
+        self._finish_part()
+        return {
+            'headers': self.headers,
+            'text': self.text or '',
+            'html': self.html or '',
+            'attachments': self.attachments,
+            'truncated': self.truncated
+        }
+    
+    def _handle_line(self, line):
+        content = line.rstrip(b'\r\n')
+        
+        if self._state == 'headers':
+            if not content:
+                self._start_body()
+            elif self._header_size + len(line) <= MAX_FORM_FIELD_BYTES:
+                self._header_lines.append(line)
+                self._header_size += len(line)
+            else:
+                self.truncated = True
+            return
+        
+        if self._boundaries and content.startswith(b'--'):
+            delimiter = content.rstrip()
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                boundary = self._boundaries[depth]
+                if delimiter == boundary:
+                    # Next part of this multipart
+                    self._finish_part()
+                    del self._boundaries[depth + 1:]
+                    self._state = 'headers'
+                    return
+                if delimiter == boundary + b'--':
+                    # End of this multipart, skip its epilogue
+                    self._finish_part()
+                    del self._boundaries[depth:]
+                    self._state = 'skip'
+                    return
+        
+        if self._state == 'body':
+            self._write_body(line, content)
+    
+    def _start_body(self):
+        from email.parser import BytesHeaderParser
+        message = BytesHeaderParser().parsebytes(b''.join(self._header_lines))
+        self._header_lines = []
+        self._header_size = 0
+        
+        # The first header block is the email's own
+        if not self.headers:
+            for name, value in message.items():
+                unfolded = re.sub(r'\r?\n[ \t]+', ' ', str(value)).strip()
+                self.headers.setdefault(name.lower(), decode_header_value(unfolded))
+        
+        if message.get_content_maintype() == 'multipart' and message.get_boundary():
+            self._boundaries.append(b'--' + message.get_boundary().encode('ascii', errors='replace'))
+            self._state = 'skip'  # Preamble
+            return
+        
+        content_type = message.get_content_type()
+        inline = message.get_content_disposition() != 'attachment' and not message.get_filename()
+        if inline and content_type == 'text/plain' and self.text is None:
+            kind = 'text'
+        elif inline and content_type == 'text/html' and self.html is None:
+            kind = 'text'
+        elif inline and message.get_content_maintype() in ('text', 'message'):
+            kind = 'skip'  # Further inline alternatives
+        else:
+            kind = 'spool'
+        
+        self._part = {
+            'kind': kind,
+            'message': message,
+            'encoding': str(message.get('Content-Transfer-Encoding', '7bit')).strip().lower(),
+            'chunks': [],
+            'size': 0,
+            'base64_remainder': b'',
+            'pending_newline': b''
+        }
+        if kind == 'spool':
+            self._part['spool'] = open_attachment_spool(message.get_filename(), content_type)
+        self._state = 'body'
+    
+    def _write_body(self, line, content):
+        import binascii
+        part = self._part
+        if part is None or part['kind'] == 'skip':
+            return
+        
+        if part['kind'] == 'text':
+            if part['size'] + len(line) <= MAX_FORM_FIELD_BYTES:
+                part['chunks'].append(line)
+                part['size'] += len(line)
+            else:
+                self.truncated = True
+            return
+        
+        spool = part['spool']
+        if spool['error']:
+            return
+        if part['encoding'] == 'base64':
+            # Decode whole 4-character groups, carrying the rest to the next line
+            data = part['base64_remainder'] + content.strip()
+            usable = len(data) - len(data) % 4
+            part['base64_remainder'] = data[usable:]
+            try:
+                write_attachment_spool(spool, binascii.a2b_base64(data[:usable]))
+            except binascii.Error as e:
+                # The rest of the file can't be trusted; it is recorded but not stored
+                print(f"Invalid base64 in attachment {spool['filename']}: {str(e)}")
+                spool['error'] = f"Could not decode attachment: {str(e)}"
+            return
+        
+        # The line break before a boundary belongs to the boundary, so each break is
+        # only written once the next body line arrives
+        write_attachment_spool(spool, part['pending_newline'])
+        if part['encoding'] == 'quoted-printable':
+            if content.endswith(b'='):
+                # Soft line break
+                write_attachment_spool(spool, binascii.a2b_qp(content[:-1]))
+                part['pending_newline'] = b''
+                return
+            content = binascii.a2b_qp(content)
+        write_attachment_spool(spool, content)
+        part['pending_newline'] = line[len(line.rstrip(b'\r\n')):]
+    
+    def _finish_part(self):
+        part = self._part
+        self._part = None
+        if part is None:
+            return
+        
+        if part['kind'] == 'spool':
+            self.attachments.append(close_attachment_spool(part['spool']))
+        elif part['kind'] == 'text':
+            # Let the stdlib Message undo the transfer encoding and charset
+            message = part['message']
+            if part['chunks']:
+                # The last line break belongs to the boundary
+                part['chunks'][-1] = part['chunks'][-1].rstrip(b'\r\n')
+            message.set_payload(b''.join(part['chunks']).decode('ascii', errors='surrogateescape'))
+            if message.get_content_type() == 'text/html':
+                self.html = _decode_text_part(message)
+            else:
+                self.text = _decode_text_part(message)
+
+def read_inbound_form_stream(request):
+    """
+    Incrementally parse SendGrid's multipart/form-data body from the request stream.
+    The raw 'email' field is fed straight into a streaming MIME parser, uploaded files are
+    streamed to Cloud Storage (or only measured, see open_attachment_spool), and other fields
+    are capped at MAX_FORM_FIELD_BYTES.
+    
+    Returns:
+      tuple: (fields dict, raw email dict or None, attachments list, truncated flag)
+             The raw email dict has headers, text, html and attachments.
+    """
+    from werkzeug.http import parse_options_header
+    from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+    
+    _, options = parse_options_header(request.content_type)
+    boundary = options.get('boundary')
+    if not boundary:
+        raise ValueError("Missing multipart boundary")
+    
+    decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=None)
+    fields = {}
+    attachments = []
+    raw_parser = None
+    truncated = False
+    bytes_read = 0
+    
+    # The part being read: ('email', None), ('file', spool) or ('field', (name, chunks))
+    current = None
+    current_size = 0
+    
+    def finish_part():
+        nonlocal current
+        if current is None:
+            return
+        kind, state = current
+        if kind == 'file':
+            attachments.append(close_attachment_spool(state))
+        elif kind == 'field':
+            name, chunks = state
+            fields.setdefault(name, b''.join(chunks).decode('utf-8', errors='replace'))
+        current = None
+    
+    while True:
+        chunk = request.stream.read(STREAM_CHUNK_BYTES)
+        at_cap = False
+        if chunk and bytes_read + len(chunk) > MAX_INBOUND_EMAIL_BYTES:
+            print(f"Inbound email larger than {MAX_INBOUND_EMAIL_BYTES} bytes, dropping the rest")
+            chunk = chunk[:MAX_INBOUND_EMAIL_BYTES - bytes_read]
+            truncated = at_cap = True
+        bytes_read += len(chunk)
+        if chunk:
+            decoder.receive_data(chunk)
+        elif not at_cap:
+            # End of the request body
+            decoder.receive_data(None)
+        
+        event = decoder.next_event()
+        while not isinstance(event, (Epilogue, NeedData)):
+            if isinstance(event, (Field, File)):
+                finish_part()
+                current_size = 0
+                if event.name == 'email':
+                    raw_parser = _StreamingMimeParser()
+                    current = ('email', None)
+                elif isinstance(event, File):
+                    current = ('file', open_attachment_spool(event.filename, event.headers.get('Content-Type', '')))
+                else:
+                    current = ('field', (event.name, []))
+            elif isinstance(event, Data) and current is not None:
+                kind, state = current
+                if kind == 'email':
+                    raw_parser.feed(event.data)
+                elif kind == 'file':
+                    write_attachment_spool(state, event.data)
+                elif current_size + len(event.data) <= MAX_FORM_FIELD_BYTES:
+                    state[1].append(event.data)
+                    current_size += len(event.data)
                 else:
-                    break
+                    truncated = True
+                if not event.more_data:
+                    finish_part()
+            event = decoder.next_event()
+        
+        if isinstance(event, Epilogue) or at_cap or not chunk:
+            break
+    
+    # Keep whatever arrived of a field cut off by the size cap, but not partial attachments
+    cut_part = current[0] if current is not None and truncated else None
+    if cut_part == 'file':
+        current[1]['truncated'] = True
+    finish_part()
+    
+    raw_email = raw_parser.close(truncated=cut_part == 'email') if raw_parser is not None else None
+    return fields, raw_email, attachments, truncated
+
+def _decode_text_part(part):
+    payload = part.get_payload(decode=True) or b''
+    charset = part.get_content_charset() or 'utf-8'
+    try:
+        return payload.decode(charset, errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+def open_attachment_spool(filename, content_type):
+    """
+    Start receiving an attachment. With ATTACHMENT_BUCKET set it is streamed to Cloud Storage
+    in ATTACHMENT_UPLOAD_CHUNK_BYTES chunks (the /tmp filesystem of Cloud Functions is held
+    in memory, so it is never written there); otherwise only its size is counted.
+    """
+    spool = {
+        'filename': filename or 'attachment',
+        'content_type': content_type,
+        'size': 0,
+        'truncated': False,
+        'error': None,
+        'blob': None,
+        'writer': None
+    }
+    if ATTACHMENT_BUCKET.value:
+        try:
+            from firebase_admin import storage
+            initialize_firebase()
+            blob_name = f"inbound_attachments/{uuid.uuid4().hex}/{spool['filename']}"
+            spool['blob'] = storage.bucket(ATTACHMENT_BUCKET.value).blob(blob_name)
+            spool['writer'] = spool['blob'].open('wb', chunk_size=ATTACHMENT_UPLOAD_CHUNK_BYTES,
+                                                 content_type=content_type or None)
+        except Exception as e:
+            print(f"Error starting upload of attachment {spool['filename']}: {str(e)}")
+            spool['error'] = f"Upload failed: {str(e)}"
+    return spool
+
+def write_attachment_spool(spool, data):
+    """
+    Append to an attachment; data past MAX_ATTACHMENT_BYTES is dropped.
+    """
+    spool['size'] += len(data)
+    if spool['size'] > MAX_ATTACHMENT_BYTES:
+        spool['truncated'] = True
+        return
+    if spool['writer'] is None or spool['error']:
+        return
+    try:
+        spool['writer'].write(data)
+    except Exception as e:
+        print(f"Error uploading attachment {spool['filename']}: {str(e)}")
+        spool['error'] = f"Upload failed: {str(e)}"
+
+def close_attachment_spool(spool):
+    """
+    Finish an attachment. An upload is only completed for a whole, decoded attachment; the
+    upload session of an oversized or failed one is left unfinished, so no object is created.
+    
+    Returns:
+      dict: attachment metadata (filename, content_type, size, truncated, and storage_uri or error)
+    """
+    attachment = {key: spool[key] for key in ('filename', 'content_type', 'size', 'truncated')}
+    if spool['writer'] is not None and not spool['truncated'] and not spool['error']:
+        try:
+            spool['writer'].close()
+            attachment['storage_uri'] = f"gs://{spool['blob'].bucket.name}/{spool['blob'].name}"
+        except Exception as e:
+            print(f"Error uploading attachment {spool['filename']}: {str(e)}")
+            spool['error'] = f"Upload failed: {str(e)}"
+    if spool['error']:
+        attachment['error'] = spool['error']
+    return attachment
+
+def parse_header_block(raw_email):
+    """
+    Parse the RFC 5322 header block of a raw email in a single pass.
+    Stops at the first blank line, so the cost depends on the header size, not the message size.
+    Folded (continuation) lines are unfolded and RFC 2047 encoded words are decoded.
+    
+    Returns:
+      dict: header values keyed by lower-case header name (first occurrence wins)
+    """
+    headers = {}
+    current_name = None
+    position = 0
+    length = len(raw_email)
+    
+    while position < length:
+        line_end = raw_email.find('\n', position)
+        if line_end == -1:
+            line_end = length
+        line = raw_email[position:line_end].rstrip('\r')
+        position = line_end + 1
+        
+        # A blank line ends the header block
+        if not line:
+            break
+        
+        # Continuation of the previous header
+        if line[0] in ' \t':
+            if current_name is not None:
+                headers[current_name] += ' ' + line.strip()
+            continue
+        
+        name, separator, value = line.partition(':')
+        if not separator:
+            current_name = None
+            continue
+        name = name.strip().lower()
+        if name in headers:
+            # Keep the first occurrence; ignore continuations of repeated headers
+            current_name = None
+            continue
+        headers[name] = value.strip()
+        current_name = name
+    
+    return {name: decode_header_value(value) for name, value in headers.items()}
+
+def decode_header_value(value):
+    """
+    Decode RFC 2047 encoded words (=?utf-8?b?...?=) in a header value.
+    """
+    if '=?' not in value:
+        return value
+    try:
+        from email.header import decode_header, make_header
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+def prepare_email_body(body, token_budget=None):
+    """
+    Reduce an inbound email body to what the AI needs to read: HTML is converted to text,
+    quoted replies, signatures and legal footers are stripped, and the rest is truncated
+    to the token budget.
+    
+    Parameters:
+      body (str): The email body (plain text or HTML)
+      token_budget (int): (Optional) Maximum estimated tokens, defaults to EMAIL_BODY_TOKEN_BUDGET
+    
+    Returns:
+      tuple: (prepared body, stats dict with original_tokens, tokens and tokens_saved)
+    """
+    body = body or ''
+    original_tokens = estimate_tokens(body)
+    if token_budget is None:
+        token_budget = EMAIL_BODY_TOKEN_BUDGET.value
+    
+    # Forwarded content is what the sender wants handled, so its quote containers are kept
+    forwarded = bool(FORWARDED_MESSAGE_PATTERN.search(body))
+    text = html_to_text(body, keep_quotes=forwarded) if HTML_BODY_PATTERN.search(body) else body
+    stripped = strip_quoted_text(text)
+    # A body that is nothing but quotes (e.g. a bare forward) is kept as is
+    text = stripped if stripped.strip() else text.strip()
+    text = truncate_to_token_budget(text, token_budget)
+    
+    tokens = estimate_tokens(text)
+    return text, {
+        'original_tokens': original_tokens,
+        'tokens': tokens,
+        'tokens_saved': max(original_tokens - tokens, 0)
+    }
+
+def estimate_tokens(text):
+    """
+    Rough token count for budgeting (about CHARS_PER_TOKEN characters per token).
+    """
+    return -(-len(text or '') // CHARS_PER_TOKEN)
+
+def strip_quoted_text(text):
+    """
+    Remove the quoted reply chain, '>' quoted lines, the signature and legal footers from a plain text body.
+    A forwarded message is kept whole from its marker on.
+    """
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    
+    kept = []
+    for index, line in enumerate(lines):
+        if FORWARDED_MESSAGE_PATTERN.match(line):
+            kept.extend(lines[index:])
+            break
+        if _starts_quoted_reply(lines, index):
+            break
+        if line.lstrip().startswith('>'):
+            continue
+        if SIGNATURE_PATTERN.match(line) or _starts_footer(lines, index):
             break
+        kept.append(line)
     
-    if found_header:
-        print(f"Extracted header {header_name}: {header_value}")
-    return header_value
+    text = '\n'.join(line.rstrip() for line in kept)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def _starts_quoted_reply(lines, index):
+    """
+    Whether lines[index] is the attribution line that starts a quoted reply chain.
+    """
+    line = lines[index].strip()
+    if not line:
+        return False
+    if ORIGINAL_MESSAGE_PATTERN.match(line):
+        return True
+    
+    # "On <date>, <name> wrote:" is often wrapped onto a second line
+    if REPLY_ATTRIBUTION_PATTERN.match(line):
+        return True
+    if line.lower().startswith('on ') and index + 1 < len(lines):
+        if REPLY_ATTRIBUTION_PATTERN.match(f"{line} {lines[index + 1].strip()}"):
+            return True
+    
+    # Outlook: "From: ..." followed by "Sent:"/"Date:" within the next few lines, under a
+    # separator line (a forward's header block looks the same, see FORWARDED_MESSAGE_PATTERN)
+    if re.match(r'^\*?From:\*?\s', line):
+        previous = next((lines[i].strip() for i in range(index - 1, -1, -1) if lines[i].strip()), '')
+        if not (SEPARATOR_PATTERN.match(previous) or ORIGINAL_MESSAGE_PATTERN.match(previous)):
+            return False
+        following = lines[index + 1:index + 4]
+        return any(re.match(r'^\s*\*?(Sent|Date):\*?\s', next_line) for next_line in following)
+    return False
+
+def _starts_footer(lines, index):
+    """
+    Whether lines[index] starts a legal footer: a known disclaimer phrasing within
+    FOOTER_MAX_CHARS of the end of the message (before any quoted reply chain).
+    """
+    if not FOOTER_PATTERN.match(lines[index]):
+        return False
+    remaining = 0
+    for next_index in range(index, len(lines)):
+        if next_index > index and _starts_quoted_reply(lines, next_index):
+            break
+        remaining += len(lines[next_index]) + 1
+        if remaining > FOOTER_MAX_CHARS:
+            return False
+    return True
+
+def html_to_text(html, keep_quotes=False):
+    """
+    Convert an HTML body to compact plain text, dropping scripts, styles and (unless
+    keep_quotes is set, e.g. for forwards) quoted reply blocks.
+    """
+    from html.parser import HTMLParser
+    
+    class _TextExtractor(HTMLParser):
+        def __init__(self):
+            super().__init__(convert_charrefs=True)
+            self.parts = []
+            self.skip_tag = None
+            self.skip_depth = 0
+        
+        def handle_starttag(self, tag, attrs):
+            if self.skip_tag:
+                if tag == self.skip_tag:
+                    self.skip_depth += 1
+                return
+            classes = (dict(attrs).get('class') or '').split()
+            quoted = tag == 'blockquote' or any(name in HTML_QUOTE_CLASSES for name in classes)
+            if (tag in HTML_SKIPPED_TAGS and tag != 'blockquote') or (quoted and not keep_quotes):
+                self.skip_tag = tag
+                self.skip_depth = 1
+            elif tag == 'br':
+                self.parts.append('\n')
+            elif tag == 'li':
+                self.parts.append('\n- ')
+            elif tag in HTML_BLOCK_TAGS:
+                self.parts.append('\n')
+        
+        def handle_endtag(self, tag):
+            if self.skip_tag:
+                if tag == self.skip_tag:
+                    self.skip_depth -= 1
+                    if self.skip_depth == 0:
+                        self.skip_tag = None
+                return
+            if tag in HTML_BLOCK_TAGS:
+                self.parts.append('\n')
+        
+        def handle_data(self, data):
+            if not self.skip_tag:
+                self.parts.append(data)
+    
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    
+    text = ''.join(extractor.parts).replace('\xa0', ' ')
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' ?\n ?', '\n', text)
+    return re.sub(r'\n{3,}', '\n\n', text).strip()
+
+def truncate_to_token_budget(text, token_budget):
+    """
+    Cut text to about token_budget tokens, at a paragraph or word boundary where possible.
+    """
+    if token_budget <= 0 or estimate_tokens(text) <= token_budget:
+        return text
+    
+    limit = token_budget * CHARS_PER_TOKEN - len(TRUNCATION_MARKER)
+    cut = text[:limit]
+    boundary = max(cut.rfind('\n\n'), cut.rfind('\n'), cut.rfind(' '))
+    if boundary > limit // 2:
+        cut = cut[:boundary]
+    return cut.rstrip() + TRUNCATION_MARKER
 
 def extract_secretary_id_from_email(email_address, sending_domain):
     """
@@ -151,52 +783,116 @@ def extract_secretary_id_from_email(email_address, sending_domain):
     
 def get_secretary_info(secretary_id, db):
     """
-    Get the AI secretary information from Firestore.
+    Get the AI secretary information from Firestore (through the profile cache).
     """
     try:
-        # Query the AI secretaries collection
-        secretary_ref = db.collection('ai_secretaries').document(secretary_id)
-        secretary_doc = secretary_ref.get()
-        
-        if secretary_doc.exists:
-            return secretary_doc.to_dict()
-        
-        return None
+        return get_secretary_profile(secretary_id, db)
     except Exception as e:
         print(f"Error getting secretary info: {str(e)}")
         return None
 
-def log_task(user_id, secretary_id, task_data, db):
+def inbound_message_key(email_data):
+    """
+    Build the dedupe key for an inbound email.
+    Uses the Message-ID header, falling back to a hash of from/to/subject/body.
+    """
+    message_id = (email_data.get('message_id') or '').strip().strip('<>')
+    if message_id:
+        source = f"mid:{message_id}"
+    else:
+        source = "content:" + "\x1f".join([
+            email_data.get('from', ''),
+            email_data.get('to', ''),
+            email_data.get('subject', ''),
+            email_data.get('text', '') or email_data.get('html', '')
+        ])
+    # Hashed so the key is always a valid Firestore document ID
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+def _remember_message_key(key):
+    with _recent_message_keys_lock:
+        _recent_message_keys[key] = True
+        _recent_message_keys.move_to_end(key)
+        while len(_recent_message_keys) > RECENT_MESSAGE_IDS_MAX:
+            _recent_message_keys.popitem(last=False)
+
+def is_duplicate_inbound_message(email_data, db):
+    """
+    Check the in-memory recent-key LRU for an email this instance already queued.
+    Only a shortcut: the task document itself is the claim (see log_inbound_task).
+    
+    Returns:
+      bool: True for a known duplicate
+    """
+    key = inbound_message_key(email_data)
+    DEDUPE_STATS['checked'] += 1
+    
+    with _recent_message_keys_lock:
+        seen_in_memory = key in _recent_message_keys
+    if seen_in_memory:
+        DEDUPE_STATS['suppressed_memory'] += 1
+        _record_suppressed_duplicate(db, 'memory')
+    return seen_in_memory
+
+def log_inbound_task(email_data, user_id, secretary_id, task_data, db):
     """
-    Log the task in Firestore task history.
-    Returns the task ID.
+    Log an inbound email's task with its dedupe key (see inbound_message_key) as the document
+    ID. create() fails if the task already exists, so SendGrid retries of a queued email are
+    dropped, while a delivery that failed before its task was written is processed on retry.
+    
+    Returns:
+      tuple: (task ID, or None if the task couldn't be written; True if the email is a duplicate)
     """
+    from google.api_core.exceptions import AlreadyExists
+    key = inbound_message_key(email_data)
+    task_data.update({
+        'user_id': user_id,
+        'secretary_id': secretary_id
+    })
     try:
-        # Create a new task entry
-        task_ref = db.collection('task_history').document()
-        
-        # Add user and secretary IDs
-        task_data.update({
-            'user_id': user_id,
-            'secretary_id': secretary_id
-        })
-        
-        # Save to Firestore
-        task_ref.set(task_data)
-            
-        return task_ref.id
+        with firestore_span('create', 'task_history'):
+            db.collection('task_history').document(key).create(task_data)
+    except AlreadyExists:
+        _remember_message_key(key)
+        DEDUPE_STATS['suppressed_firestore'] += 1
+        _record_suppressed_duplicate(db, 'firestore')
+        return None, True
     except Exception as e:
         print(f"Error logging task: {str(e)}")
-        return None
+        return None, False
+    
+    _remember_message_key(key)
+    return key, False
+
+def _record_suppressed_duplicate(db, source):
+    """
+    Count a suppressed duplicate in the metrics/inbound_dedupe document.
+    """
+    from firebase_admin import firestore
+    print(f"Suppressed duplicate inbound email ({source}), stats: {DEDUPE_STATS}")
+    try:
+        with firestore_span('set', 'metrics'):
+            db.collection('metrics').document('inbound_dedupe').set({
+                'duplicates_suppressed': firestore.Increment(1),
+                f'suppressed_{source}': firestore.Increment(1)
+            }, merge=True)
+    except Exception as e:
+        print(f"Error recording dedupe metrics: {str(e)}")
 
 def send_email_response(to_email, from_email, subject, content, message_id=None, references=None, domain=None):
     """
-    Send an email response using SendGrid.
-    Threading headers temporarily disabled for demo.
+    Send an email response using SendGrid, threaded under the email it answers: the reply
+    gets its own Message-ID, In-Reply-To is the answered email's Message-ID, and References
+    is the answered email's References followed by its Message-ID.
+    
+    Returns:
+      str or None: the Message-ID of the sent email, or None if sending failed
     """
+    from email.utils import make_msgid
+    from sendgrid.helpers.mail import Mail, Content, Header # type: ignore
     try:
-        # Create SendGrid client inside the function
-        sg = sendgrid.SendGridAPIClient(api_key=SENDGRID_API_KEY.value)
+        # Reuse the instance's keep-alive SendGrid client
+        sg = get_sendgrid_client(SENDGRID_API_KEY.value)
         
         # Extract the local part (before @) from the from_email
         local_part = from_email.split('@')[0]
@@ -216,16 +912,28 @@ def send_email_response(to_email, from_email, subject, content, message_id=None,
         # But use standard Email object creation to avoid errors
         message.reply_to = from_email
         
+        # Threading headers, so replies to this email can be matched to the thread
+        outgoing_message_id = make_msgid(domain=domain)
+        threading_headers = [Header('Message-ID', outgoing_message_id)]
+        if message_id and message_id.strip():
+            answered_id = f"<{message_id.strip().strip('<>')}>"
+            threading_headers.append(Header('In-Reply-To', answered_id))
+            threading_headers.append(Header('References', ' '.join(parse_message_ids(references) + [answered_id])))
+        message.header = threading_headers
+        
         # Send email
-        response = sg.send(message)
+        with span('sendgrid.send', {'http.request.method': 'POST', 'url.path': '/v3/mail/send'}) as send_span:
+            response = sg.post("/v3/mail/send", json=message.get())
+            send_span.set_attribute('http.response.status_code', response.status_code)
+            response.raise_for_status()
         
         # Log the response code
         print(f"SendGrid response code: {response.status_code}")
         
-        return True
+        return outgoing_message_id
     except Exception as e:
         print(f"Error sending email: {str(e)}")
-        return False
+        return None
     
 def format_email_response(text):
     """
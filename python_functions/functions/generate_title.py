@@ -1,9 +1,11 @@
 from flask import Request, Response
 from firebase_functions import https_fn
 import json
+import re
 from firebase_functions import https_fn, options
-import anthropic
 from firebase_functions.params import StringParam
+from clients import get_anthropic_client
+from tracing import model_span, record_model_usage
 
 CLAUDE_API_KEY = StringParam('CLAUDE_API_KEY')
 
@@ -44,8 +46,8 @@ def generate_title(request: Request) -> Response:
         else:
             backend_model = model
             
-        # Initialize Anthropic client
-        client = anthropic.Anthropic(api_key=CLAUDE_API_KEY.value)
+        # Reuse the instance's Anthropic client
+        client = get_anthropic_client(CLAUDE_API_KEY.value)
         
         # Create system message for title generation
         system_message = """You are a title generation assistant. Your task is to create short, descriptive titles (max 50 characters) for conversations. The title should be concise and reflect the main topic or purpose of the conversation. Return only the title, no additional text or explanation."""
@@ -54,15 +56,17 @@ def generate_title(request: Request) -> Response:
         user_message = f"""Generate a short, descriptive title for a conversation that starts with this message: "{message}". The title should be concise and reflect the main topic or purpose of the conversation. Return only the title, no additional text."""
         
         # Call Claude API
-        response = client.messages.create(
-            model=backend_model,
-            max_tokens=100,
-            system=system_message,
-            messages=[{
-                "role": "user",
-                "content": user_message
-            }]
-        )
+        with model_span(backend_model, 'title') as model_call:
+            response = client.messages.create(
+                model=backend_model,
+                max_tokens=100,
+                system=system_message,
+                messages=[{
+                    "role": "user",
+                    "content": user_message
+                }]
+            )
+            record_model_usage(model_call, response.usage)
         
         # Extract the title from the response
         title = ""
@@ -72,8 +76,8 @@ def generate_title(request: Request) -> Response:
                 
         # Clean up the title
         title = title.strip()
-        title = title.replace(/["']/g, "")
-        title = title.replace(/[*_`]/g, "")
+        title = re.sub(r"[\"']", "", title)
+        title = re.sub(r"[*_`]", "", title)
         title = title[:50]  # Ensure it's not too long
         
         return Response(
@@ -1,27 +1,19 @@
 from flask import Request, Response
 from firebase_functions import https_fn
 import json
-from firebase_functions import https_fn, options
-from firebase_admin import credentials, firestore
-import firebase_admin
+from firebase_functions import https_fn, options, firestore_fn, scheduler_fn
 from firebase_functions.params import StringParam
-from email_utils import parse_sendgrid_inbound_email, extract_secretary_id_from_email, get_secretary_info, log_task, send_email_response
-from ai_utils import process_with_ai
+from email_utils import parse_sendgrid_inbound_email, extract_secretary_id_from_email, get_secretary_info, log_inbound_task, is_duplicate_inbound_message
+from email_pipeline import enqueue_email_task, process_email_task, run_stale_email_tasks, EMAIL_PIPELINE_MODE, EMAIL_WORKER_MAX_INSTANCES, EMAIL_WORKER_TIMEOUT_SECONDS
 import logging
+import time
 from typing import Dict, Any
-import anthropic 
-from ai_utils import process_with_claude  # Reuse your existing function
-
-# Initialize Firebase Admin SDK
-try:
-    cred = credentials.Certificate("starlis_admin_creds.json")
-    firebase_admin.initialize_app(cred)
-except ValueError:
-    # App already initialized
-    pass
-
-# Initialize Firestore
-db = firestore.client()
+from ai_utils import process_with_claude, iter_claude_events  # Reuse your existing function
+from clients import get_anthropic_client, get_db, initialize_firebase
+from profile_cache import get_user_profile, put_cached_document
+from thread_memory import chat_thread_key, load_thread, append_turns
+from tracing import traced, span, firestore_span
+from usage_accounting import UsageLedger
 
 SENDING_DOMAIN = StringParam('SENDING_DOMAIN', 'starlis.com')
 CLAUDE_API_KEY_2 = StringParam('CLAUDE_API_KEY_2')
@@ -69,10 +61,12 @@ def create_ai_secretary_email(request: Request) -> Response:
         if not user_id:
             return Response("Missing user_id", status=400)
         
-        user_ref = db.collection('users').document(user_id)
-        if not user_ref.get().exists:
+        from firebase_admin import firestore
+        db = get_db()
+        
+        user_doc = get_user_profile(user_id, db)
+        if not user_doc:
             return Response("User not found", status=404)
-        user_doc = user_ref.get()
         user_full_name = user_doc.get('firstName') + ' ' + user_doc.get('lastName')
         user_email = user_doc.get('email')
         
@@ -96,7 +90,13 @@ def create_ai_secretary_email(request: Request) -> Response:
         }
         
         # Save to Firestore
-        db.collection('ai_secretaries').document(secretary_id).set(secretary_data)
+        with firestore_span('set', 'ai_secretaries'):
+            db.collection('ai_secretaries').document(secretary_id).set(secretary_data)
+        
+        # Write through to the profile cache (without the server timestamp sentinel)
+        put_cached_document('ai_secretaries', secretary_id, {
+            key: value for key, value in secretary_data.items() if key != 'created_at'
+        })
         
         # Return the email address and secretary ID
         return Response(
@@ -129,6 +129,7 @@ def generate_unique_id(length=8):
         cors_methods=["GET", "POST"]
     )
 )
+@traced('email.webhook', flush=True)
 def process_sendgrid_inbound_email(request: Request) -> Response:
     """
     Process incoming emails from SendGrid's Inbound Parse webhook.
@@ -140,15 +141,35 @@ def process_sendgrid_inbound_email(request: Request) -> Response:
     Function will:
     1. Parse the incoming email
     2. Identify which AI secretary should handle it
-    3. Log the request in Firestore
-    4. Process with AI
-    5. Send a response email
+    3. Log the request in Firestore as a queued task, keyed by its dedupe key so
+       duplicate deliveries are dropped
+    4. Acknowledge the webhook right away
+    
+    Processing with AI and sending the response happen in process_email_task_worker,
+    so SendGrid does not time out and retry while Claude is working.
     """
     try:
+        from firebase_admin import firestore
+        db = get_db()
+        
         # Parse the incoming email from SendGrid's webhook
-        email_data = parse_sendgrid_inbound_email(request)
+        parse_start = time.perf_counter()
+        with span('email.parse', {'http.request.body.size': request.content_length}) as parse_span:
+            email_data = parse_sendgrid_inbound_email(request)
+            if email_data:
+                parse_span.set_attributes({
+                    'email.attachments': len(email_data.get('attachments', [])),
+                    'email.truncated': bool(email_data.get('truncated'))
+                })
         if not email_data:
             return Response("Invalid email data", status=400)
+        parse_ms = round((time.perf_counter() - parse_start) * 1000)
+        
+        # SendGrid retries deliveries; acknowledge duplicates without processing them again.
+        # Nothing is recorded until the task is written, so a delivery that fails before
+        # then is processed when SendGrid retries it.
+        if is_duplicate_inbound_message(email_data, db):
+            return Response("Duplicate email ignored", status=200)
         
         # Extract relevant information
         to_address = email_data.get('to', '')
@@ -161,6 +182,7 @@ def process_sendgrid_inbound_email(request: Request) -> Response:
         # Extract message ID and references for threading
         message_id = email_data.get('message_id')
         references = email_data.get('references')
+        in_reply_to = email_data.get('in_reply_to')
         
         # Get the AI secretary ID from the email address
         ai_secretary_id = extract_secretary_id_from_email(to_address, SENDING_DOMAIN.value)
@@ -174,8 +196,8 @@ def process_sendgrid_inbound_email(request: Request) -> Response:
             print(f"No secretary found with ID: {ai_secretary_id}")
             return Response("Secretary not found", status=404)
         
-        # Log the incoming email in task history
-        task_id = log_task(secretary_info['user_id'], ai_secretary_id, {
+        # Log the incoming email in task history; the worker picks it up from there
+        task_id, duplicate = log_inbound_task(email_data, secretary_info['user_id'], ai_secretary_id, {
             'type': 'email',
             'from': from_address,
             'to': to_address,
@@ -183,43 +205,66 @@ def process_sendgrid_inbound_email(request: Request) -> Response:
             'body': text_content or html_content,  # Store the body for history
             'message_id': message_id,
             'references': references,
+            'in_reply_to': in_reply_to,
+            'routing_headers': email_data.get('routing_headers', {}),
+            'attachments': email_data.get('attachments', []),
+            'truncated': email_data.get('truncated', False),
             'received_at': firestore.SERVER_TIMESTAMP,
-            'status': 'received'
+            'enqueued_at': time.time(),
+            'timings': {'parse_ms': parse_ms},
+            'status': 'queued'
         }, db)
-
-        # Process the email with AI and get response
-        response_content, debug_logs = process_with_ai(
-            secretary_info=secretary_info,
-            from_address=from_address,
-            subject=subject,
-            body=text_content or html_content,
-            task_id=task_id
-        )
+        if duplicate:
+            return Response("Duplicate email ignored", status=200)
+        if not task_id:
+            return Response("Error logging email", status=500)
         
-        # Print debug logs
-        print("=== DEBUG LOGS START ===")
-        for i, log in enumerate(debug_logs):
-            print(f"[{i}] {log}")
-        print("=== DEBUG LOGS END ===")
+        enqueue_email_task(task_id, db, SENDING_DOMAIN.value)
         
-        # Send the response email with thread headers
-        send_email_response(
-            to_email=from_address,
-            from_email=to_address,
-            subject=f"Re: {subject}",
-            content=response_content,
-            message_id=message_id,
-            references=references, 
-            domain=SENDING_DOMAIN.value
-        )
-        
-        return Response("Email processed successfully", status=200)
+        return Response("Email queued for processing", status=200)
     
     except Exception as e:
         print(f"Error processing email: {str(e)}")
         return Response(f"Error processing email: {str(e)}", status=500)
 
+@firestore_fn.on_document_created(
+    document="task_history/{task_id}",
+    max_instances=EMAIL_WORKER_MAX_INSTANCES,
+    concurrency=1,
+    timeout_sec=EMAIL_WORKER_TIMEOUT_SECONDS
+)
+def process_email_task_worker(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]) -> None:
+    """
+    Background worker for emails queued by process_sendgrid_inbound_email.
+    Runs the AI tool loop and sends the response email.
+    """
+    if event.data is None:
+        return
+    
+    task_data = event.data.to_dict() or {}
+    if task_data.get('type') != 'email' or task_data.get('status') != 'queued':
+        return
+    
+    # In local mode the in-process queue already owns the task
+    if EMAIL_PIPELINE_MODE.value == 'local':
+        return
+    
+    process_email_task(event.params['task_id'], get_db(), SENDING_DOMAIN.value)
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes", timeout_sec=EMAIL_WORKER_TIMEOUT_SECONDS + 60)
+def reclaim_stale_email_tasks(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Run again the email tasks whose worker crashed or timed out after claiming them.
+    """
+    if EMAIL_PIPELINE_MODE.value == 'local':
+        return
+    
+    task_ids = run_stale_email_tasks(get_db(), SENDING_DOMAIN.value)
+    if task_ids:
+        print(f"Ran {len(task_ids)} stale email tasks: {task_ids}")
+
 @https_fn.on_call()
+@traced('chat.message', flush=True)
 def process_claude_message(req: https_fn.CallableRequest) -> Dict[str, Any]:
     """
     Process messages using Claude API, leveraging existing tools infrastructure
@@ -228,7 +273,8 @@ def process_claude_message(req: https_fn.CallableRequest) -> Dict[str, Any]:
     {
         "messages": [{"role": "user"|"assistant"|"system", "content": string}],
         "model": "claude-3-7-sonnet-latest"|"claude-3-5-haiku-latest",
-        "userId": string
+        "userId": string,
+        "conversationId": string  (optional; earlier messages then come from the thread memory)
     }
     """
     try:
@@ -236,6 +282,7 @@ def process_claude_message(req: https_fn.CallableRequest) -> Dict[str, Any]:
         messages = data.get("messages", [])
         model = data.get("model", "claude-3-7-sonnet-latest")
         user_id = data.get("userId")
+        conversation_id = data.get("conversationId")
         
         if not user_id:
             return {"error": "Missing userId in request"}
@@ -253,37 +300,179 @@ def process_claude_message(req: https_fn.CallableRequest) -> Dict[str, Any]:
         else:
             backend_model = model  # Fallback to whatever was provided
             
-        # Format the conversation content for process_with_claude
-        # Create a single content string that Claude can process
-        conversation_content = ""
-        for msg in messages:
-            role = msg.get("role", "")
-            content = msg.get("content", "")
-            conversation_content += f"\n\n{role.upper()}: {content}"
+        # Earlier turns go to Claude as real turns, so they are cached across requests
+        conversation, thread_key, new_messages = prepare_chat_conversation(messages, user_id, conversation_id)
         
-        # Initialize Anthropic client
-        client = anthropic.Anthropic(api_key=CLAUDE_API_KEY_2.value)
+        # Reuse the instance's Anthropic client
+        client = get_anthropic_client(CLAUDE_API_KEY_2.value)
         
         # Process with existing function
+        usage = UsageLedger(user_id)
         result, logs = process_with_claude(
             client=client,
-            email_content=conversation_content,
-            user_id=user_id
+            email_content=conversation,
+            user_id=user_id,
+            usage=usage
         )
-        
-        # Extract the result content
-        if isinstance(result, dict) and "email_response" in result:
-            response_content = result["email_response"]
-        elif isinstance(result, str):
-            response_content = result
-        else:
-            response_content = "I'm sorry, there was an error processing your request."
+        content = extract_response_content(result)
+        remember_chat_turn(thread_key, new_messages, content, client, user_id, usage)
+        usage.flush()
         
         # Return in the format expected by the frontend
         return {
-            "content": response_content
+            "content": content
         }
         
     except Exception as e:
         logging.error(f"Error in process_claude_message: {str(e)}")
         return {"error": f"Failed to process message: {str(e)}"}
+
+@https_fn.on_request(
+    cors=options.CorsOptions(
+        cors_origins=["*"],
+        cors_methods=["POST"]
+    )
+)
+def stream_claude_message(request: Request) -> Response:
+    """
+    Streaming variant of process_claude_message using server-sent events.
+    The caller is identified by a Firebase ID token in an "Authorization: Bearer <token>"
+    header; the user id comes from the token.
+    
+    Expected request data:
+    {
+        "data": {
+            "messages": [{"role": "user"|"assistant"|"system", "content": string}],
+            "model": "claude-3-7-sonnet-latest"|"claude-3-5-haiku-latest",
+            "userId": string  (optional; must match the token's user),
+            "conversationId": string  (optional, as in process_claude_message)
+        }
+    }
+    
+    Emits these events as they happen:
+    - text: {"text": string}  (text deltas from Claude)
+    - email_delta: {"text": string}  (deltas of the final response)
+    - tool: {"name": string, "status": "running"|"done", "label": string}
+    - result: {"content": string}  (same content process_claude_message returns)
+    - error: {"error": string}
+    """
+    if request.method != 'POST':
+        return Response("Method not allowed", status=405)
+    
+    user_id = get_request_user_id(request)
+    if not user_id:
+        return Response(json.dumps({"error": "Missing or invalid ID token"}), status=401, mimetype='application/json')
+    
+    data = (request.get_json(silent=True) or {}).get('data') or {}
+    messages = data.get("messages", [])
+    conversation_id = data.get("conversationId")
+    
+    if data.get("userId") and data["userId"] != user_id:
+        return Response(json.dumps({"error": "userId does not match the signed-in user"}), status=403, mimetype='application/json')
+    if not messages:
+        return Response(json.dumps({"error": "No messages provided"}), status=400, mimetype='application/json')
+    
+    usage = UsageLedger(user_id)
+    
+    def generate():
+        try:
+            conversation, thread_key, new_messages = prepare_chat_conversation(messages, user_id, conversation_id)
+            client = get_anthropic_client(CLAUDE_API_KEY_2.value)
+            for event in iter_claude_events(client, conversation, user_id, stream=True, usage=usage):
+                if event["type"] == "result":
+                    content = extract_response_content(event["result"])
+                    yield format_sse("result", {"content": content})
+                    remember_chat_turn(thread_key, new_messages, content, client, user_id, usage)
+                else:
+                    event_type = event.pop("type")
+                    yield format_sse(event_type, event)
+        except Exception as e:
+            logging.error(f"Error in stream_claude_message: {str(e)}")
+            yield format_sse("error", {"error": f"Failed to process message: {str(e)}"})
+        finally:
+            usage.flush()
+    
+    return Response(
+        generate(),
+        status=200,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Keep proxies from buffering the stream
+        }
+    )
+
+def get_request_user_id(request):
+    """
+    The Firebase user id of an HTTP request's "Authorization: Bearer <ID token>" header.
+    
+    Returns:
+      str or None: the token's uid, or None if the header is missing or the token is invalid
+    """
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    from firebase_admin import auth
+    try:
+        initialize_firebase()
+        return auth.verify_id_token(header[len('Bearer '):])['uid']
+    except Exception as e:
+        logging.warning(f"Rejected ID token: {str(e)}")
+        return None
+
+def prepare_chat_conversation(messages, user_id, conversation_id=None):
+    """
+    Build the message list for a chat request. With a conversation id, only the messages
+    the thread memory hasn't stored yet are taken from the request; earlier turns come from
+    the thread's recent turns, and older ones from its rolling summary (sent as a system
+    message), so the prompt stays bounded.
+    
+    Returns:
+      tuple: (chat messages for process_with_claude, thread key or None, messages new to the thread)
+    """
+    thread_key = chat_thread_key(user_id, conversation_id)
+    if not thread_key:
+        return messages, None, messages
+    
+    # System messages are resent with every request and never stored
+    system_messages = [msg for msg in messages if msg.get("role") == "system"]
+    chat_messages = [msg for msg in messages if msg.get("role") != "system"]
+    
+    thread = load_thread(thread_key)
+    stored = thread.get('turn_count', 0)
+    # The client resends the whole conversation; if it has fewer messages than were stored
+    # (edited or restarted), only the latest message is treated as new
+    new_messages = chat_messages[stored:] if len(chat_messages) > stored else chat_messages[-1:]
+    
+    summary = []
+    if thread.get('summary'):
+        summary = [{"role": "system", "content": f"Summary of earlier messages in this conversation:\n{thread['summary']}"}]
+    return system_messages + summary + thread.get('turns', []) + new_messages, thread_key, new_messages
+
+def remember_chat_turn(thread_key, new_messages, content, client, user_id, usage=None):
+    """
+    Store a chat request's new messages and the reply in the thread memory.
+    Failures are logged; the reply has already been produced.
+    """
+    if not thread_key:
+        return
+    try:
+        append_turns(thread_key, new_messages + [{"role": "assistant", "content": content}], client, user_id, usage=usage)
+    except Exception as e:
+        logging.error(f"Error updating thread memory {thread_key}: {str(e)}")
+
+def extract_response_content(result):
+    """
+    Pull the text shown in the chat out of a process_with_claude result.
+    """
+    if isinstance(result, dict) and "email_response" in result:
+        return result["email_response"]
+    elif isinstance(result, str):
+        return result
+    return "I'm sorry, there was an error processing your request."
+
+def format_sse(event_type, payload):
+    """
+    Format one server-sent event.
+    """
+    return f"event: {event_type}\ndata: {json.dumps(payload)}\n\n"
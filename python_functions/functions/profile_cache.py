@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import OrderedDict
+from firebase_functions.params import BoolParam
+from clients import get_db
+from tracing import firestore_span
+
+# Profile cache settings. Only writes made through put_cached_document on this instance
+# (e.g. create_ai_secretary_email) update the cache; without listeners, edits made anywhere
+# else (the app, the console, other instances) are served stale for up to the TTL.
+PROFILE_CACHE_TTL_SECONDS = 300  # How long a cached document is served without re-reading it
+PROFILE_CACHE_MAX_SIZE = 500  # Maximum number of cached documents per instance
+
+# Keep cached documents current with Firestore on_snapshot listeners (one per cached document)
+PROFILE_CACHE_LISTENERS = BoolParam('PROFILE_CACHE_LISTENERS', default=False)
+
+# Cached documents keyed by (collection, document_id), oldest first: (data, expires_at)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_watches = {}
+
+CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'invalidations': 0
+}
+
+def get_cached_document(collection, document_id, db=None):
+    """
+    Read-through cache for small, rarely changing documents (users, ai_secretaries).
+
+    Parameters:
+      collection (str): Firestore collection name
+      document_id (str): Document ID
+      db: (Optional) Firestore client, defaults to the shared client
+
+    Returns:
+      dict or None: a copy of the document data, or None if the document does not exist
+    """
+    key = (collection, document_id)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached and cached[1] > now:
+            _cache.move_to_end(key)
+            CACHE_STATS['hits'] += 1
+            return dict(cached[0])
+        CACHE_STATS['misses'] += 1
+
+    db = db or get_db()
+    doc_ref = db.collection(collection).document(document_id)
+    with firestore_span('get', collection):
+        snapshot = doc_ref.get()
+    if not snapshot.exists:
+        return None
+
+    data = snapshot.to_dict()
+    put_cached_document(collection, document_id, data)
+    if PROFILE_CACHE_LISTENERS.value:
+        _watch(key, doc_ref)
+    return dict(data)
+
+def peek_cached_document(collection, document_id):
+    """
+    The cached document data if it is in memory and fresh, without ever reading Firestore.
+
+    Returns:
+      dict or None: a copy of the document data, or None if it isn't cached
+    """
+    with _cache_lock:
+        cached = _cache.get((collection, document_id))
+        if cached and cached[1] > time.monotonic():
+            return dict(cached[0])
+    return None
+
+def put_cached_document(collection, document_id, data):
+    """
+    Write-through: store a document the caller just wrote (or received from a listener).
+    """
+    key = (collection, document_id)
+    evicted_watches = []
+    with _cache_lock:
+        _cache[key] = (dict(data), time.monotonic() + PROFILE_CACHE_TTL_SECONDS)
+        _cache.move_to_end(key)
+        while len(_cache) > PROFILE_CACHE_MAX_SIZE:
+            evicted, _ = _cache.popitem(last=False)
+            evicted_watches.append(_watches.pop(evicted, None))
+    # Unsubscribing waits on the listener thread, which may itself be waiting for _cache_lock
+    for watch in evicted_watches:
+        _unwatch(watch)
+
+def invalidate_cached_document(collection, document_id):
+    """
+    Drop a document from the cache so the next read goes to Firestore.
+    """
+    with _cache_lock:
+        if _cache.pop((collection, document_id), None) is not None:
+            CACHE_STATS['invalidations'] += 1
+
+def get_user_profile(user_id, db=None):
+    """Returns the users/{user_id} document data, or None."""
+    return get_cached_document('users', user_id, db)
+
+def get_secretary_profile(secretary_id, db=None):
+    """Returns the ai_secretaries/{secretary_id} document data, or None."""
+    return get_cached_document('ai_secretaries', secretary_id, db)
+
+def _watch(key, doc_ref):
+    """
+    Start an on_snapshot listener that keeps a cached document current.
+    Listener threads only run while the instance has CPU, so the TTL still bounds staleness.
+    """
+    with _cache_lock:
+        if key in _watches:
+            return
+        _watches[key] = None
+
+    def on_snapshot(snapshots, changes, read_time):
+        for snapshot in snapshots:
+            if snapshot.exists:
+                put_cached_document(key[0], key[1], snapshot.to_dict())
+            else:
+                invalidate_cached_document(key[0], key[1])
+
+    try:
+        watch = doc_ref.on_snapshot(on_snapshot)
+    except Exception as e:
+        print(f"Error starting profile listener for {key}: {e}")
+        with _cache_lock:
+            _watches.pop(key, None)
+        return
+
+    with _cache_lock:
+        if key in _watches:
+            _watches[key] = watch
+            return
+    # Evicted while the listener was starting
+    _unwatch(watch)
+
+def _unwatch(watch):
+    """
+    Stop the listener of an evicted document (None while it is still starting). Must be
+    called without _cache_lock held.
+    """
+    if watch is None:
+        return
+    try:
+        watch.unsubscribe()
+    except Exception as e:
+        print(f"Error stopping profile listener: {e}")
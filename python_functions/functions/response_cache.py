@@ -0,0 +1,200 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from firebase_functions.params import BoolParam
+from calendar_index import calendar_version
+
+# Answer near-identical emails to the same secretary from earlier responses (opt-in)
+RESPONSE_CACHE = BoolParam('RESPONSE_CACHE', default=False)
+
+# Response cache settings
+RESPONSE_CACHE_TTL_SECONDS = 1800  # Entries older than this are never replayed
+RESPONSE_CACHE_MAX_SECRETARIES = 100  # Secretaries with cached responses per instance
+RESPONSE_CACHE_MAX_ENTRIES = 50  # Responses kept per secretary, newest first
+RESPONSE_CACHE_MIN_SIMILARITY = 0.9  # Estimated Jaccard similarity for a near-identical email
+RESPONSE_CACHE_CALENDAR_MAX_AGE_SECONDS = 300  # Calendar index syncs older than this can't vouch for a cached response
+MINHASH_PERMUTATIONS = 64
+SHINGLE_WORDS = 3  # Words per shingle
+
+# Responses can only be replayed for emails with the same times, dates, numbers and addresses
+SIGNIFICANT_TOKEN_PATTERN = re.compile(
+    r'\d+(?::\d+)?|\b(?:mon|tues|wednes|thurs|fri|satur|sun)day\b|'
+    r'\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\b|\S+@\S+|\b(?:today|tomorrow|tonight|next|this)\b'
+)
+SUBJECT_PREFIX_PATTERN = re.compile(r'^\s*((re|fwd?|aw)\s*:\s*)+', re.IGNORECASE)
+
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_SEEDS = [
+    (int.from_bytes(hashlib.sha256(f"a{i}".encode()).digest()[:8], 'big') % (MINHASH_PRIME - 1) + 1,
+     int.from_bytes(hashlib.sha256(f"b{i}".encode()).digest()[:8], 'big') % MINHASH_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+# Entries per secretary_id, least recently used first
+_entries = OrderedDict()
+_entries_lock = threading.Lock()
+
+# Per-secretary counters on this instance
+RESPONSE_CACHE_STATS = {}
+
+def lookup_response(secretary_info, from_address, subject, body, thread_context=''):
+    """
+    Find a cached response for an email: the same normalized email first, then a
+    near-identical one (MinHash over word shingles). Entries are only replayed while the
+    user's calendar is unchanged, and responses that mention their original sender are
+    only replayed to that sender. Emails that continue a thread are never cached.
+    The calendar version comes from the in-memory index without syncing it; when the index
+    isn't in memory or its last sync is older than RESPONSE_CACHE_CALENDAR_MAX_AGE_SECONDS,
+    the email isn't cached.
+
+    Returns:
+      tuple: (cached entry or None, probe for store_response, or None if the email can't be cached)
+    """
+    secretary_id = secretary_info.get('secretary_id')
+    if not RESPONSE_CACHE.value or not secretary_id or thread_context:
+        return None, None
+
+    started = time.perf_counter()
+    version = calendar_version(secretary_info.get('user_id', ''), RESPONSE_CACHE_CALENDAR_MAX_AGE_SECONDS)
+    if version is None:
+        return None, None
+
+    text = normalize_email(subject, body)
+    probe = {
+        'secretary_id': secretary_id,
+        'config': _secretary_config_hash(secretary_info),
+        'digest': hashlib.sha256(text.encode('utf-8')).hexdigest(),
+        'signature': minhash_signature(text),
+        'tokens': significant_tokens(text),
+        'calendar_version': version,
+        'day': date.today().isoformat(),
+        'from': (from_address or '').lower()
+    }
+
+    now = time.monotonic()
+    best, best_kind, best_similarity = None, None, 0.0
+    stale = 0
+    with _entries_lock:
+        entries = _entries.get(secretary_id, [])
+        for entry in entries:
+            if not _entry_is_current(entry, probe, now):
+                stale += 1
+                continue
+            if entry['from'] != probe['from'] and _mentions_sender(entry['email_response'], entry['from']):
+                continue
+            if entry['digest'] == probe['digest']:
+                best, best_kind, best_similarity = entry, 'exact', 1.0
+                break
+            if entry['tokens'] != probe['tokens']:
+                continue
+            similarity = signature_similarity(entry['signature'], probe['signature'])
+            if similarity >= RESPONSE_CACHE_MIN_SIMILARITY and similarity > best_similarity:
+                best, best_kind, best_similarity = entry, 'similar', similarity
+        if entries:
+            _entries[secretary_id] = [entry for entry in entries if _entry_is_current(entry, probe, now)]
+            _entries.move_to_end(secretary_id)
+
+        stats = _secretary_stats(secretary_id)
+        stats['lookups'] += 1
+        stats['invalidated'] += stale
+        if best is None:
+            return None, probe
+        stats[f'{best_kind}_hits'] += 1
+        stats['latency_saved_ms'] += best['latency_ms']
+
+    hit = {
+        'email_response': best['email_response'],
+        'reasoning': best['reasoning'],
+        'kind': best_kind,
+        'similarity': round(best_similarity, 3),
+        'latency_saved_ms': best['latency_ms'],
+        'lookup_ms': round((time.perf_counter() - started) * 1000)
+    }
+    print(f"Response cache {best_kind} hit for secretary {secretary_id}, stats: {RESPONSE_CACHE_STATS[secretary_id]}")
+    return hit, probe
+
+def store_response(probe, email_response, reasoning, latency_ms, mutated):
+    """
+    Cache a response for a probe from lookup_response. Responses from runs that changed the
+    calendar are never stored, so a cached answer can't stand in for a calendar change.
+    """
+    if probe is None or mutated or not email_response:
+        return
+    entry = dict(probe)
+    entry.update({
+        'email_response': email_response,
+        'reasoning': reasoning,
+        'latency_ms': round(latency_ms),
+        'stored_at': time.monotonic()
+    })
+    secretary_id = probe['secretary_id']
+    with _entries_lock:
+        entries = [existing for existing in _entries.get(secretary_id, []) if existing['digest'] != entry['digest']]
+        _entries[secretary_id] = [entry] + entries[:RESPONSE_CACHE_MAX_ENTRIES - 1]
+        _entries.move_to_end(secretary_id)
+        while len(_entries) > RESPONSE_CACHE_MAX_SECRETARIES:
+            _entries.popitem(last=False)
+        _secretary_stats(secretary_id)['stores'] += 1
+
+def normalize_email(subject, body):
+    """
+    Lower-case subject (without Re:/Fwd: prefixes) and body with whitespace collapsed.
+    """
+    subject = SUBJECT_PREFIX_PATTERN.sub('', subject or '')
+    return re.sub(r'\s+', ' ', f"{subject}\n{body or ''}").strip().lower()
+
+def significant_tokens(text):
+    return sorted(set(SIGNIFICANT_TOKEN_PATTERN.findall(text)))
+
+def minhash_signature(text):
+    """
+    MinHash signature of the text's word shingles (the whole text when it is shorter than a shingle).
+    """
+    words = re.findall(r'\w+', text)
+    shingles = {' '.join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))}
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big') for shingle in shingles]
+    return [min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in MINHASH_SEEDS]
+
+def signature_similarity(first, second):
+    """
+    Estimated Jaccard similarity: the share of matching MinHash positions.
+    """
+    return sum(1 for a, b in zip(first, second) if a == b) / MINHASH_PERMUTATIONS
+
+def _entry_is_current(entry, probe, now):
+    return (
+        now - entry['stored_at'] < RESPONSE_CACHE_TTL_SECONDS
+        and entry['calendar_version'] == probe['calendar_version']
+        and entry['config'] == probe['config']
+        and entry['day'] == probe['day']
+    )
+
+def _mentions_sender(response, from_address):
+    """
+    Whether a response names its sender (display name words or the address's local part).
+    """
+    match = re.match(r'\s*"?([^"<]*?)"?\s*<([^>]+)>', from_address)
+    name, address = (match.group(1), match.group(2)) if match else ('', from_address)
+    names = [word for word in re.findall(r'[a-z]+', name) if len(word) > 2]
+    names.append(address.split('@')[0])
+    response = response.lower()
+    return any(re.search(rf'\b{re.escape(word)}\b', response) for word in names if word)
+
+def _secretary_config_hash(secretary_info):
+    config = "\x1f".join(str(secretary_info.get(field, '')) for field in (
+        'name', 'personality', 'custom_instructions', 'user_full_name', 'user_email'
+    ))
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+def _secretary_stats(secretary_id):
+    return RESPONSE_CACHE_STATS.setdefault(secretary_id, {
+        'lookups': 0,
+        'exact_hits': 0,
+        'similar_hits': 0,
+        'invalidated': 0,
+        'stores': 0,
+        'latency_saved_ms': 0
+    })
@@ -0,0 +1,116 @@
+from firebase_functions.params import BoolParam
+from clients import get_db
+from tracing import firestore_span
+
+# Store debug logs in task_history/{task_id}/debug_logs instead of only printing them
+PERSIST_DEBUG_LOGS = BoolParam('PERSIST_DEBUG_LOGS', default=False)
+
+# Initialize Globals
+DEBUG_LOG_LINES_PER_DOC = 200  # Log lines stored per debug_logs document
+DEBUG_LOG_LINE_MAX_CHARS = 1000  # Longer log lines are truncated
+MAX_BATCH_WRITES = 500  # Firestore limit on writes in one batch
+
+class TaskHistoryWriter:
+    """
+    Collects the changes one request makes to its task_history document and writes
+    them in a single batch, instead of one set()/update() per step.
+
+    Fields use dotted paths (e.g. 'timings.ai_ms'), so nothing needs to be read first.
+    With a UsageLedger, the task's token usage and the user's daily usage counters are
+    written in the same batch.
+    """
+
+    def __init__(self, task_id, db=None, usage=None):
+        self.task_id = task_id
+        self.db = db or get_db()
+        self.usage = usage
+        self.fields = {}
+        self.tool_calls = []
+        self.tool_calls_recorded = 0  # Numbers the calls across flushes
+        self.debug_logs = []
+        self.log_docs_written = 0
+
+    def update(self, fields):
+        """Queue arbitrary field updates."""
+        self.fields.update(fields)
+
+    def set_status(self, status):
+        self.fields['status'] = status
+
+    def record_timing(self, stage, milliseconds):
+        self.fields[f'timings.{stage}'] = round(milliseconds)
+
+    def record_ai_output(self, email_response, reasoning):
+        from firebase_admin import firestore
+        self.fields.update({
+            'ai_response': email_response,
+            'ai_reasoning': reasoning,
+            'processed_at': firestore.SERVER_TIMESTAMP
+        })
+
+    def record_tool_call(self, tool_name, tool_input, result, turn_ms):
+        """
+        Record one tool call. turn_ms is the wall time of the whole turn, since a turn's calls run together.
+        seq keeps repeated identical calls apart, since ArrayUnion drops duplicate entries.
+        """
+        self.tool_calls.append({
+            'seq': self.tool_calls_recorded,
+            'name': tool_name,
+            'input': tool_input,
+            'error': result.get('error') if isinstance(result, dict) else None,
+            'turn_ms': round(turn_ms)
+        })
+        self.tool_calls_recorded += 1
+
+    def add_debug_logs(self, logs):
+        self.debug_logs.extend(logs)
+
+    def flush(self):
+        """
+        Write everything collected so far in one batch (debug log chunks included) and reset.
+        """
+        if not self.task_id:
+            return
+        from firebase_admin import firestore
+
+        fields = dict(self.fields)
+        if self.tool_calls:
+            fields['tool_calls'] = firestore.ArrayUnion(self.tool_calls)
+        if self.usage is not None and self.usage.calls:
+            fields.update(self.usage.task_fields())
+
+        log_chunks = []
+        if self.debug_logs and PERSIST_DEBUG_LOGS.value:
+            lines = [str(line)[:DEBUG_LOG_LINE_MAX_CHARS] for line in self.debug_logs]
+            log_chunks = [
+                lines[start:start + DEBUG_LOG_LINES_PER_DOC]
+                for start in range(0, len(lines), DEBUG_LOG_LINES_PER_DOC)
+            ][:MAX_BATCH_WRITES - 1]
+            fields['debug_log_count'] = len(lines)
+        elif self.debug_logs:
+            print(f"=== DEBUG LOGS START ({self.task_id}) ===")
+            for i, log in enumerate(self.debug_logs):
+                print(f"[{i}] {log}")
+            print("=== DEBUG LOGS END ===")
+
+        if not fields and not log_chunks:
+            return
+
+        task_ref = self.db.collection('task_history').document(self.task_id)
+        batch = self.db.batch()
+        if fields:
+            batch.update(task_ref, fields)
+        for index, chunk in enumerate(log_chunks, start=self.log_docs_written):
+            batch.set(task_ref.collection('debug_logs').document(f"{index:04d}"), {
+                'index': index,
+                'lines': chunk
+            })
+        if self.usage is not None:
+            self.usage.add_daily_counters(batch, self.db)
+        with firestore_span('batch_commit', 'task_history'):
+            batch.commit()
+
+        self.log_docs_written += len(log_chunks)
+        self.fields = {}
+        self.tool_calls = []
+        self.debug_logs = []
@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import re
+from firebase_functions.params import StringParam
+from clients import get_db
+from tracing import firestore_span, model_span, record_model_usage
+
+# Model used to fold older turns into a thread's rolling summary
+THREAD_SUMMARY_MODEL = StringParam('THREAD_SUMMARY_MODEL', 'claude-3-5-haiku-20241022')
+
+# Thread memory settings
+THREAD_RECENT_TURNS = 6  # Turns kept verbatim; older ones live only in the summary
+THREAD_FOLD_BATCH = 4  # Turns allowed past THREAD_RECENT_TURNS before they are folded into the summary
+THREAD_TURN_MAX_CHARS = 4000  # Longer turns are cut before they are stored
+THREAD_SUMMARY_MAX_TOKENS = 400
+THREAD_SUMMARY_MAX_CHARS = 2000  # Cap for the fallback summary when the model call fails
+THREAD_ALIAS_LOOKUP_MAX_IDS = 20  # Most recent References/In-Reply-To IDs checked against thread_aliases
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a conversation between an AI secretary and the people it works with. Merge the new turns into the existing summary. Keep names, dates, times, decisions, open requests and anything the secretary has promised to do; drop pleasantries. Write at most a few short paragraphs. Return only the summary."""
+
+def email_thread_key(message_id, references=None):
+    """
+    Thread key for an email: the first Message-ID in References (the thread root),
+    or the email's own Message-ID when it starts a thread.
+
+    Returns:
+      str or None: the key, or None if the email has no usable IDs
+    """
+    ids = parse_message_ids(references)
+    root = ids[0] if ids else (message_id or '').strip()
+    if not root:
+        return None
+    return 'email_' + hashlib.sha256(root.encode('utf-8')).hexdigest()[:40]
+
+def resolve_email_thread(message_id, references=None, in_reply_to=None, db=None):
+    """
+    Thread key for an inbound email. Every Message-ID the thread has seen (inbound emails and
+    the replies sent to them) is stored as an alias of its thread, so a reply is matched
+    through any ID in its References or In-Reply-To, even when the client cut References
+    short. Emails with no known IDs start a thread keyed by email_thread_key.
+
+    Returns:
+      str or None: the key, or None if the email has no usable IDs
+    """
+    candidates = parse_message_ids(in_reply_to) + parse_message_ids(references)[::-1]
+    candidates = list(dict.fromkeys(candidates))[:THREAD_ALIAS_LOOKUP_MAX_IDS]
+    if candidates:
+        db = db or get_db()
+        aliases = db.collection('thread_aliases')
+        try:
+            with firestore_span('get_all', 'thread_aliases'):
+                snapshots = {snapshot.id: snapshot for snapshot in db.get_all([aliases.document(_alias_id(mid)) for mid in candidates])}
+        except Exception as e:
+            logging.error(f"Error resolving email thread aliases: {str(e)}")
+            snapshots = {}
+        # In-Reply-To first, then References from the newest
+        for mid in candidates:
+            snapshot = snapshots.get(_alias_id(mid))
+            if snapshot is not None and snapshot.exists and snapshot.to_dict().get('thread_key'):
+                return snapshot.to_dict()['thread_key']
+    return email_thread_key(message_id, references)
+
+def parse_message_ids(value):
+    """
+    The <...> Message-IDs in a References or In-Reply-To header value, in order.
+    """
+    return re.findall(r'<[^<>\s]+>', value or '')
+
+def _alias_id(message_id):
+    normalized = f"<{message_id.strip().strip('<>')}>"
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:40]
+
+def chat_thread_key(user_id, conversation_id):
+    """
+    Thread key for a chat conversation.
+    """
+    if not user_id or not conversation_id:
+        return None
+    return 'chat_' + hashlib.sha256(f"{user_id}:{conversation_id}".encode('utf-8')).hexdigest()[:40]
+
+def load_thread(thread_key, db=None):
+    """
+    Read a thread's memory.
+
+    Returns:
+      dict: summary (str), turns (list of {role, content}), turn_count (turns ever stored)
+            and summarized_count (turns folded into the summary)
+    """
+    memory = {'summary': '', 'turns': [], 'turn_count': 0, 'summarized_count': 0}
+    if not thread_key:
+        return memory
+    db = db or get_db()
+    with firestore_span('get', 'thread_memory'):
+        snapshot = db.collection('thread_memory').document(thread_key).get()
+    if snapshot.exists:
+        memory.update(snapshot.to_dict())
+    return memory
+
+def format_thread_context(memory):
+    """
+    Render a thread's memory for the prompt: the rolling summary, then the recent turns.
+    """
+    sections = []
+    if memory.get('summary'):
+        sections.append(f"Summary of earlier messages:\n{memory['summary']}")
+    if memory.get('turns'):
+        recent = "\n\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in memory['turns'])
+        sections.append(f"Recent messages:\n{recent}")
+    return "\n\n".join(sections)
+
+def append_turns(thread_key, turns, client=None, user_id=None, db=None, usage=None, message_ids=None):
+    """
+    Add turns to a thread and, once more than THREAD_RECENT_TURNS + THREAD_FOLD_BATCH are
+    held, fold the oldest into the rolling summary. Only the new turns are written, so each
+    update costs the same however long the thread is.
+
+    Parameters:
+      thread_key (str): Key from resolve_email_thread or chat_thread_key
+      turns (list): [{"role": str, "content": str}, ...]
+      client: (Optional) Anthropic client used to write the summary
+      user_id (str): (Optional) Owner of the thread
+      db: (Optional) Firestore client
+      usage (UsageLedger): (Optional) Ledger the summary call is recorded on
+      message_ids (list): (Optional) Message-IDs of the emails in the turns, stored as
+                          aliases of the thread (see resolve_email_thread)
+    """
+    if not thread_key or not turns:
+        return
+    from firebase_admin import firestore
+    db = db or get_db()
+    thread_ref = db.collection('thread_memory').document(thread_key)
+    new_turns = [
+        {'role': turn.get('role', 'user'), 'content': str(turn.get('content', ''))[:THREAD_TURN_MAX_CHARS]}
+        for turn in turns
+    ]
+
+    @firestore.transactional
+    def append(transaction):
+        snapshot = thread_ref.get(transaction=transaction)
+        memory = snapshot.to_dict() if snapshot.exists else {}
+        stored = memory.get('turns', []) + new_turns
+        transaction.set(thread_ref, {
+            'user_id': user_id or memory.get('user_id'),
+            'summary': memory.get('summary', ''),
+            'turns': stored,
+            'turn_count': memory.get('turn_count', 0) + len(new_turns),
+            'summarized_count': memory.get('summarized_count', 0),
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+        for message_id in message_ids or []:
+            if message_id and message_id.strip():
+                transaction.set(db.collection('thread_aliases').document(_alias_id(message_id)), {
+                    'thread_key': thread_key,
+                    'message_id': message_id.strip(),
+                    'updated_at': firestore.SERVER_TIMESTAMP
+                })
+        return memory.get('summary', ''), stored, memory.get('summarized_count', 0)
+
+    with firestore_span('transaction', 'thread_memory'):
+        summary, stored, summarized_count = append(db.transaction())
+    if len(stored) > THREAD_RECENT_TURNS + THREAD_FOLD_BATCH:
+        fold_turns(thread_ref, summary, stored, summarized_count, client, db, usage)
+
+def fold_turns(thread_ref, summary, turns, summarized_count, client=None, db=None, usage=None):
+    """
+    Move all but the last THREAD_RECENT_TURNS turns into the summary.
+    The summary is written outside the transaction; the fold is dropped if another
+    update folded the same turns first.
+    """
+    from firebase_admin import firestore
+    fold_count = len(turns) - THREAD_RECENT_TURNS
+    new_summary = summarize_turns(summary, turns[:fold_count], client, usage)
+
+    @firestore.transactional
+    def fold(transaction):
+        snapshot = thread_ref.get(transaction=transaction)
+        memory = snapshot.to_dict() if snapshot.exists else {}
+        if memory.get('summarized_count', 0) != summarized_count:
+            return False
+        transaction.update(thread_ref, {
+            'summary': new_summary,
+            'turns': memory.get('turns', [])[fold_count:],
+            'summarized_count': summarized_count + fold_count
+        })
+        return True
+
+    with firestore_span('transaction', 'thread_memory'):
+        folded = fold((db or get_db()).transaction())
+    if not folded:
+        print(f"Thread {thread_ref.id} was folded concurrently, skipping")
+
+def summarize_turns(summary, turns, client=None, usage=None):
+    """
+    Merge turns into the rolling summary with a small model. Without a client, or if the
+    call fails, the turns are appended in shortened form and the oldest text is dropped.
+    The call is recorded on usage (a UsageLedger), if given.
+
+    Returns:
+      str: the updated summary
+    """
+    transcript = "\n\n".join(f"{turn['role'].upper()}: {turn['content']}" for turn in turns)
+    if client is not None:
+        try:
+            with model_span(THREAD_SUMMARY_MODEL.value, 'thread_summary') as model_call:
+                response = client.messages.create(
+                    model=THREAD_SUMMARY_MODEL.value,
+                    max_tokens=THREAD_SUMMARY_MAX_TOKENS,
+                    system=SUMMARY_SYSTEM_PROMPT,
+                    messages=[{
+                        "role": "user",
+                        "content": f"Existing summary:\n{summary or '(none)'}\n\nNew turns:\n{transcript}"
+                    }]
+                )
+                record_model_usage(model_call, response.usage)
+            if usage is not None:
+                usage.record(THREAD_SUMMARY_MODEL.value, response.usage, 'thread_summary')
+            text = "".join(block.text for block in response.content if block.type == "text").strip()
+            if text:
+                return text
+        except Exception as e:
+            logging.error(f"Error summarizing thread: {str(e)}")
+
+    shortened = "\n".join(f"{turn['role'].upper()}: {turn['content'][:200]}" for turn in turns)
+    return f"{summary}\n{shortened}".strip()[-THREAD_SUMMARY_MAX_CHARS:]
@@ -1,20 +1,15 @@
 from datetime import datetime, timedelta
+from collections import OrderedDict
+import threading
+import time
 import pytz
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 import json
-import firebase_admin
-from firebase_admin import credentials, firestore
 from firebase_functions.params import StringParam
-
-# Initialize Firebase Admin SDK
-try:
-    cred = credentials.Certificate("starlis_admin_creds.json")
-    firebase_admin.initialize_app(cred)
-except ValueError:
-    # App already initialized
-    pass
+from profile_cache import get_user_profile, peek_cached_document, invalidate_cached_document
+from calendar_index import (
+    get_indexed_events, record_event_change, record_event_deleted, simplify_event, evict_calendar_index,
+    event_interval, parse_event_time, CALENDAR_TIMEZONE
+)
 
 SCOPES = [
     "https://www.googleapis.com/auth/calendar",
@@ -24,6 +19,25 @@ SCOPES = [
 GOOGLE_CLIENT_ID = StringParam('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = StringParam('GOOGLE_CLIENT_SECRET')
 
+# Calendar service pool settings
+SERVICE_POOL_MAX_SIZE = 100  # Maximum number of users with a pooled Calendar service
+SERVICE_POOL_TTL_SECONDS = 15 * 60  # Re-read tokens from Firestore after this long
+
+# Pooled entries keyed by user_id, oldest first: {'creds', 'services', 'created_at', 'refresh_lock', 'stored_refresh_token'}
+_service_pool = OrderedDict()
+_service_pool_lock = threading.Lock()
+
+# find_free_slots limits
+MAX_FREE_SLOTS = 10  # Free windows returned per call
+MAX_FREE_SLOT_SEARCH_DAYS = 31  # Longest date range searched at once
+FREE_SLOT_GRANULARITY_MINUTES = 15  # Free windows start on a multiple of this
+
+# Calendar API batch requests are limited to 50 calls
+MAX_BATCH_REQUESTS = 50
+
+# Parsed Calendar v3 discovery document, loaded once per process
+_calendar_discovery_doc = None
+
 def get_calendar_token(user_id):
     """
     Get the user's Google Calendar API tokens from Firestore.
@@ -35,16 +49,11 @@ def get_calendar_token(user_id):
       tuple: (access_token, refresh_token)
     """
     try:
-        # Initialize Firestore client
-        db = firestore.client()
-        
-        # Get the user's document from Firestore
-        user_doc = db.collection('users').document(user_id).get()
+        # Get the user's document from Firestore (through the profile cache)
+        user_data = get_user_profile(user_id)
         
-        if not user_doc.exists:
+        if not user_data:
             raise ValueError(f"No user found with ID: {user_id}")
-            
-        user_data = user_doc.to_dict()
         
         # Check if the user has Google Calendar tokens
         if 'google_oauth_token' not in user_data or 'access_token' not in user_data['google_oauth_token']:
@@ -56,40 +65,137 @@ def get_calendar_token(user_id):
         # For testing/development only - would remove in production
         return "ya29.a0ARrdaM8...", "1//0g2..."
 
+def get_calendar_discovery_doc():
+    """
+    Returns the Calendar v3 discovery document shipped with googleapiclient.
+    The JSON is parsed once per process so building a service never touches the network.
+    """
+    global _calendar_discovery_doc
+    if _calendar_discovery_doc is None:
+        from googleapiclient.discovery_cache import get_static_doc
+        _calendar_discovery_doc = json.loads(get_static_doc('calendar', 'v3'))
+    return _calendar_discovery_doc
+
+def _build_calendar_entry(user_id):
+    """
+    Reads the user's tokens from Firestore and builds a new pool entry.
+    """
+    from google.oauth2.credentials import Credentials
+    # Get the token from Firestore
+    token, refresh_token = get_calendar_token(user_id)
+    
+    # Get client ID and client secret from the function params
+    client_id = GOOGLE_CLIENT_ID.value
+    client_secret = GOOGLE_CLIENT_SECRET.value
+
+    # Create a proper credentials info dictionary
+    credentials_info = {
+        "token": token,
+        "refresh_token": refresh_token, 
+        "token_uri": "https://oauth2.googleapis.com/token",
+        "client_id": client_id,
+        "client_secret": client_secret,
+        "scopes": SCOPES
+    }
+    
+    creds = Credentials.from_authorized_user_info(credentials_info)
+    return {
+        'creds': creds,
+        'services': {},  # Calendar services by thread id, sharing creds
+        'created_at': time.monotonic(),
+        'refresh_lock': threading.Lock(),
+        # The refresh token stored on the user's profile (None if it couldn't be read)
+        'stored_refresh_token': _stored_refresh_token(peek_cached_document('users', user_id))
+    }
+
+def _stored_refresh_token(profile):
+    return ((profile or {}).get('google_oauth_token') or {}).get('refresh_token')
+
+def _calendar_tokens_changed(user_id, entry):
+    """
+    Whether the refresh token on the user's profile differs from the one the pooled entry was
+    built from. Only a profile already in the profile cache is looked at, so this never reads
+    Firestore; an uncached profile counts as unchanged, and the pool TTL bounds the rest.
+    """
+    profile = peek_cached_document('users', user_id)
+    if profile is None:
+        return False
+    return _stored_refresh_token(profile) != entry['stored_refresh_token']
+
+def _ensure_fresh_credentials(entry):
+    """
+    Refreshes the entry's credentials if they have expired.
+    The refresh lock makes concurrent callers wait for a single refresh instead of each hitting the token endpoint.
+    """
+    creds = entry['creds']
+    if creds.valid:
+        return
+    from google.auth.transport.requests import Request
+    with entry['refresh_lock']:
+        # Another caller may have refreshed while we were waiting
+        if not creds.valid and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+
 def get_calendar_service(user_id):
     """
-    Authenticates and returns a Google Calendar API service instance.
-    Uses credentials from Firestore and client details from google_credentials.json.
+    Authenticates and returns a Google Calendar API service instance for the calling thread.
+    Credentials are pooled per user (LRU, bounded by SERVICE_POOL_MAX_SIZE) and re-read
+    from Firestore after SERVICE_POOL_TTL_SECONDS. The pooled service (and calendar index)
+    is dropped when the cached profile shows a different stored refresh token (they
+    reconnected or disconnected their calendar) or the token can't be refreshed.
     """
     try:
-        # Get the token from Firestore
-        token, refresh_token = get_calendar_token(user_id)
+        now = time.monotonic()
+        with _service_pool_lock:
+            entry = _service_pool.get(user_id)
+            if entry and now - entry['created_at'] < SERVICE_POOL_TTL_SECONDS:
+                _service_pool.move_to_end(user_id)
+            else:
+                entry = None
+        
+        if entry is not None and _calendar_tokens_changed(user_id, entry):
+            print(f"Calendar tokens changed for {user_id}, dropping the pooled service")
+            evict_calendar_service(user_id)
+            entry = None
         
-        # Get client ID and client secret from the credentials file
-        client_id = GOOGLE_CLIENT_ID.value
-        client_secret = GOOGLE_CLIENT_SECRET.value
-
-        # Create a proper credentials info dictionary
-        credentials_info = {
-            "token": token,
-            "refresh_token": refresh_token, 
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "scopes": SCOPES
-        }
+        if entry is None:
+            entry = _build_calendar_entry(user_id)
+            with _service_pool_lock:
+                _service_pool[user_id] = entry
+                _service_pool.move_to_end(user_id)
+                while len(_service_pool) > SERVICE_POOL_MAX_SIZE:
+                    _service_pool.popitem(last=False)
         
-        creds = Credentials.from_authorized_user_info(credentials_info)
+        from google.auth.exceptions import RefreshError
+        try:
+            _ensure_fresh_credentials(entry)
+        except RefreshError:
+            # Revoked or expired grant: start over from freshly read tokens next time
+            evict_calendar_service(user_id)
+            invalidate_cached_document('users', user_id)
+            raise
         
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-        service = build('calendar', 'v3', credentials=creds)
+        # httplib2 connections are not thread-safe, so each thread gets its own service
+        thread_id = threading.get_ident()
+        service = entry['services'].get(thread_id)
+        if service is None:
+            from googleapiclient.discovery import build_from_document
+            service = build_from_document(get_calendar_discovery_doc(), credentials=entry['creds'])
+            entry['services'][thread_id] = service
         return service
     except Exception as e:
         print(f"Error setting up calendar service: {e}")
         raise
 
+def evict_calendar_service(user_id):
+    """
+    Drops the pooled Calendar service and calendar index for a user, e.g. after their
+    OAuth tokens change.
+    """
+    with _service_pool_lock:
+        _service_pool.pop(user_id, None)
+    evict_calendar_index(user_id)
+
 def add_event(user_id, title, description, start_day, end_day, start_time, end_time, location="", attendees=None):
     """
     Adds an event to the user's primary calendar and invites attendees.
@@ -105,13 +211,36 @@ def add_event(user_id, title, description, start_day, end_day, start_time, end_t
       attendees (list): (Optional) List of email addresses to invite.
     """
     print(f"Adding event params: {title}, {description}, {start_day}, {end_day}, {start_time}, {end_time}, {location}, {attendees}")
+    event, send_updates, error = _new_event_body(title, description, start_day, end_day, start_time, end_time, location, attendees)
+    if error:
+        return error
+
+    try:
+        service = get_calendar_service(user_id=user_id)
+        created_event = service.events().insert(
+            calendarId='primary', 
+            body=event,
+            sendUpdates=send_updates
+        ).execute()
+        return _event_result(user_id, created_event, 'created')
+    except Exception as e:
+        print(f"Error creating event: {str(e)}")
+        return {"error": f"Failed to create event: {str(e)}"}
+
+def _new_event_body(title, description, start_day, end_day, start_time, end_time, location="", attendees=None):
+    """
+    Builds the Calendar API body for a new event.
+    
+    Returns:
+      tuple: (event body, sendUpdates value, error dict or None)
+    """
     # Combine day and time and parse into datetime objects.
     try:
         start_dt = datetime.strptime(f"{start_day} {start_time}", '%m/%d/%Y %I:%M %p')
         end_dt = datetime.strptime(f"{end_day} {end_time}", '%m/%d/%Y %I:%M %p')
     except ValueError as e:
         print("Error parsing date/time:", e)
-        return {"error": f"Date/time parsing error: {str(e)}"}
+        return None, None, {"error": f"Date/time parsing error: {str(e)}"}
 
     # Set the timezone (adjust if necessary)
     tz = pytz.timezone('America/New_York')
@@ -139,33 +268,29 @@ def add_event(user_id, title, description, start_day, end_day, start_time, end_t
         send_updates = 'all'
     else:
         send_updates = 'none'
+    return event, send_updates, None
 
-    try:
-        service = get_calendar_service(user_id=user_id)
-        created_event = service.events().insert(
-            calendarId='primary', 
-            body=event,
-            sendUpdates=send_updates
-        ).execute()
-        
-        print('Event created: %s' % created_event.get('htmlLink'))
-        
-        # Return a simplified event object with key information
-        return {
-            'id': created_event.get('id'),
-            'summary': created_event.get('summary'),
-            'start': created_event.get('start', {}).get('dateTime'),
-            'end': created_event.get('end', {}).get('dateTime'),
-            'location': created_event.get('location', ''),
-            'link': created_event.get('htmlLink')
-        }
-    except Exception as e:
-        print(f"Error creating event: {str(e)}")
-        return {"error": f"Failed to create event: {str(e)}"}
+def _event_result(user_id, event, action):
+    """
+    Records a created or updated event in the calendar index and returns the simplified
+    event object given back to Claude.
+    """
+    print(f"Event {action}: {event.get('htmlLink')}")
+    record_event_change(user_id, event)
+    return {
+        'id': event.get('id'),
+        'summary': event.get('summary'),
+        'start': event.get('start', {}).get('dateTime'),
+        'end': event.get('end', {}).get('dateTime'),
+        'location': event.get('location', ''),
+        'link': event.get('htmlLink')
+    }
 
 def get_events(user_id, start_day, end_day):
     """
     Retrieves events from the user's primary calendar within a specific date range.
+    Served from the user's calendar index (see calendar_index) when it covers the range;
+    otherwise Google is asked directly.
     
     Parameters:
       start_day (str): Start day for the query period (MM/DD/YYYY).
@@ -183,6 +308,15 @@ def get_events(user_id, start_day, end_day):
         print("Error parsing dates:", e)
         return {"error": f"Date parsing error: {str(e)}"}
 
+    try:
+        events = get_indexed_events(user_id, start_dt, end_dt)
+        if events is not None:
+            if not events:
+                print('No events found.')
+            return events
+    except Exception as e:
+        print(f"Error reading calendar index, falling back to Google: {str(e)}")
+
     try:
         service = get_calendar_service(user_id)
         events_result = service.events().list(
@@ -199,22 +333,159 @@ def get_events(user_id, start_day, end_day):
             return []
         
         # Return simplified event objects with key information
-        simplified_events = []
-        for event in events:
-            simplified_events.append({
-                'id': event.get('id'),
-                'summary': event.get('summary', 'No Title'),
-                'start': event['start'].get('dateTime', event['start'].get('date')),
-                'end': event['end'].get('dateTime', event['end'].get('date')),
-                'location': event.get('location', ''),
-                'description': event.get('description', '')
-            })
-        
-        return simplified_events
+        return [simplify_event(event) for event in events]
     except Exception as e:
         print(f"Error retrieving events: {str(e)}")
         return {"error": f"Failed to retrieve events: {str(e)}"}
     
+def find_free_slots(user_id, start_day, end_day, duration_minutes, working_hours_start="09:00 AM",
+                    working_hours_end="05:00 PM", attendees=None, include_weekends=False, max_slots=MAX_FREE_SLOTS):
+    """
+    Finds open time windows long enough for a meeting, on the user's calendar and (through
+    Google freeBusy) the attendees' calendars.
+    
+    Parameters:
+      start_day (str): First day to search (MM/DD/YYYY).
+      end_day (str): Last day to search (MM/DD/YYYY).
+      duration_minutes (int): Meeting length in minutes.
+      working_hours_start (str): (Optional) Earliest start each day (HH:MM AM/PM).
+      working_hours_end (str): (Optional) Latest end each day (HH:MM AM/PM).
+      attendees (list): (Optional) Email addresses whose free/busy should also be respected.
+      include_weekends (bool): (Optional) Also search Saturdays and Sundays.
+      max_slots (int): (Optional) Maximum number of windows returned.
+      
+    Returns:
+      dict: the free windows (day, start_time, end_time) in which a meeting of duration_minutes
+            fits, plus any attendees whose calendars could not be read.
+            As in Google freeBusy, events shown as free (transparent) don't block time. All-day
+            events usually are; those shown as busy (e.g. out of office) block the whole day.
+            Windows start on a FREE_SLOT_GRANULARITY_MINUTES boundary.
+    """
+    print(f"Finding free slots from {start_day} to {end_day} for {duration_minutes} minutes, attendees: {attendees}")
+    tz = pytz.timezone(CALENDAR_TIMEZONE)
+    try:
+        first_day = datetime.strptime(start_day, '%m/%d/%Y').date()
+        last_day = datetime.strptime(end_day, '%m/%d/%Y').date()
+        day_start = datetime.strptime(working_hours_start, '%I:%M %p').time()
+        day_end = datetime.strptime(working_hours_end, '%I:%M %p').time()
+        duration = timedelta(minutes=int(duration_minutes))
+    except (TypeError, ValueError) as e:
+        print("Error parsing free slot parameters:", e)
+        return {"error": f"Parameter parsing error: {str(e)}"}
+    if last_day < first_day or duration <= timedelta(0):
+        return {"error": "end_day must not be before start_day and duration_minutes must be positive"}
+    if (last_day - first_day).days > MAX_FREE_SLOT_SEARCH_DAYS:
+        return {"error": f"Search at most {MAX_FREE_SLOT_SEARCH_DAYS} days at a time"}
+    
+    range_start = tz.localize(datetime.combine(first_day, datetime.min.time()))
+    range_end = tz.localize(datetime.combine(last_day + timedelta(days=1), datetime.min.time()))
+    
+    try:
+        busy, unavailable = get_busy_intervals(user_id, range_start, range_end, attendees or [])
+    except Exception as e:
+        print(f"Error retrieving free/busy: {str(e)}")
+        return {"error": f"Failed to retrieve free/busy: {str(e)}"}
+    busy = merge_intervals(busy)
+    
+    slots = []
+    now = time.time()
+    granularity = FREE_SLOT_GRANULARITY_MINUTES * 60
+    busy_index = 0
+    day = first_day
+    while day <= last_day and len(slots) < max_slots:
+        if include_weekends or day.weekday() < 5:
+            window_start = max(tz.localize(datetime.combine(day, day_start)).timestamp(), now)
+            window_end = tz.localize(datetime.combine(day, day_end)).timestamp()
+            
+            # Busy intervals are sorted and merged, so one pass over them covers every day
+            while busy_index < len(busy) and busy[busy_index][1] <= window_start:
+                busy_index += 1
+            cursor = window_start
+            position = busy_index
+            while cursor < window_end and len(slots) < max_slots:
+                next_busy = busy[position] if position < len(busy) and busy[position][0] < window_end else None
+                free_until = min(next_busy[0], window_end) if next_busy else window_end
+                # Time zone offsets are whole quarter hours, so this rounds local time too
+                slot_start = -(-cursor // granularity) * granularity
+                if free_until - slot_start >= duration.total_seconds():
+                    slots.append(_format_slot(slot_start, free_until, tz))
+                if next_busy is None:
+                    break
+                cursor = max(cursor, next_busy[1])
+                position += 1
+        day += timedelta(days=1)
+    
+    result = {
+        "duration_minutes": int(duration_minutes),
+        "timezone": CALENDAR_TIMEZONE,
+        "slots": slots
+    }
+    if unavailable:
+        result["unavailable_attendees"] = unavailable
+    return result
+
+def get_busy_intervals(user_id, range_start, range_end, attendees):
+    """
+    Busy (start, end) timestamps in a range: the user's own from the calendar index, the
+    attendees' (and the user's, if the index doesn't cover the range or can't be read) from
+    one freeBusy query. Indexed events shown as free are skipped, as freeBusy does.
+    
+    Returns:
+      tuple: (list of (start_ts, end_ts), attendee emails whose free/busy could not be read)
+    """
+    busy = []
+    calendar_ids = list(dict.fromkeys(attendees))
+    try:
+        events = get_indexed_events(user_id, range_start, range_end)
+    except Exception as e:
+        print(f"Error reading calendar index, falling back to Google: {str(e)}")
+        events = None
+    if events is None:
+        calendar_ids.insert(0, 'primary')
+    else:
+        for event in events:
+            if event.get('transparency') == 'transparent':
+                continue
+            busy.append(event_interval(event))
+    
+    unavailable = []
+    if calendar_ids:
+        service = get_calendar_service(user_id)
+        response = service.freebusy().query(body={
+            'timeMin': range_start.isoformat(),
+            'timeMax': range_end.isoformat(),
+            'timeZone': CALENDAR_TIMEZONE,
+            'items': [{'id': calendar_id} for calendar_id in calendar_ids]
+        }).execute()
+        for calendar_id, calendar in response.get('calendars', {}).items():
+            if calendar.get('errors'):
+                unavailable.append(calendar_id)
+                continue
+            for period in calendar.get('busy', []):
+                busy.append((parse_event_time(period['start']), parse_event_time(period['end'])))
+    return busy, unavailable
+
+def merge_intervals(intervals):
+    """
+    Sort (start, end) intervals and merge the overlapping or touching ones.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def _format_slot(start_ts, end_ts, tz):
+    start = datetime.fromtimestamp(start_ts, tz)
+    end = datetime.fromtimestamp(end_ts, tz)
+    return {
+        'day': start.strftime('%m/%d/%Y'),
+        'start_time': start.strftime('%I:%M %p'),
+        'end_time': end.strftime('%I:%M %p')
+    }
+
 def delete_event(user_id, event_id):
     """
     Deletes an event from the user's primary calendar.
@@ -225,16 +496,21 @@ def delete_event(user_id, event_id):
     try:
         service = get_calendar_service(user_id)
         service.events().delete(calendarId='primary', eventId=event_id).execute()
-        print(f"Event {event_id} deleted.")
-        return {"status": "success", "message": f"Event {event_id} deleted successfully"}
+        return _deleted_event_result(user_id, event_id)
     except Exception as e:
         print(f"An error occurred: {e}")
         return {"error": f"Failed to delete event: {str(e)}"}
 
+def _deleted_event_result(user_id, event_id):
+    print(f"Event {event_id} deleted.")
+    record_event_deleted(user_id, event_id)
+    return {"status": "success", "message": f"Event {event_id} deleted successfully"}
+
 def update_event(user_id, event_id, title=None, description=None, start_day=None, end_day=None, 
                 start_time=None, end_time=None, location=None, attendees=None):
     """
     Updates an existing event in the user's primary calendar.
+    Only the given fields are sent (events().patch), so the event isn't read first.
     
     Parameters:
       event_id (str): The unique identifier of the event to update.
@@ -248,25 +524,42 @@ def update_event(user_id, event_id, title=None, description=None, start_day=None
       attendees (list): (Optional) Updated list of email addresses to invite.
     """
     print(f"Updating event params: {event_id}, {title}, {description}, {start_day}, {end_day}, {start_time}, {end_time}, {location}, {attendees}")
-    
+    changes, send_updates, error = _event_patch_body(title, description, start_day, end_day, start_time, end_time, location, attendees)
+    if error:
+        return error
+
     try:
         service = get_calendar_service(user_id)
-        event = service.events().get(calendarId='primary', eventId=event_id).execute()
+        updated_event = service.events().patch(
+            calendarId='primary', 
+            eventId=event_id, 
+            body=changes,
+            sendUpdates=send_updates
+        ).execute()
+        return _event_result(user_id, updated_event, 'updated')
     except Exception as e:
-        print(f"Error retrieving event: {e}")
-        return {"error": f"Failed to retrieve event: {str(e)}"}
+        print(f"Error updating event: {e}")
+        return {"error": f"Failed to update event: {str(e)}"}
 
-    # Update fields if provided
+def _event_patch_body(title=None, description=None, start_day=None, end_day=None, start_time=None,
+                      end_time=None, location=None, attendees=None):
+    """
+    Builds the Calendar API patch body with only the fields being changed.
+    
+    Returns:
+      tuple: (patch body, sendUpdates value, error dict or None)
+    """
+    changes = {}
     if title is not None:
-        event['summary'] = title
+        changes['summary'] = title
     if description is not None:
-        event['description'] = description
+        changes['description'] = description
     if location is not None:
-        event['location'] = location
+        changes['location'] = location
         
     # Update attendees if provided
     if attendees is not None:
-        event['attendees'] = [{'email': email} for email in attendees]
+        changes['attendees'] = [{'email': email} for email in attendees]
         # Set sendUpdates to 'all' when modifying attendees
         send_updates = 'all'
     else:
@@ -276,44 +569,147 @@ def update_event(user_id, event_id, title=None, description=None, start_day=None
     if start_day and start_time:
         try:
             start_dt = tz.localize(datetime.strptime(f"{start_day} {start_time}", '%m/%d/%Y %I:%M %p'))
-            event['start'] = {
+            changes['start'] = {
                 'dateTime': start_dt.isoformat(),
                 'timeZone': 'America/New_York'
             }
         except ValueError as e:
             print("Error parsing start date/time:", e)
-            return {"error": f"Start date/time parsing error: {str(e)}"}
+            return None, None, {"error": f"Start date/time parsing error: {str(e)}"}
     if end_day and end_time:
         try:
             end_dt = tz.localize(datetime.strptime(f"{end_day} {end_time}", '%m/%d/%Y %I:%M %p'))
-            event['end'] = {
+            changes['end'] = {
                 'dateTime': end_dt.isoformat(),
                 'timeZone': 'America/New_York'
             }
         except ValueError as e:
             print("Error parsing end date/time:", e)
-            return {"error": f"End date/time parsing error: {str(e)}"}
+            return None, None, {"error": f"End date/time parsing error: {str(e)}"}
+    return changes, send_updates, None
+
+def execute_event_mutations(user_id, calls):
+    """
+    Runs several calendar mutations (add_event, update_event and delete_event tool calls) as
+    Google batch requests: one HTTP round trip per MAX_BATCH_REQUESTS calls instead of one each.
+    Google runs the parts of a batch in any order, so repeated mutations of the same event go
+    into successive batches, in the order they were requested.
+    
+    If a batch request fails, its calls that got no response may still have been applied,
+    so they get an "unknown" outcome (see unknown_mutation_result); calls that were never
+    sent are reported as not run. Results already received are kept.
+    
+    Parameters:
+      calls (list): (tool_name, tool_input) pairs
+      
+    Returns:
+      list: result dicts in the same order as calls, as the single-call functions return them
+    """
+    results = [None] * len(calls)
+    waves = []
+    seen_events = {}
+    for index, (tool_name, arguments) in enumerate(calls):
+        event_id = arguments.get('event_id')
+        wave = seen_events.get(event_id, -1) + 1 if event_id else 0
+        if event_id:
+            seen_events[event_id] = wave
+        while len(waves) <= wave:
+            waves.append([])
+        waves[wave].append(index)
 
+    service = get_calendar_service(user_id)
+    failure = None  # Error of the batch request that failed; nothing is sent after it
+    for wave in waves:
+        if failure is not None:
+            for index in wave:
+                results[index] = _not_run_result(calls[index][0], failure)
+            continue
+        
+        requests = []
+        for index in wave:
+            tool_name, arguments = calls[index]
+            request, finish, error = _event_mutation_request(service, user_id, tool_name, arguments)
+            if error:
+                results[index] = error
+            else:
+                requests.append((index, request, finish))
+        
+        for start in range(0, len(requests), MAX_BATCH_REQUESTS):
+            chunk = requests[start:start + MAX_BATCH_REQUESTS]
+            if failure is not None:
+                for index, _, _ in chunk:
+                    results[index] = _not_run_result(calls[index][0], failure)
+                continue
+            
+            batch = service.new_batch_http_request()
+            for index, request, finish in chunk:
+                def callback(request_id, response, exception, index=index, finish=finish):
+                    if exception is not None:
+                        print(f"Error in batched {calls[index][0]}: {exception}")
+                        results[index] = {"error": f"Failed to {calls[index][0].replace('_', ' ')}: {str(exception)}"}
+                    else:
+                        results[index] = finish(response)
+                batch.add(request, callback=callback, request_id=str(index))
+            try:
+                batch.execute()
+            except Exception as e:
+                failure = str(e)
+                print(f"Error executing calendar batch: {failure}")
+                for index, _, _ in chunk:
+                    if results[index] is None:
+                        results[index] = unknown_mutation_result(calls[index][0], f"got no response ({failure})")
+    return results
+
+def unknown_mutation_result(tool_name, reason):
+    """
+    Result of a calendar mutation that may or may not have been applied (it timed out, or
+    its request failed without a response). Claude is told not to retry it, so it checks
+    the calendar instead of creating a duplicate.
+    """
+    return {
+        "error": f"{tool_name} {reason} and its outcome is unknown. "
+                 f"Do not retry it; check the calendar with get_events before making further changes.",
+        "outcome": "unknown"
+    }
+
+def _not_run_result(tool_name, failure):
+    return {"error": f"{tool_name} was not run because an earlier calendar request failed ({failure}); it is safe to retry"}
+
+def _event_mutation_request(service, user_id, tool_name, arguments):
+    """
+    Builds the unexecuted Calendar API request for one mutation tool call.
+    
+    Returns:
+      tuple: (HttpRequest, function turning the response into the tool result, error dict or None)
+    """
     try:
-        updated_event = service.events().update(
-            calendarId='primary', 
-            eventId=event_id, 
-            body=event,
-            sendUpdates=send_updates
-        ).execute()
+        if tool_name == 'add_event':
+            event, send_updates, error = _new_event_body(
+                arguments["title"], arguments.get("description", ""), arguments["start_day"], arguments["end_day"],
+                arguments["start_time"], arguments["end_time"], arguments.get("location", ""), arguments.get("attendees")
+            )
+            if error:
+                return None, None, error
+            request = service.events().insert(calendarId='primary', body=event, sendUpdates=send_updates)
+            return request, lambda response: _event_result(user_id, response, 'created'), None
         
-        print('Event updated: %s' % updated_event.get('htmlLink'))
+        event_id = arguments["event_id"]
+        if tool_name == 'update_event':
+            changes, send_updates, error = _event_patch_body(
+                arguments.get("title"), arguments.get("description"), arguments.get("start_day"), arguments.get("end_day"),
+                arguments.get("start_time"), arguments.get("end_time"), arguments.get("location"), arguments.get("attendees")
+            )
+            if error:
+                return None, None, error
+            request = service.events().patch(calendarId='primary', eventId=event_id, body=changes, sendUpdates=send_updates)
+            return request, lambda response: _event_result(user_id, response, 'updated'), None
         
-        # Return a simplified event object with key information
-        return {
-            'id': updated_event.get('id'),
-            'summary': updated_event.get('summary'),
-            'start': updated_event.get('start', {}).get('dateTime'),
-            'end': updated_event.get('end', {}).get('dateTime'),
-            'location': updated_event.get('location', ''),
-            'link': updated_event.get('htmlLink')
-        }
+        if tool_name == 'delete_event':
+            request = service.events().delete(calendarId='primary', eventId=event_id)
+            return request, lambda response: _deleted_event_result(user_id, event_id), None
+    except KeyError as e:
+        return None, None, {"error": f"Missing argument for {tool_name}: {str(e)}"}
     except Exception as e:
-        print(f"Error updating event: {e}")
-        return {"error": f"Failed to update event: {str(e)}"}
-    
\ No newline at end of file
+        print(f"Error building {tool_name} request: {str(e)}")
+        return None, None, {"error": f"Failed to {tool_name.replace('_', ' ')}: {str(e)}"}
+    return None, None, {"error": f"Not a calendar mutation: {tool_name}"}
@@ -0,0 +1,181 @@
+import contextlib
+import contextvars
+import functools
+import threading
+from firebase_functions.params import StringParam
+
+# Span exporter: '' (spans are not recorded), 'console', or 'otlp' (OTLP over HTTP, e.g. a local collector).
+# Exporting needs the optional opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages.
+TRACE_EXPORTER = StringParam('TRACE_EXPORTER', '')
+TRACE_OTLP_ENDPOINT = StringParam('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+
+TRACE_SERVICE_NAME = 'starlis-functions'
+
+_tracer = None  # False when tracing is off
+_provider = None
+_tracer_lock = threading.Lock()
+
+class _NoopSpan:
+    """Stands in for an OpenTelemetry span when tracing is off."""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+    def is_recording(self):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+@contextlib.contextmanager
+def span(name, attributes=None, current=True):
+    """
+    Time a block as a span. Exceptions are recorded on the span and re-raised.
+
+    Parameters:
+      name (str): Span name
+      attributes (dict): (Optional) Attributes; None values are skipped
+      current (bool): Make the span the parent of spans started inside the block. Pass False
+                      for blocks that yield to other code (e.g. generators), since the current
+                      span can only be restored in order.
+    """
+    tracer = _get_tracer()
+    if not tracer:
+        yield _NOOP_SPAN
+        return
+    attributes = _clean_attributes(attributes)
+    if current:
+        with tracer.start_as_current_span(name, attributes=attributes) as active:
+            yield active
+        return
+    active = tracer.start_span(name, attributes=attributes)
+    try:
+        yield active
+    except BaseException as e:
+        active.record_exception(e)
+        raise
+    finally:
+        active.end()
+
+def traced(name, flush=False):
+    """
+    Decorator: run the function inside a span. Entry points pass flush=True so spans are
+    exported before the instance goes idle.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                with span(name):
+                    return function(*args, **kwargs)
+            finally:
+                if flush:
+                    flush_traces()
+        return wrapper
+    return decorator
+
+def current_span():
+    """
+    The innermost active span, for adding attributes.
+    """
+    if not _get_tracer():
+        return _NOOP_SPAN
+    from opentelemetry import trace
+    return trace.get_current_span()
+
+def firestore_span(operation, collection):
+    """
+    Span around one Firestore read or write.
+    """
+    return span(f"firestore.{operation}", {
+        'db.system': 'firestore',
+        'db.operation': operation,
+        'db.collection.name': collection
+    })
+
+def model_span(model, purpose):
+    """
+    Span around one Anthropic request; add the token counts with record_model_usage.
+    Not made current, since streaming requests yield while it is open.
+    """
+    return span(f"anthropic.{purpose}", {
+        'gen_ai.system': 'anthropic',
+        'gen_ai.request.model': model
+    }, current=False)
+
+def record_model_usage(active, usage):
+    """
+    Put a response's token counts on its span.
+    """
+    if not active.is_recording() or usage is None:
+        return
+    active.set_attributes(_clean_attributes({
+        'gen_ai.usage.input_tokens': getattr(usage, 'input_tokens', None),
+        'gen_ai.usage.output_tokens': getattr(usage, 'output_tokens', None),
+        'gen_ai.usage.cache_read_input_tokens': getattr(usage, 'cache_read_input_tokens', None),
+        'gen_ai.usage.cache_creation_input_tokens': getattr(usage, 'cache_creation_input_tokens', None)
+    }))
+
+def bind_context(function):
+    """
+    Bind a function to the caller's context (and so its current span), for work handed to
+    a thread pool; pool threads otherwise start with an empty context.
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, function)
+
+def flush_traces():
+    """
+    Export the spans finished so far.
+    """
+    if _provider is not None:
+        try:
+            _provider.force_flush()
+        except Exception as e:
+            print(f"Error exporting spans: {e}")
+
+def _clean_attributes(attributes):
+    return {key: value for key, value in (attributes or {}).items() if value is not None}
+
+def _get_tracer():
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = _build_tracer()
+    return _tracer
+
+def _build_tracer():
+    """
+    Set up the OpenTelemetry tracer provider for TRACE_EXPORTER.
+
+    Returns:
+      Tracer or False: the tracer, or False if tracing is off or OpenTelemetry isn't installed
+    """
+    global _provider
+    exporter_name = TRACE_EXPORTER.value.strip().lower()
+    if exporter_name in ('', 'none'):
+        return False
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+        if exporter_name == 'otlp':
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter(endpoint=TRACE_OTLP_ENDPOINT.value)
+        else:
+            exporter = ConsoleSpanExporter()
+    except ImportError as e:
+        print(f"Tracing is off, OpenTelemetry is not installed: {e}")
+        return False
+
+    _provider = TracerProvider(resource=Resource.create({'service.name': TRACE_SERVICE_NAME}))
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+    return _provider.get_tracer(TRACE_SERVICE_NAME)
@@ -0,0 +1,190 @@
+from datetime import datetime, timedelta, timezone
+from clients import get_db
+from tracing import firestore_span
+
+# Per-user, per-day token counters: usage_daily/{user_id}_{YYYY-MM-DD} (UTC days)
+USAGE_COLLECTION = 'usage_daily'
+
+# Token counts taken from each response's usage
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+# Usage accounting settings
+USAGE_MAX_CALLS_PER_TASK = 50  # Per-call records kept on a task_history document; totals cover every call
+
+# Price per million tokens: (input, output, cache write, cache read); matched by model prefix
+MODEL_PRICES = {
+    'claude-3-5-haiku': (0.80, 4.00, 1.00, 0.08),
+    'claude-3-haiku': (0.25, 1.25, 0.30, 0.03),
+    'claude-3-7-sonnet': (3.00, 15.00, 3.75, 0.30),
+    'claude-sonnet-4': (3.00, 15.00, 3.75, 0.30),
+    'claude-opus-4': (15.00, 75.00, 18.75, 1.50)
+}
+
+class UsageLedger:
+    """
+    Token usage of the Anthropic requests made while handling one request (an email task or a
+    chat message), one entry per API call.
+
+    The totals go on the task_history document (see TaskHistoryWriter) and are added to the
+    user's usage_daily counter with Firestore increments, in the same batch as the task
+    update; requests without a task call flush(). Only calls recorded since the last write
+    are added to the counters, so writing more than once never double counts.
+    """
+
+    def __init__(self, user_id=None, secretary_id=None):
+        self.user_id = user_id
+        self.secretary_id = secretary_id
+        self.calls = []
+        self.counted = 0  # Calls already added to the daily counters
+
+    def record(self, model, usage, purpose):
+        """
+        Add one response's usage.
+
+        Parameters:
+          model (str): The model the request was sent to
+          usage: The response's usage (anthropic.types.Usage)
+          purpose (str): What the request was for, e.g. 'tool_loop', 'triage', 'reply', 'thread_summary'
+        """
+        call = {'model': model, 'purpose': purpose}
+        for field in USAGE_FIELDS:
+            call[field] = getattr(usage, field, 0) or 0
+        call['cost_usd'] = round(usage_cost(model, call), 6)
+        self.calls.append(call)
+        return call
+
+    def totals(self, purpose=None, calls=None):
+        """
+        Summed token counts and cost, over all calls or only those for one purpose.
+
+        Returns:
+          dict: {requests, input_tokens, output_tokens, cache_read_input_tokens, cache_creation_input_tokens, cost_usd}
+        """
+        calls = self.calls if calls is None else calls
+        totals = new_usage_totals()
+        for call in calls:
+            if purpose is None or call['purpose'] == purpose:
+                _add_call(totals, call)
+        totals['cost_usd'] = round(totals['cost_usd'], 6)
+        return totals
+
+    def task_fields(self):
+        """
+        The 'usage' field of the task_history document: totals, per-model totals and the calls.
+        """
+        by_model = {}
+        for call in self.calls:
+            _add_call(by_model.setdefault(call['model'], new_usage_totals()), call)
+        usage = self.totals()
+        usage['by_model'] = by_model
+        usage['calls'] = self.calls[:USAGE_MAX_CALLS_PER_TASK]
+        return {'usage': usage}
+
+    def add_daily_counters(self, batch, db):
+        """
+        Queue increments of the user's usage_daily counters for the calls not counted yet.
+        Does nothing without a user_id.
+        """
+        from firebase_admin import firestore
+        calls = self.calls[self.counted:]
+        if not self.user_id or not calls:
+            return
+
+        day = datetime.now(timezone.utc).date().isoformat()
+        totals = self.totals(calls=calls)
+        counters = {
+            'user_id': self.user_id,
+            'day': day,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            **_increments(totals),
+            'models': {},
+            'purposes': {}
+        }
+        for model in {call['model'] for call in calls}:
+            counters['models'][model] = _increments(self.totals(calls=[call for call in calls if call['model'] == model]))
+        for purpose in {call['purpose'] for call in calls}:
+            counters['purposes'][purpose] = _increments(self.totals(purpose, calls))
+        if self.secretary_id:
+            counters['secretaries'] = {self.secretary_id: _increments(totals)}
+
+        batch.set(db.collection(USAGE_COLLECTION).document(f"{self.user_id}_{day}"), counters, merge=True)
+        self.counted = len(self.calls)
+
+    def flush(self, db=None):
+        """
+        Write the daily counters on their own, for requests without a task_history document.
+        Failures are logged; the request has already been answered.
+        """
+        if not self.user_id or self.counted == len(self.calls):
+            return
+        try:
+            db = db or get_db()
+            batch = db.batch()
+            self.add_daily_counters(batch, db)
+            with firestore_span('batch_commit', USAGE_COLLECTION):
+                batch.commit()
+        except Exception as e:
+            print(f"Error recording usage for {self.user_id}: {e}")
+
+def new_usage_totals():
+    totals = {'requests': 0, 'cost_usd': 0.0}
+    totals.update({field: 0 for field in USAGE_FIELDS})
+    return totals
+
+def usage_cost(model, usage):
+    """
+    Estimated cost in USD of the requests counted in a usage dict (token fields as in USAGE_FIELDS).
+    Unknown models count as free.
+    """
+    if not usage or not model:
+        return 0.0
+    prices = next((prices for prefix, prices in MODEL_PRICES.items() if model.startswith(prefix)), None)
+    if prices is None:
+        return 0.0
+    input_price, output_price, write_price, read_price = prices
+    return (
+        usage.get('input_tokens', 0) * input_price
+        + usage.get('output_tokens', 0) * output_price
+        + usage.get('cache_creation_input_tokens', 0) * write_price
+        + usage.get('cache_read_input_tokens', 0) * read_price
+    ) / 1_000_000
+
+def top_consumers(days=1, limit=10, by='cost_usd', db=None):
+    """
+    Users with the highest usage over the last `days` UTC days (today included), from the
+    usage_daily counters.
+
+    Parameters:
+      days (int): Number of days, counting back from today
+      limit (int): Number of users returned
+      by (str): Field to rank by: 'cost_usd', 'requests' or one of USAGE_FIELDS
+      db: (Optional) Firestore client
+
+    Returns:
+      list: dicts with user_id, days (number of days with usage) and the summed totals, highest first
+    """
+    db = db or get_db()
+    first_day = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+    users = {}
+    with firestore_span('query', USAGE_COLLECTION):
+        snapshots = db.collection(USAGE_COLLECTION).where('day', '>=', first_day).stream()
+        for snapshot in snapshots:
+            data = snapshot.to_dict()
+            user = users.setdefault(data.get('user_id'), dict(new_usage_totals(), user_id=data.get('user_id'), days=0))
+            user['days'] += 1
+            for field in ('requests', 'cost_usd') + USAGE_FIELDS:
+                user[field] += data.get(field, 0) or 0
+    ranked = sorted(users.values(), key=lambda user: user.get(by, 0), reverse=True)
+    for user in ranked:
+        user['cost_usd'] = round(user['cost_usd'], 6)
+    return ranked[:limit]
+
+def _add_call(totals, call):
+    totals['requests'] += 1
+    totals['cost_usd'] += call['cost_usd']
+    for field in USAGE_FIELDS:
+        totals[field] += call[field]
+
+def _increments(totals):
+    from firebase_admin import firestore
+    return {field: firestore.Increment(value) for field, value in totals.items()}
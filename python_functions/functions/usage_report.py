@@ -0,0 +1,30 @@
+"""
+Report the users with the highest Claude usage, from the usage_daily counters.
+
+Usage:
+    python usage_report.py [--days 7] [--limit 20] [--by cost_usd]
+
+Needs the admin credentials file (see clients.FIREBASE_CREDENTIALS_FILE) in the working directory.
+"""
+import argparse
+from usage_accounting import USAGE_FIELDS, top_consumers
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=1, help='UTC days to cover, counting back from today (default: 1)')
+    parser.add_argument('--limit', type=int, default=10, help='Users to show (default: 10)')
+    parser.add_argument('--by', default='cost_usd', choices=('cost_usd', 'requests') + USAGE_FIELDS, help='Ranking field')
+    args = parser.parse_args()
+
+    consumers = top_consumers(days=args.days, limit=args.limit, by=args.by)
+    if not consumers:
+        print(f"No usage recorded in the last {args.days} day(s)")
+        exit(0)
+
+    print(f"{'user_id':<30} {'days':>4} {'requests':>8} {'input':>10} {'output':>9} {'cache_read':>11} {'cache_write':>11} {'cost_usd':>10}")
+    for user in consumers:
+        print(
+            f"{str(user['user_id']):<30} {user['days']:>4} {user['requests']:>8} {user['input_tokens']:>10} "
+            f"{user['output_tokens']:>9} {user['cache_read_input_tokens']:>11} {user['cache_creation_input_tokens']:>11} "
+            f"{user['cost_usd']:>10.4f}"
+        )
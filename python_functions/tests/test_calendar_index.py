@@ -0,0 +1,63 @@
+"""
+Persisting the calendar index: the saved document stays under Firestore's size limit when
+events have long descriptions, and a save that fails is logged.
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import calendar_index
+
+def make_index(count, description_chars):
+    index = calendar_index.CalendarIndex('user-1')
+    now = datetime.now(timezone.utc)
+    for number in range(count):
+        start = now + timedelta(hours=number * 6)
+        index.put({
+            'id': f'event-{number}',
+            'summary': f'Meeting {number}',
+            'start': {'dateTime': start.isoformat()},
+            'end': {'dateTime': (start + timedelta(hours=1)).isoformat()},
+            'description': 'x' * description_chars
+        })
+    index.sync_token = 'token'
+    index.window_start = (now - timedelta(days=30)).timestamp()
+    index.window_end = (now + timedelta(days=365)).timestamp()
+    return index
+
+def test_long_descriptions_are_persisted_within_the_byte_cap():
+    index = make_index(400, 8000)
+    data = index.to_dict(calendar_index.CALENDAR_INDEX_PERSIST_MAX_EVENTS, calendar_index.CALENDAR_INDEX_PERSIST_MAX_BYTES)
+
+    assert 0 < len(data['events']) < 400
+    assert len(json.dumps(data['events']).encode('utf-8')) <= calendar_index.CALENDAR_INDEX_PERSIST_MAX_BYTES
+    assert data['window_end'] < index.window_end
+
+    # The reloaded index answers what it covers exactly as the full one does
+    loaded = calendar_index.CalendarIndex.from_dict('user-1', data)
+    start, end = time.time(), data['window_end']
+    assert loaded.covers(start, end)
+    assert [event['id'] for event in loaded.query(start, end)] == [event['id'] for event in index.query(start, end)]
+    assert not loaded.covers(start, index.window_end)
+
+def test_small_index_is_persisted_whole():
+    index = make_index(20, 100)
+    data = index.to_dict(calendar_index.CALENDAR_INDEX_PERSIST_MAX_EVENTS, calendar_index.CALENDAR_INDEX_PERSIST_MAX_BYTES)
+
+    assert len(data['events']) == 20
+    assert (data['window_start'], data['window_end']) == (index.window_start, index.window_end)
+
+def test_failed_save_is_logged(monkeypatch, caplog):
+    class FailingDatabase:
+        def collection(self, name):
+            raise RuntimeError('Document too large')
+
+    monkeypatch.setattr(calendar_index, 'get_db', FailingDatabase)
+    calendar_index._persist_index('user-1', make_index(3, 10).to_dict())
+
+    assert 'Error saving calendar index for user-1' in caplog.text
+    assert 'Document too large' in caplog.text
@@ -0,0 +1,80 @@
+"""
+Calendar service pool: pool hits never read Firestore, a reconnect seen in the cached
+profile rebuilds the service, and a profile that can't be read doesn't force a rebuild on
+every call.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+
+import calendar_index
+import profile_cache
+import tools
+
+class UnreachableDatabase:
+    def __init__(self):
+        self.reads = 0
+
+    def collection(self, name):
+        self.reads += 1
+        raise ConnectionError('Firestore unavailable')
+
+def tokens(refresh_token):
+    return {'google_oauth_token': {'access_token': 'access', 'refresh_token': refresh_token}}
+
+@pytest.fixture
+def db(monkeypatch):
+    db = UnreachableDatabase()
+    monkeypatch.setattr(profile_cache, 'get_db', lambda: db)
+    monkeypatch.setattr(tools, '_ensure_fresh_credentials', lambda entry: None)
+    tools._service_pool.clear()
+    yield db
+    tools._service_pool.clear()
+    profile_cache.invalidate_cached_document('users', 'user-1')
+
+def test_pool_hits_do_not_read_firestore(db):
+    profile_cache.put_cached_document('users', 'user-1', tokens('refresh-1'))
+    service = tools.get_calendar_service('user-1')
+
+    assert tools.get_calendar_service('user-1') is service
+    profile_cache.invalidate_cached_document('users', 'user-1')
+    assert tools.get_calendar_service('user-1') is service
+    assert db.reads == 0
+
+def test_reconnect_rebuilds_the_service(db):
+    profile_cache.put_cached_document('users', 'user-1', tokens('refresh-1'))
+    service = tools.get_calendar_service('user-1')
+    calendar_index._indexes['user-1'] = calendar_index.CalendarIndex('user-1')
+
+    profile_cache.put_cached_document('users', 'user-1', tokens('refresh-2'))
+    rebuilt = tools.get_calendar_service('user-1')
+
+    assert rebuilt is not service
+    assert tools._service_pool['user-1']['creds'].refresh_token == 'refresh-2'
+    assert 'user-1' not in calendar_index._indexes
+    assert tools.get_calendar_service('user-1') is rebuilt
+
+def test_unreadable_profile_does_not_rebuild_every_call(db):
+    service = tools.get_calendar_service('user-1')
+
+    assert tools.get_calendar_service('user-1') is service
+    assert tools.get_calendar_service('user-1') is service
+    assert db.reads == 1
+
+def test_refresh_failure_evicts_and_rereads_tokens(db, monkeypatch):
+    from google.auth.exceptions import RefreshError
+
+    profile_cache.put_cached_document('users', 'user-1', tokens('refresh-1'))
+    tools.get_calendar_service('user-1')
+
+    def refresh_fails(entry):
+        raise RefreshError('invalid_grant')
+    monkeypatch.setattr(tools, '_ensure_fresh_credentials', refresh_fails)
+
+    with pytest.raises(RefreshError):
+        tools.get_calendar_service('user-1')
+    assert 'user-1' not in tools._service_pool
+    assert profile_cache.peek_cached_document('users', 'user-1') is None
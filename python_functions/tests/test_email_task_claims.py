@@ -0,0 +1,121 @@
+"""
+Email task claims: a 'processing' claim left by a run that died is taken again once its lease
+expires (up to TASK_MAX_CLAIMS runs), and a failed failure write doesn't hide the error.
+"""
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+from firebase_admin import firestore
+
+import email_pipeline
+
+class Snapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+class DocumentRef:
+    def __init__(self, database, doc_id):
+        self.database = database
+        self.doc_id = doc_id
+
+    def get(self, transaction=None):
+        return Snapshot(self.doc_id, self.database.docs.get(self.doc_id))
+
+class Transaction:
+    def update(self, ref, data):
+        doc = ref.database.docs[ref.doc_id]
+        for key, value in data.items():
+            if value is firestore.SERVER_TIMESTAMP:
+                value = datetime.now(timezone.utc)
+            elif isinstance(value, firestore.Increment):
+                value = doc.get(key, 0) + value.value
+            doc[key] = value
+
+class Query:
+    def __init__(self, database, field, value):
+        self.database = database
+        self.field = field
+        self.value = value
+
+    def stream(self):
+        return [Snapshot(doc_id, data) for doc_id, data in self.database.docs.items() if data.get(self.field) == self.value]
+
+class Database:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return DocumentRef(self, doc_id)
+
+    def transaction(self):
+        return Transaction()
+
+    def where(self, field, op, value):
+        return Query(self, field, value)
+
+def claimed(seconds_ago, claim_count=1):
+    claimed_at = datetime.fromtimestamp(time.time() - seconds_ago, timezone.utc)
+    return {'type': 'email', 'status': 'processing', 'processing_started_at': claimed_at, 'claim_count': claim_count}
+
+@pytest.fixture(autouse=True)
+def run_transactions_directly(monkeypatch):
+    monkeypatch.setattr(firestore, 'transactional', lambda function: function)
+
+def test_expired_claim_is_taken_again():
+    db = Database({'task-1': claimed(email_pipeline.TASK_CLAIM_LEASE_SECONDS + 1)})
+
+    assert email_pipeline.claim_email_task('task-1', db)['type'] == 'email'
+    assert db.docs['task-1']['claim_count'] == 2
+    assert not email_pipeline.claim_expired(db.docs['task-1'])
+
+def test_live_claim_is_left_alone():
+    db = Database({'task-1': claimed(10)})
+
+    assert email_pipeline.claim_email_task('task-1', db) is None
+    assert db.docs['task-1']['claim_count'] == 1
+
+def test_task_fails_after_max_claims():
+    db = Database({'task-1': claimed(email_pipeline.TASK_CLAIM_LEASE_SECONDS + 1, email_pipeline.TASK_MAX_CLAIMS)})
+
+    assert email_pipeline.claim_email_task('task-1', db) is None
+    assert db.docs['task-1']['status'] == 'failed'
+
+def test_only_stale_tasks_are_run_again(monkeypatch):
+    db = Database({
+        'stale': claimed(email_pipeline.TASK_CLAIM_LEASE_SECONDS + 1),
+        'live': claimed(10),
+        'done': {'type': 'email', 'status': 'completed'}
+    })
+    ran = []
+    monkeypatch.setattr(email_pipeline, 'process_email_task', lambda task_id, db, domain: ran.append(task_id))
+
+    assert email_pipeline.run_stale_email_tasks(db, 'example.com') == ['stale']
+    assert ran == ['stale']
+
+def test_failed_flush_keeps_the_original_error(monkeypatch, caplog):
+    monkeypatch.setattr(email_pipeline, 'claim_email_task', lambda task_id, db: {'secretary_id': 'missing'})
+    monkeypatch.setattr(email_pipeline, 'get_secretary_info', lambda secretary_id, db: None)
+
+    def flush_fails(self):
+        raise ConnectionError('Firestore unavailable')
+    monkeypatch.setattr(email_pipeline.TaskHistoryWriter, 'flush', flush_fails)
+
+    with caplog.at_level(logging.ERROR):
+        email_pipeline.process_email_task('task-1', Database({}), 'example.com')
+
+    assert 'No secretary found with ID: missing' in caplog.text
+    assert 'Firestore unavailable' in caplog.text
@@ -0,0 +1,136 @@
+"""
+Email threading across a two-round exchange: replies carry Message-ID, In-Reply-To and
+References, and the thread memory is found again from either header of the next email.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+from firebase_admin import firestore
+
+import email_utils
+import thread_memory
+
+class Snapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+class Document:
+    def __init__(self, docs, path, doc_id):
+        self._docs = docs
+        self.path = f"{path}/{doc_id}"
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        return Snapshot(self.id, self._docs.get(self.path))
+
+    def set(self, data):
+        self._docs[self.path] = dict(data)
+
+class Collection:
+    def __init__(self, docs, path):
+        self._docs = docs
+        self._path = path
+
+    def document(self, doc_id):
+        return Document(self._docs, self._path, doc_id)
+
+class Transaction:
+    def set(self, ref, data):
+        ref.set(data)
+
+class Database:
+    """In-memory documents; transactions write straight through."""
+
+    def __init__(self):
+        self.docs = {}
+
+    def collection(self, name):
+        return Collection(self.docs, name)
+
+    def transaction(self):
+        return Transaction()
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+class SendGrid:
+    def __init__(self):
+        self.sent = []
+
+    def post(self, path, json):
+        self.sent.append(json)
+        return type("Response", (), {"status_code": 202, "raise_for_status": lambda self: None})()
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(firestore, "transactional", lambda function: function)
+    return Database()
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    client = SendGrid()
+    monkeypatch.setattr(email_utils, "get_sendgrid_client", lambda api_key: client)
+    return client
+
+def exchange(db, email, reply_text, thread_key):
+    """Reply to an inbound email and store the exchange, as the email worker does."""
+    sent_id = email_utils.send_email_response(
+        to_email="sam@example.org",
+        from_email="ava@secretary.test",
+        subject=f"Re: {email['subject']}",
+        content=reply_text,
+        message_id=email["message_id"],
+        references=email.get("references"),
+        domain="secretary.test"
+    )
+    thread_memory.append_turns(thread_key, [
+        {"role": "user", "content": email["body"]},
+        {"role": "assistant", "content": reply_text}
+    ], db=db, message_ids=[email["message_id"], sent_id])
+    return sent_id
+
+def test_two_round_exchange_shares_thread_memory(db, sendgrid):
+    first = {"message_id": "<m1@example.org>", "subject": "Lunch", "body": "Lunch on Friday?"}
+    thread_key = thread_memory.resolve_email_thread(first["message_id"], db=db)
+    first_reply_id = exchange(db, first, "Friday at noon works.", thread_key)
+
+    headers = sendgrid.sent[-1]["headers"]
+    assert headers["Message-ID"] == first_reply_id
+    assert headers["In-Reply-To"] == "<m1@example.org>"
+    assert headers["References"] == "<m1@example.org>"
+
+    # The user's reply to our reply, with the References our email carried
+    second = {
+        "message_id": "<m2@example.org>",
+        "subject": "Re: Lunch",
+        "body": "Great, see you there.",
+        "references": f"{headers['References']} {first_reply_id}",
+        "in_reply_to": first_reply_id
+    }
+    assert thread_memory.resolve_email_thread(second["message_id"], second["references"], second["in_reply_to"], db) == thread_key
+    memory = thread_memory.load_thread(thread_key, db)
+    assert [turn["content"] for turn in memory["turns"]] == ["Lunch on Friday?", "Friday at noon works."]
+
+    exchange(db, second, "See you Friday.", thread_key)
+    headers = sendgrid.sent[-1]["headers"]
+    assert headers["In-Reply-To"] == "<m2@example.org>"
+    assert headers["References"] == f"<m1@example.org> {first_reply_id} <m2@example.org>"
+    assert len(thread_memory.load_thread(thread_key, db)["turns"]) == 4
+
+def test_reply_with_only_in_reply_to_finds_the_thread(db, sendgrid):
+    first = {"message_id": "<m1@example.org>", "subject": "Lunch", "body": "Lunch on Friday?"}
+    thread_key = thread_memory.resolve_email_thread(first["message_id"], db=db)
+    first_reply_id = exchange(db, first, "Friday at noon works.", thread_key)
+
+    # Some clients drop References and keep only In-Reply-To
+    assert thread_memory.resolve_email_thread("<m2@example.org>", None, first_reply_id, db) == thread_key
+    # An unrelated email starts a new thread
+    assert thread_memory.resolve_email_thread("<other@example.org>", None, None, db) != thread_key
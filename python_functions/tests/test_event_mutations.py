@@ -0,0 +1,91 @@
+"""
+Batched calendar mutations when a batch request fails partway through a turn: results that
+came back are kept, calls without a response get an "unknown" outcome, and calls that were
+never sent are reported as not run.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import ai_utils
+import tools
+
+class Request:
+    def __init__(self, method, **params):
+        self.method = method
+        self.params = params
+
+class Events:
+    def insert(self, **params):
+        return Request('insert', **params)
+
+    def patch(self, **params):
+        return Request('patch', **params)
+
+    def delete(self, **params):
+        return Request('delete', **params)
+
+class Batch:
+    def __init__(self, service):
+        self.service = service
+        self.parts = []
+
+    def add(self, request, callback, request_id):
+        self.parts.append((request, callback, request_id))
+
+    def execute(self):
+        number = len(self.service.executed)
+        self.service.executed.append([request.method for request, _, _ in self.parts])
+        for position, (request, callback, request_id) in enumerate(self.parts):
+            if (number, position) == self.service.fail_at:
+                raise ConnectionError('connection reset')
+            if request.method == 'delete':
+                callback(request_id, '', None)
+            else:
+                event_id = request.params.get('eventId', 'new-event')
+                callback(request_id, {'id': event_id, 'summary': 'Meeting', 'start': {}, 'end': {}}, None)
+
+class Service:
+    def __init__(self, fail_at):
+        self.fail_at = fail_at  # (batch number, part) at which execute() raises
+        self.executed = []
+
+    def events(self):
+        return Events()
+
+    def new_batch_http_request(self):
+        return Batch(self)
+
+CALLS = [
+    ('add_event', {'title': 'Sync', 'start_day': '10/20/2026', 'end_day': '10/20/2026',
+                   'start_time': '10:00 AM', 'end_time': '11:00 AM'}),
+    ('delete_event', {'event_id': 'old'}),
+    ('update_event', {'event_id': 'evt-1', 'title': 'Renamed'}),
+    ('update_event', {'event_id': 'evt-1', 'location': 'Room 4'})
+]
+
+def run(monkeypatch, fail_at):
+    service = Service(fail_at)
+    monkeypatch.setattr(tools, 'get_calendar_service', lambda user_id: service)
+    return ai_utils.handle_mutation_batch('user-1', CALLS), service
+
+def test_failure_inside_first_batch_keeps_applied_results(monkeypatch):
+    outcomes, service = run(monkeypatch, fail_at=(0, 1))
+    results = [result for result, _ in outcomes]
+
+    assert results[0]['id'] == 'new-event'
+    assert results[1]['outcome'] == 'unknown'
+    assert results[2]['outcome'] == 'unknown'
+    assert 'not run' in results[3]['error'] and 'outcome' not in results[3]
+    assert len(service.executed) == 1
+
+def test_failure_in_later_batch_keeps_earlier_batches(monkeypatch):
+    outcomes, service = run(monkeypatch, fail_at=(1, 0))
+    results = [result for result, _ in outcomes]
+
+    assert results[0]['id'] == 'new-event'
+    assert results[1]['status'] == 'success'
+    assert results[2]['id'] == 'evt-1'
+    assert results[3]['outcome'] == 'unknown'
+    assert service.executed == [['insert', 'delete', 'patch'], ['patch']]
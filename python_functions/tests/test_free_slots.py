@@ -0,0 +1,57 @@
+"""
+find_free_slots from the calendar index: events shown as free don't block time, all-day
+events block the day only when shown as busy, and windows start on a rounded time.
+"""
+import os
+import sys
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+import pytz
+
+import calendar_index
+import tools
+
+# Tuesday 10/20/2026 and Wednesday 10/21/2026, in the calendar's time zone
+EVENTS = [
+    {'id': 'standup', 'start': '2026-10-20T09:00:00-04:00', 'end': '2026-10-20T09:50:00-04:00'},
+    {'id': 'hold', 'start': '2026-10-20T13:00:00-04:00', 'end': '2026-10-20T17:00:00-04:00', 'transparency': 'transparent'},
+    {'id': 'birthday', 'start': '2026-10-20', 'end': '2026-10-21', 'transparency': 'transparent'},
+    {'id': 'out-of-office', 'start': '2026-10-21', 'end': '2026-10-22'}
+]
+
+def set_now(monkeypatch, *local_time):
+    now = pytz.timezone(calendar_index.CALENDAR_TIMEZONE).localize(datetime(*local_time)).timestamp()
+    monkeypatch.setattr(tools, 'time', SimpleNamespace(time=lambda: now, monotonic=time.monotonic))
+
+@pytest.fixture(autouse=True)
+def indexed_events(monkeypatch):
+    set_now(monkeypatch, 2026, 10, 19, 8, 0)
+    def get_indexed_events(user_id, start_dt, end_dt):
+        start_ts, end_ts = start_dt.timestamp(), end_dt.timestamp()
+        return [event for event in EVENTS if calendar_index.event_interval(event)[0] < end_ts
+                and calendar_index.event_interval(event)[1] > start_ts]
+    monkeypatch.setattr(tools, 'get_indexed_events', get_indexed_events)
+
+def test_free_events_do_not_block_and_busy_all_day_events_do():
+    result = tools.find_free_slots('user-1', '10/20/2026', '10/21/2026', 60)
+
+    assert result['slots'] == [{'day': '10/20/2026', 'start_time': '10:00 AM', 'end_time': '05:00 PM'}]
+
+def test_windows_start_on_the_granularity(monkeypatch):
+    set_now(monkeypatch, 2026, 10, 20, 10, 37)
+
+    result = tools.find_free_slots('user-1', '10/20/2026', '10/20/2026', 30)
+
+    assert result['slots'] == [{'day': '10/20/2026', 'start_time': '10:45 AM', 'end_time': '05:00 PM'}]
+
+def test_simplified_events_keep_only_free_transparency():
+    free = calendar_index.simplify_event({'id': 'a', 'start': {'date': '2026-10-20'}, 'end': {'date': '2026-10-21'}, 'transparency': 'transparent'})
+    busy = calendar_index.simplify_event({'id': 'b', 'start': {'date': '2026-10-20'}, 'end': {'date': '2026-10-21'}, 'transparency': 'opaque'})
+
+    assert free['transparency'] == 'transparent'
+    assert 'transparency' not in busy
@@ -0,0 +1,107 @@
+"""
+Streaming inbound parsing: bodies cut at MAX_FORM_FIELD_BYTES are flagged, and attachments
+are either streamed to Cloud Storage or only recorded, never written to local files.
+"""
+import base64
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import flask
+import pytest
+from firebase_admin import storage
+
+import email_utils
+
+BOUNDARY = 'formboundary'
+
+def raw_email(body, attachment=b''):
+    encoded = base64.encodebytes(attachment).decode('ascii')
+    return (
+        'From: Alice <alice@example.com>\r\nTo: ai-abc@starlis.com\r\nSubject: Agenda\r\n'
+        'Message-ID: <m1@example.com>\r\nMIME-Version: 1.0\r\n'
+        'Content-Type: multipart/mixed; boundary="XYZ"\r\n\r\n'
+        '--XYZ\r\nContent-Type: text/plain; charset=utf-8\r\n\r\n' + body + '\r\n'
+        '--XYZ\r\nContent-Type: application/pdf\r\nContent-Disposition: attachment; filename="a.pdf"\r\n'
+        'Content-Transfer-Encoding: base64\r\n\r\n' + encoded + '--XYZ--\r\n'
+    )
+
+def parse(email):
+    body = f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="email"\r\n\r\n{email}\r\n--{BOUNDARY}--\r\n'
+    app = flask.Flask(__name__)
+    with app.test_request_context('/', method='POST', data=body.encode(), content_type=f'multipart/form-data; boundary={BOUNDARY}'):
+        return email_utils.parse_sendgrid_inbound_email(flask.request)
+
+def test_long_body_is_flagged_truncated():
+    line = 'x' * 99 + '\r\n'
+    email_data = parse(raw_email(line * 14000))
+
+    assert len(email_data['text']) <= email_utils.MAX_FORM_FIELD_BYTES
+    assert email_data['truncated'] is True
+
+def test_short_body_is_not_truncated():
+    email_data = parse(raw_email('Can we meet on Tuesday?'))
+
+    assert email_data['text'] == 'Can we meet on Tuesday?'
+    assert email_data['truncated'] is False
+
+def test_attachments_are_metadata_only_without_a_bucket(monkeypatch):
+    monkeypatch.setenv('ATTACHMENT_BUCKET', '')
+    email_data = parse(raw_email('See attached', os.urandom(3000)))
+
+    assert email_data['attachments'] == [
+        {'filename': 'a.pdf', 'content_type': 'application/pdf', 'size': 3000, 'truncated': False}
+    ]
+
+class Writer:
+    def __init__(self, uploads, name):
+        self.uploads = uploads
+        self.name = name
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.uploads[self.name] = self.data
+
+class Blob:
+    def __init__(self, bucket, name, uploads):
+        self.bucket = bucket
+        self.name = name
+        self.uploads = uploads
+
+    def open(self, mode, chunk_size=None, content_type=None):
+        return Writer(self.uploads, self.name)
+
+class Bucket:
+    def __init__(self, name, uploads):
+        self.name = name
+        self.uploads = uploads
+
+    def blob(self, name):
+        return Blob(self, name, self.uploads)
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploads = {}
+    monkeypatch.setenv('ATTACHMENT_BUCKET', 'inbound-bucket')
+    monkeypatch.setattr(email_utils, 'initialize_firebase', lambda: None)
+    monkeypatch.setattr(storage, 'bucket', lambda name: Bucket(name, uploads))
+    return uploads
+
+def test_attachments_stream_to_the_bucket(uploads):
+    content = os.urandom(3000)
+    [attachment] = parse(raw_email('See attached', content))['attachments']
+
+    assert attachment['storage_uri'].startswith('gs://inbound-bucket/inbound_attachments/')
+    assert list(uploads.values()) == [content]
+
+def test_oversized_attachment_is_not_uploaded(uploads, monkeypatch):
+    monkeypatch.setattr(email_utils, 'MAX_ATTACHMENT_BYTES', 1000)
+    [attachment] = parse(raw_email('See attached', os.urandom(3000)))['attachments']
+
+    assert attachment['truncated'] is True
+    assert 'storage_uri' not in attachment
+    assert uploads == {}
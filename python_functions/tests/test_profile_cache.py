@@ -0,0 +1,100 @@
+"""
+Profile cache listeners (PROFILE_CACHE_LISTENERS): snapshots keep cached documents current,
+deleted documents are dropped, and evicted documents stop their listener outside the lock.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+
+import profile_cache
+
+class Snapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+class Watch:
+    def __init__(self):
+        self.unsubscribed = False
+        self.lock_held = None
+
+    def unsubscribe(self):
+        self.lock_held = profile_cache._cache_lock.locked()
+        self.unsubscribed = True
+
+class DocumentRef:
+    def __init__(self, database, doc_id):
+        self.database = database
+        self.doc_id = doc_id
+
+    def get(self):
+        self.database.reads += 1
+        return Snapshot(self.database.docs.get(self.doc_id))
+
+    def on_snapshot(self, callback):
+        watch = Watch()
+        self.database.listeners[self.doc_id] = (callback, watch)
+        return watch
+
+class Database:
+    def __init__(self, docs):
+        self.docs = docs
+        self.reads = 0
+        self.listeners = {}
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return DocumentRef(self, doc_id)
+
+    def change(self, doc_id, data):
+        self.docs[doc_id] = data
+        callback, _ = self.listeners[doc_id]
+        callback([Snapshot(data)], [], None)
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setenv('PROFILE_CACHE_LISTENERS', 'true')
+    profile_cache._cache.clear()
+    profile_cache._watches.clear()
+    yield Database({'user-1': {'first_name': 'Ann'}, 'user-2': {'first_name': 'Bo'}})
+    profile_cache._cache.clear()
+    profile_cache._watches.clear()
+
+def test_listener_keeps_the_cached_document_current(db):
+    assert profile_cache.get_user_profile('user-1', db) == {'first_name': 'Ann'}
+
+    db.change('user-1', {'first_name': 'Anna'})
+
+    assert profile_cache.get_user_profile('user-1', db) == {'first_name': 'Anna'}
+    assert db.reads == 1
+
+def test_deleted_document_is_dropped(db):
+    profile_cache.get_user_profile('user-1', db)
+
+    db.change('user-1', None)
+
+    assert profile_cache.peek_cached_document('users', 'user-1') is None
+
+def test_evicted_document_stops_its_listener_outside_the_lock(db, monkeypatch):
+    monkeypatch.setattr(profile_cache, 'PROFILE_CACHE_MAX_SIZE', 1)
+    profile_cache.get_user_profile('user-1', db)
+    _, watch = db.listeners['user-1']
+
+    profile_cache.get_user_profile('user-2', db)
+
+    assert watch.unsubscribed and watch.lock_held is False
+    assert list(profile_cache._watches) == [('users', 'user-2')]
+
+def test_no_listeners_unless_enabled(db, monkeypatch):
+    monkeypatch.setenv('PROFILE_CACHE_LISTENERS', 'false')
+    profile_cache.get_user_profile('user-1', db)
+
+    assert db.listeners == {}
@@ -0,0 +1,65 @@
+"""
+Response cache lookups take the calendar version from the in-memory index: they never sync
+it or read Firestore, and emails aren't cached while the index is missing or out of date.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import pytest
+
+import calendar_index
+import response_cache
+
+SECRETARY = {'secretary_id': 'sec-1', 'user_id': 'user-1', 'name': 'Ava'}
+BODY = 'Could you send me the agenda for the quarterly planning review when you get a chance?'
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setenv('RESPONSE_CACHE', 'true')
+
+    def no_calendar_io(*args, **kwargs):
+        raise AssertionError('the response cache must not sync or load the calendar index')
+    monkeypatch.setattr(calendar_index, 'sync_calendar_index', no_calendar_io)
+    monkeypatch.setattr(calendar_index, '_load_index', no_calendar_io)
+    response_cache._entries.clear()
+    yield
+    response_cache._entries.clear()
+    calendar_index.evict_calendar_index('user-1')
+
+def synced_index(seconds_ago=0):
+    index = calendar_index.CalendarIndex('user-1')
+    index.synced_at = time.monotonic() - seconds_ago
+    calendar_index._indexes['user-1'] = index
+    return index
+
+def test_cached_response_is_replayed_without_syncing():
+    synced_index()
+    _, probe = response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Agenda', BODY)
+    response_cache.store_response(probe, 'Here it is.', 'Sent the agenda', 1200, mutated=False)
+
+    hit, _ = response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Re: Agenda', BODY)
+
+    assert hit['email_response'] == 'Here it is.'
+    assert hit['kind'] == 'exact'
+
+def test_calendar_change_invalidates_cached_responses():
+    synced_index()
+    _, probe = response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Agenda', BODY)
+    response_cache.store_response(probe, 'Here it is.', 'Sent the agenda', 1200, mutated=False)
+
+    calendar_index.record_event_change('user-1', {'id': 'e1', 'start': {'dateTime': '2026-10-20T09:00:00-04:00'},
+                                                  'end': {'dateTime': '2026-10-20T10:00:00-04:00'}})
+
+    hit, _ = response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Agenda', BODY)
+    assert hit is None
+
+def test_no_index_in_memory_is_not_cached():
+    assert response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Agenda', BODY) == (None, None)
+
+def test_index_synced_too_long_ago_is_not_cached():
+    synced_index(response_cache.RESPONSE_CACHE_CALENDAR_MAX_AGE_SECONDS + 1)
+
+    assert response_cache.lookup_response(SECRETARY, 'bob@example.com', 'Agenda', BODY) == (None, None)
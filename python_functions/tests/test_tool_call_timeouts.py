@@ -0,0 +1,57 @@
+"""
+Tool call timeouts: a turn's only call is timed out like any other, and while a user's
+timed-out calls still hold executor threads, new calls are refused instead of queued.
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import ai_utils
+
+def blocking_tool(release):
+    def handle_tool_call(user_id, tool_name, tool_input):
+        if tool_input.get("block"):
+            release.wait(5)
+        return {"ok": tool_name}, []
+    return handle_tool_call
+
+def test_single_call_times_out(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(ai_utils, "handle_tool_call", blocking_tool(release))
+    try:
+        [(result, _)] = ai_utils.execute_tool_calls("user-1", [("add_event", {"block": True})], timeout=0.1)
+        assert result["outcome"] == "unknown"
+    finally:
+        release.set()
+
+def test_hung_calls_are_capped_per_user(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(ai_utils, "handle_tool_call", blocking_tool(release))
+    finished = threading.Event()
+    original_count = ai_utils._count_hung_tool_call
+
+    def count_hung_tool_call(user_id, change):
+        original_count(user_id, change)
+        if change < 0 and not ai_utils._hung_tool_calls.get(user_id):
+            finished.set()
+    monkeypatch.setattr(ai_utils, "_count_hung_tool_call", count_hung_tool_call)
+
+    try:
+        calls = [("get_events", {"block": True})] * ai_utils.HUNG_TOOL_CALLS_MAX_PER_USER
+        ai_utils.execute_tool_calls("user-2", calls, timeout=0.1)
+        assert ai_utils._hung_tool_calls["user-2"] == ai_utils.HUNG_TOOL_CALLS_MAX_PER_USER
+
+        [(refused, _)] = ai_utils.execute_tool_calls("user-2", [("get_events", {})], timeout=0.1)
+        assert "was not run" in refused["error"]
+
+        # Other users still get their calls run
+        [(other, _)] = ai_utils.execute_tool_calls("user-3", [("get_events", {})], timeout=1)
+        assert other == {"ok": "get_events"}
+    finally:
+        release.set()
+
+    assert finished.wait(5)
+    [(result, _)] = ai_utils.execute_tool_calls("user-2", [("get_events", {})], timeout=1)
+    assert result == {"ok": "get_events"}